@@ -0,0 +1,165 @@
+import hashlib
+import json
+import os
+import random
+
+import joblib
+import numpy as np
+import torch
+
+import dtype_utils
+
+# Folder of the cache (can be changed with the environment variable)
+CACHE_DIR_ENV = 'PAO_CACHE_DIR'
+CACHE_DIR = './cache'
+
+# Set PAO_CACHE=0 to always recompute
+CACHE_ENABLED_ENV = 'PAO_CACHE'
+
+# Source files of the problems, solvers and losses: the optimization 
+# layers of the combined trainings and the oracle costs (see cached_oracle)
+ORACLE_CODE_FILES = ['constrained_newsvendor_utils.py', 'minmax_op_utils.py', 
+                     'classical_newsvendor_utils.py', 'qp_utils.py', 
+                     'params_newsvendor.py', 'quantile_utils.py', 
+                     'scenario_utils.py', 'dtype_utils.py']
+
+# Source files whose content defines the code version of a trained model
+CODE_FILES = ['model.py', 'train.py', 'data_generator.py', 
+              'gauss_proc.py'] + ORACLE_CODE_FILES
+
+
+def cache_enabled():
+    return os.environ.get(CACHE_ENABLED_ENV, '1') != '0'
+
+
+def code_version(files=CODE_FILES):
+    """
+    Hash of the source code that produces the cached artifacts
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    h = hashlib.sha256()
+    for f in files:
+        with open(os.path.join(root, f), 'rb') as fp:
+            h.update(fp.read())
+    return h.hexdigest()
+
+
+def cache_key(**parts):
+    """
+    Content address of an artifact: hash of the key parts (seed, model
+    class, hyperparameters, ...), of the code version and of the dtype.
+    """
+    parts = dict(parts, code_version=code_version(),
+                 dtype=str(dtype_utils.get_dtype()))
+    serialized = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode()).hexdigest()
+
+
+def data_hash(*arrays):
+    """
+    Hash of the content of tensors or arrays (e.g. the test data or the 
+    problem parameters), to use as a key part
+    """
+    h = hashlib.sha256()
+    for array in arrays:
+        if torch.is_tensor(array):
+            array = array.detach().cpu().numpy()
+        array = np.ascontiguousarray(array)
+        h.update(f'{array.dtype}{array.shape}'.encode())
+        h.update(array.tobytes())
+    return h.hexdigest()
+
+
+def cache_path(kind, key):
+    cache_dir = os.environ.get(CACHE_DIR_ENV, CACHE_DIR)
+    return os.path.join(cache_dir, kind, f'{key}.gz')
+
+
+def load(kind, key):
+    """
+    Load a cached artifact, None if not found
+    """
+    path = cache_path(kind, key)
+    if not cache_enabled() or not os.path.isfile(path):
+        return None
+    return joblib.load(path)
+
+
+def save(kind, key, artifact):
+    if not cache_enabled():
+        return
+    path = cache_path(kind, key)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write then rename, so parallel runs never read a partial file
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    joblib.dump(artifact, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def get_rng_states():
+    states = {
+        'torch': torch.get_rng_state(),
+        'numpy': np.random.get_state(),
+        'random': random.getstate()
+    }
+    if torch.cuda.is_available():
+        states['cuda'] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def set_rng_states(states):
+    torch.set_rng_state(states['torch'])
+    np.random.set_state(states['numpy'])
+    random.setstate(states['random'])
+    if 'cuda' in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states['cuda'])
+
+
+def cached_train(train_fn, **key_parts):
+    """
+    Return the model trained by train_fn(), loading it from the cache if
+    a model with the same key parts was already trained. The random
+    states after training are stored too and restored on a cache hit,
+    so the rest of the experiment is the same with or without cache.
+    Returns the model and its cache key (to chain warm-start stages).
+    The source of the experiment script (key part script), which sets the 
+    data, the optimizer and the constants of the training, is part of the 
+    key too.
+    """
+    if 'script' in key_parts:
+        key_parts = dict(key_parts, script_code_version=code_version(
+            [f'{key_parts["script"]}.py']))
+    key = cache_key(**key_parts)
+    artifact = load('models', key)
+    if artifact is not None:
+        print(f'Loading trained model from cache ({key[:12]})')
+        set_rng_states(artifact['rng_states'])
+        return artifact['model'], key
+
+    model = train_fn()
+    save('models', key, {'model': model,
+                         'rng_states': get_rng_states(),
+                         'key_parts': key_parts})
+    return model, key
+
+
+def cached_oracle(compute_fn, **key_parts):
+    """
+    Return the oracle quantities computed by compute_fn() (e.g. the best 
+    and fair costs of the test set), loading them from the cache if they 
+    were computed before. They do not depend on the evaluated model, so 
+    the key parts are only the test data (seed or data_hash), the problem 
+    parameters and the sample counts; every method and M of the same 
+    dataset shares them.
+    """
+    key = cache_key(oracle_code_version=code_version(ORACLE_CODE_FILES), 
+                    **key_parts)
+    value = load('oracle', key)
+    if value is not None:
+        print(f'Loading oracle costs from cache ({key[:12]})')
+        return value
+
+    value = compute_fn()
+    save('oracle', key, value)
+    return value
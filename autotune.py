@@ -0,0 +1,123 @@
+import json
+import os
+import platform
+import time
+
+import torch
+
+import artifact_cache
+import parallel_utils
+
+# Batch sizes tried by tune
+BATCH_SIZES = [16, 32, 64, 128, 256]
+
+# File of the tuned plans, in the cache folder (see artifact_cache)
+PLANS_FILE = 'autotune.json'
+
+
+def candidate_devices():
+    devices = [torch.device('cpu')]
+    if torch.cuda.is_available():
+        devices.append(torch.device('cuda'))
+    return devices
+
+
+def machine_id():
+    """
+    Name of the machine and of its GPU, the plans are only valid on it
+    """
+    gpu = torch.cuda.get_device_name() if torch.cuda.is_available() else None
+    return f'{platform.node()}:{gpu}'
+
+
+def plans_path():
+    cache_dir = os.environ.get(
+        artifact_cache.CACHE_DIR_ENV, artifact_cache.CACHE_DIR)
+    return os.path.join(cache_dir, PLANS_FILE)
+
+
+def load_plans():
+    path = plans_path()
+    if not artifact_cache.cache_enabled() or not os.path.isfile(path):
+        return {}
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def save_plan(key, plan):
+    if not artifact_cache.cache_enabled():
+        return
+    plans = load_plans()
+    plans[key] = plan
+    path = plans_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write then rename, so parallel runs never read a partial file
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as fp:
+        json.dump(plans, fp, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def time_probe(probe, dev, batch_size, n_repeats):
+    """
+    Mean time of probe(dev, batch_size), after a warm-up run
+    """
+    def sync():
+        if dev.type == 'cuda':
+            torch.cuda.synchronize()
+
+    probe(dev, batch_size)
+    sync()
+    t0 = time.perf_counter()
+    for _ in range(0, n_repeats):
+        probe(dev, batch_size)
+    sync()
+    return (time.perf_counter() - t0)/n_repeats
+
+
+def tune(name, probe, max_batch_size=None, batch_sizes=BATCH_SIZES,
+         devices=None, n_repeats=2, **key_parts):
+    """
+    Device and batch size of a decision step. probe(dev, batch_size) runs
+    the step (e.g. the solves of one test batch) and is timed for each
+    candidate; the plan with the most rows per second is returned as
+    {'device', 'batch_size', 'rows_per_s'}. Plans are stored on disk,
+    keyed by name, key_parts (e.g. n_items and M), the machine and the
+    processes and threads of the run (PAO_EVAL_JOBS, PAO_CPU_BUDGET), so
+    the probes only run the first time.
+    """
+    if devices is None:
+        devices = candidate_devices()
+    if max_batch_size is not None:
+        batch_sizes = [bs for bs in batch_sizes if bs <= max_batch_size] \
+        or [max_batch_size]
+    key = artifact_cache.cache_key(
+        name=name, devices=[str(dev) for dev in devices],
+        batch_sizes=list(batch_sizes), machine=machine_id(),
+        eval_jobs=parallel_utils.get_eval_jobs(),
+        cpu_budget=parallel_utils.get_cpu_count(),
+        n_threads=torch.get_num_threads(), **key_parts)
+
+    plan = load_plans().get(key)
+    if plan is not None:
+        return plan
+
+    plan = None
+    for dev in devices:
+        for batch_size in batch_sizes:
+            try:
+                t = time_probe(probe, dev, batch_size, n_repeats)
+            except RuntimeError as e:
+                # e.g. out of memory on the GPU
+                print(f'Probe failed on {dev} with batch size {batch_size}: {e}')
+                continue
+            rows_per_s = batch_size/t
+            if plan is None or rows_per_s > plan['rows_per_s']:
+                plan = {'device': str(dev), 'batch_size': batch_size,
+                        'rows_per_s': rows_per_s}
+    if plan is None:
+        raise RuntimeError(f'No working plan found for {name}')
+
+    print(f'Autotuned {name}: {plan}')
+    save_plan(key, plan)
+    return plan
@@ -0,0 +1,55 @@
+import sys
+
+import pandas as pd
+import torch
+
+import constrained_newsvendor_utils as cnu
+import params_newsvendor as params
+from benchmark_solvers import time_solver
+
+
+def benchmark_newsvendor(n_items, M, k_values, batch_size, n_repeats, dev):
+    """
+    Time of the qpth solve (forward and backward) with the M samples and
+    with k weighted scenarios, and increase (regret) of the sample average
+    cost of the orders with respect to the full solve
+    """
+    params_t, _ = params.get_params(n_items, 0, dev)
+    y_dist = 5 + 5*torch.rand((M, batch_size, n_items), dtype=torch.float64)
+
+    def cost(op, z):
+        return op.cost_per_item(
+            z.unsqueeze(1), y_dist.permute((1, 0, 2))).sum(-1).mean()
+
+    rows = []
+    op_full = cnu.SolveConstrainedNewsvendor(params_t, M, dev)
+    t_full, z_full, _ = time_solver(
+        lambda y: op_full.forward(op_full.reshape_outcomes(y)),
+        y_dist, n_repeats)
+    cost_full = cost(op_full, z_full)
+    for k in k_values:
+        op = cnu.SolveConstrainedNewsvendor(
+            params_t, k, dev, scenario_reduction=True)
+        t, z, _ = time_solver(
+            lambda y: op.forward(*op.reshape_outcomes(y, True)),
+            y_dist, n_repeats)
+        rows.append({
+            'problem': 'newsvendor', 'M': M, 'k': k,
+            'full_s': t_full, 'reduced_s': t, 'speedup': t_full/t,
+            'cost_full': cost_full.item(), 
+            'regret': (cost(op, z) - cost_full).item(),
+            'rel_regret': ((cost(op, z) - cost_full)/cost_full).item()})
+    return rows
+
+
+if __name__ == '__main__':
+
+    dev = torch.device('cpu')
+    torch.manual_seed(0)
+
+    n_repeats = 3
+    if len(sys.argv) > 1:
+        n_repeats = int(sys.argv[1])
+
+    rows = benchmark_newsvendor(4, 64, [4, 8, 16], 16, n_repeats, dev)
+    print(pd.DataFrame(rows).to_string(index=False))
@@ -0,0 +1,146 @@
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+
+import constrained_newsvendor_utils as cnu
+import minmax_op_utils as op_utils
+import params_newsvendor as params
+
+
+def time_solver(solve, y, n_repeats):
+    """
+    Mean time of forward and backward through solve(y), after a warm-up run
+    """
+    def run():
+        y_grad = y.clone().requires_grad_()
+        out = solve(y_grad)
+        out.sum().backward()
+        return out.detach(), y_grad.grad
+
+    out, grad = run()
+    t0 = time.time()
+    for _ in range(0, n_repeats):
+        run()
+    return (time.time() - t0)/n_repeats, out, grad
+
+
+def benchmark_newsvendor(n_items, n_samples, batch_size, n_repeats, dev):
+    params_t, _ = params.get_params(n_items, 0, dev)
+    y = 5 + 5*torch.rand((batch_size, n_items*n_samples), dtype=torch.float64)
+
+    results = {}
+    for solver in ['qpth', 'cached']:
+        op = cnu.SolveConstrainedNewsvendor(
+            params_t, n_samples, dev, solver=solver)
+        results[solver] = time_solver(op.forward, y, n_repeats)
+    return results
+
+
+def benchmark_portfolio(n_assets, n_samples, batch_size, n_repeats, dev):
+    Y_train = torch.rand((1000, n_assets), dtype=torch.float64)
+    Y_dist = 0.5 + torch.randn(
+        (batch_size, n_samples, n_assets), dtype=torch.float64)
+
+    results = {}
+    for solver in ['qpth', 'cached']:
+        op = op_utils.RiskPortOP(
+            n_samples, n_assets, 1.0, Y_train, dev, solver=solver)
+        results[solver] = time_solver(
+            lambda Y: op.forward(Y)[1], Y_dist, n_repeats)
+    return results
+
+
+def benchmark_portfolio_lp(n_assets, n_samples, n_rows, eval_tol=1e-3):
+    """
+    Mean time per row of the LPs of the portfolio evaluation with 
+    min_true_sample (linprog), PortfolioLP if highspy is installed, and 
+    the batched PDHG of RiskPortOP(..., eval_tol) (uncertified rows 
+    solved exactly included), with the costs of their solutions
+    """
+    rng = np.random.RandomState(0)
+    uy = 0.5 + rng.rand(n_assets)
+    Y_dist = 0.1 + 0.5*rng.randn(n_rows, n_samples, n_assets)
+
+    backends = {'linprog': lambda y: op_utils.min_true_sample(y, uy, 0.8)}
+    if op_utils.highspy is not None:
+        backends['model'] = op_utils.PortfolioLP(uy, 0.8, n_samples).solve
+
+    results = {}
+    for name, solve in backends.items():
+        t0 = time.time()
+        costs = [solve(y)[0].mean() for y in Y_dist]
+        results[name] = ((time.time() - t0)/n_rows, np.array(costs))
+
+    op = op_utils.RiskPortOP(
+        n_samples, n_assets, 0.8, torch.tensor(uy).unsqueeze(0), 
+        torch.device('cpu'), eval_tol=eval_tol)
+    t0 = time.time()
+    argmins = op.true_argmins(Y_dist)
+    results['pdhg'] = ((time.time() - t0)/n_rows, 
+                       argmins[:, :n_samples].mean(-1))
+    return results
+
+
+if __name__ == '__main__':
+
+    dev = torch.device('cpu')
+    torch.manual_seed(0)
+
+    n_repeats = 3
+    if len(sys.argv) > 1:
+        n_repeats = int(sys.argv[1])
+
+    # (problem, size of the decision, M, batch size) of the experiments
+    configs = [
+        ('newsvendor', 8, 4, 32),
+        ('newsvendor', 8, 16, 32),
+        ('portfolio', 10, 16, 128),
+        ('portfolio', 10, 64, 128),
+    ]
+
+    rows = []
+    for problem, n, M, batch_size in configs:
+        if problem == 'newsvendor':
+            results = benchmark_newsvendor(n, M, batch_size, n_repeats, dev)
+        else:
+            results = benchmark_portfolio(n, M, batch_size, n_repeats, dev)
+
+        t_qpth, z_qpth, grad_qpth = results['qpth']
+        t_cached, z_cached, grad_cached = results['cached']
+        rows.append({
+            'problem': problem, 'n': n, 'M': M, 'batch': batch_size,
+            'qpth_s': t_qpth, 'cached_s': t_cached,
+            'speedup': t_qpth/t_cached,
+            'max_diff_z': (z_qpth - z_cached).abs().max().item(),
+            'max_diff_grad': (grad_qpth - grad_cached).abs().max().item(),
+        })
+        print(rows[-1])
+
+    print(pd.DataFrame(rows).to_string(index=False))
+
+    # LPs of the portfolio evaluation, per row against M (batches of 128 
+    # rows as in the experiments); pdhg_rel_cost is the largest relative 
+    # excess of its costs over the exact ones
+    lp_configs = [(10, 16), (10, 64), (10, 128), (10, 500), (30, 500)]
+    rows = []
+    for n, M in lp_configs:
+        results = benchmark_portfolio_lp(n, M, 128)
+        t_linprog, cost_linprog = results['linprog']
+        row = {'n': n, 'M': M, 'linprog_ms': 1e3*t_linprog}
+        if 'model' in results:
+            t_model, cost_model = results['model']
+            row.update({
+                'model_ms': 1e3*t_model,
+                'max_diff_cost': np.abs(cost_linprog - cost_model).max()})
+        t_pdhg, cost_pdhg = results['pdhg']
+        row.update({
+            'pdhg_ms': 1e3*t_pdhg,
+            'pdhg_rel_cost': ((cost_pdhg - cost_linprog)
+                              /np.maximum(cost_linprog, 1e-12)).max()})
+        rows.append(row)
+        print(rows[-1])
+
+    print(pd.DataFrame(rows).to_string(index=False))
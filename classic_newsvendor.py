@@ -20,7 +20,12 @@ import joblib
 import os
 
 # Utils
+import artifact_cache
 import data_generator
+import dtype_utils
+import evaluation_utils
+import hparam_search
+import parallel_utils
 from gauss_proc import GP
 from model import VariationalLayer, VariationalNet, StandardNet
 from train import TrainDecoupled, TrainCombined
@@ -35,7 +40,10 @@ def run_classic_newsvendor(
             aleat_bool,
             N_SAMPLES,
             M_SAMPLES,
-            dev):
+            dev,
+            COST_EXCESS=(900,),
+            hparams=None,
+            epoch_callback=None):
     
     ##################################################################
     ##### Setting Parameters #########################################
@@ -98,6 +106,10 @@ def run_classic_newsvendor(
         EPOCHS = 350
         explr=0.99
 
+    # Overrides of the hard-coded hyperparameters (see hparam_search.py)
+    lr, explr, EPOCHS, K = hparam_search.apply_overrides(
+        hparams, method_name, lr, explr, EPOCHS, K if bnn else None)
+
     ##################################################################
     ##### Data #######################################################
     ##################################################################
@@ -112,8 +124,8 @@ def run_classic_newsvendor(
     # Output normalization
     scaler = StandardScaler()
     scaler.fit(y_original)
-    tmean = torch.tensor(scaler.mean_.item())
-    tstd = torch.tensor(scaler.scale_.item())
+    tmean = torch.tensor(scaler.mean_.item(), dtype=dtype_utils.get_dtype())
+    tstd = torch.tensor(scaler.scale_.item(), dtype=dtype_utils.get_dtype())
     joblib.dump(scaler, 'scaler.gz') # if you need to analyse
 
     # Function to denormalize the data
@@ -121,12 +133,12 @@ def run_classic_newsvendor(
         return yy*tstd + tmean
 
     y = scaler.transform(y_original).copy()
-    X = torch.tensor(X, dtype=torch.float32)
-    y = torch.tensor(y, dtype=torch.float32)
+    X = torch.tensor(X, dtype=dtype_utils.get_dtype())
+    y = torch.tensor(y, dtype=dtype_utils.get_dtype())
     data_train = data_generator.ArtificialDataset(X, y)
     training_loader = torch.utils.data.DataLoader(
         data_train, batch_size=BATCH_SIZE_LOADER,
-        shuffle=False, num_workers=mp.cpu_count())
+        shuffle=False, num_workers=parallel_utils.get_loader_workers())
 
     X_val, y_val_original, _ = data_generator.data_1to1(
         N_valid, noise_level=nl, 
@@ -134,22 +146,22 @@ def run_classic_newsvendor(
         noise_type = noise_type, 
         uniform_input_space=False)
     y_val = scaler.transform(y_val_original).copy()
-    X_val = torch.tensor(X_val, dtype=torch.float32)
-    y_val_original = torch.tensor(y_val_original, dtype=torch.float32)
-    y_val = torch.tensor(y_val, dtype=torch.float32)
+    X_val = torch.tensor(X_val, dtype=dtype_utils.get_dtype())
+    y_val_original = torch.tensor(y_val_original, dtype=dtype_utils.get_dtype())
+    y_val = torch.tensor(y_val, dtype=dtype_utils.get_dtype())
 
     data_valid = data_generator.ArtificialDataset(X_val, y_val)
     validation_loader = torch.utils.data.DataLoader(
         data_valid, batch_size=BATCH_SIZE_LOADER,
-        shuffle=False, num_workers=mp.cpu_count())
+        shuffle=False, num_workers=parallel_utils.get_loader_workers())
 
     X_test, y_test_original, y_true_noisy = data_generator.data_1to1(
         N_test, noise_level=nl, 
         seed_number=seed_number+200, 
         noise_type = noise_type, 
         uniform_input_space=False, add_yfair=True)
-    X_test = torch.tensor(X_test, dtype=torch.float32)
-    y_test_original = torch.tensor(y_test_original, dtype=torch.float32)
+    X_test = torch.tensor(X_test, dtype=dtype_utils.get_dtype())
+    y_test_original = torch.tensor(y_test_original, dtype=dtype_utils.get_dtype())
     
  
     input_size = X.shape[1]
@@ -165,7 +177,17 @@ def run_classic_newsvendor(
         gp = GP(length_scale=1, length_scale_bounds=(1e-2, 1e4), 
                     alpha_noise=0.1, white_noise=1, 
                     n_restarts_optimizer=12)
-        gp.gp_fit(X.detach().numpy(), y.detach().numpy())
+        
+        def fit_gp():
+            gp.gp_fit(X.detach().numpy(), y.detach().numpy())
+            return gp
+        
+        gp, _ = artifact_cache.cached_train(
+            fit_gp,
+            script='classic_newsvendor', method_name=method_name,
+            model_class=type(gp).__name__, seed_number=seed_number,
+            noise_type=noise_type, nl=nl, N_train=N_train,
+            gp_params=(gp.ls, gp.lsbs, gp.alp, gp.wn, gp.nro))
         model_used = gp
     
     else:
@@ -218,47 +240,101 @@ def run_classic_newsvendor(
             quit()
 
         # save the used model in a variable for the OP part
-        model_used = train_NN.train(EPOCHS=EPOCHS)
+        # (loaded from the cache if this configuration was trained before)
+        model_used, _ = artifact_cache.cached_train(
+            lambda: train_NN.train(EPOCHS=EPOCHS, callback=epoch_callback),
+            script='classic_newsvendor', method_name=method_name,
+            method_learning=method_learning, model_class=type(h).__name__,
+            seed_number=seed_number, noise_type=noise_type, nl=nl,
+            N_train=N_train, N_valid=N_valid, 
+            batch_size=BATCH_SIZE_LOADER, aleat_bool=aleat_bool, 
+            N_SAMPLES=N_SAMPLES, lr=lr, K=K, PLV=PLV if bnn else None, 
+            explr=explr, EPOCHS=EPOCHS,
+            quantile=(cost_shortage/(cost_shortage+cost_excess) 
+                      if method_learning == 'combined' else None),
+            dev=dev)
 
         
     ##################################################################
     ##### Solving the Optimization Problem ###########################
     ##################################################################
         
-    mser = []
-    regr = []
-    fregr = []
-    for M in M_SAMPLES:
-
-        # Updating the number of samples M_opt
+    # All the cost ratios cs/(cs+ce) are evaluated from the same samples
+    cn2 = ClassicalNewsvendor(cost_shortage, COST_EXCESS)
+    mse_loss = nn.MSELoss()
+    
+    # Best and fair costs of the test set, the same for every method and 
+    # M of this dataset (stored in the cache, see artifact_cache)
+    oracle = artifact_cache.cached_oracle(
+        lambda: tuple(c.tolist() for c in cn2.oracle_costs(
+            y_test_original, y_true_noisy.squeeze())), 
+        script='classic_newsvendor', seed_number=seed_number+200, 
+        noise_type=noise_type, nl=nl, cost_shortage=cost_shortage, 
+        cost_excess=COST_EXCESS, 
+        data=artifact_cache.data_hash(y_test_original, y_true_noisy))
+    
+    # max(M_SAMPLES) samples are drawn once and each M uses the first M
+    def sample_fn(batch, M):
         model_used.update_n_samples(n_samples=M)
-        y_pred = model_used.forward_dist(X_test, aleat_bool)[:,:,0]
-        y_pred = inverse_transform(y_pred)
-
-        mse_loss = nn.MSELoss()
+        y_pred = model_used.forward_dist(batch[0], aleat_bool)[:,:,0]
+        return inverse_transform(y_pred)
+    
+    def metrics_fn(M, y_pred, batch):
+        _, y_true, y_noisy = batch
         mse_loss_result = mse_loss(
             y_pred.mean(axis=0).squeeze(), 
-            y_test_original.squeeze()
-        ).item()
-
-        cost_excess = 900 #only for q=0.1
-        cn2 = ClassicalNewsvendor(cost_shortage, cost_excess)
+            y_true.squeeze()
+        )
         regret, fair_regret = cn2.compute_norm_regret_from_preds(
-                                y_test_original, y_pred, y_true_noisy.squeeze())
-        regret = round(regret.item(), 5)
-        fair_regret = round(fair_regret.item(), 5)  
+                                y_true, y_pred, y_noisy, oracle)
+        return {'MSE': mse_loss_result, 'REGRET': regret, 
+                'FAIR_REGRET': fair_regret}
+    
+    # The predictive distribution of StandardNet is Gaussian (a point mass 
+    # without aleatoric uncertainty): the orders are its quantiles, computed 
+    # without samples, and are the same for every M
+    if hasattr(model_used, 'forward_gaussian'):
+        with torch.no_grad():
+            y_mean, y_std = model_used.forward_gaussian(X_test, aleat_bool)
+        y_mean = inverse_transform(y_mean[:,0])
+        y_std = y_std[:,0]*tstd
+        z_pred = cn2.get_argmins_from_gaussian(y_mean, y_std)
+        regret, fair_regret = cn2.compute_norm_regret_from_orders(
+            y_test_original, z_pred, y_true_noisy.squeeze(), oracle)
+        metrics = {
+            'MSE': mse_loss(y_mean, y_test_original.squeeze()).item(), 
+            'REGRET': regret.cpu().numpy(), 
+            'FAIR_REGRET': fair_regret.cpu().numpy()}
+        df_eval = pd.DataFrame([dict(metrics, M=M) for M in M_SAMPLES])
+    else:
+        df_eval = evaluation_utils.evaluate_prefixes(
+            [(X_test, y_test_original, y_true_noisy.squeeze())], 
+            sample_fn, M_SAMPLES, metrics_fn)
+    
+    mser = []
+    regr = []
+    fregr = []
+    for _, row in df_eval.iterrows():
+        mse_loss_result = row['MSE']
+        regret = np.round(row['REGRET'], 5)
+        fair_regret = np.round(row['FAIR_REGRET'], 5)  
 
         print('Results for seed = ', seed_number)
-        print('Results for M = ', M)
+        print('Results for M = ', int(row['M']))
         print('MSE loss: ', round(mse_loss_result, 5))
-        print('REGRET: ', round(regret, 5))
-        print('FAIR REGRET: ', round(fair_regret, 5))
+        for q, r, fr in zip(cn2.quantile_cuts(), regret, fair_regret):
+            print(f'REGRET {q:g}: ', r)
+            print(f'FAIR REGRET {q:g}: ', fr)
         
         mser.append(mse_loss_result)
         regr.append(regret)
         fregr.append(fair_regret)
 
-    return model_used, model_name, regr, fregr, mser
+    # Regrets of each cost ratio (rows) and M (columns)
+    regr = torch.tensor(np.array(regr).reshape(-1, len(COST_EXCESS))).T
+    fregr = torch.tensor(np.array(fregr).reshape(-1, len(COST_EXCESS))).T
+
+    return model_used, model_name, regr, fregr, mser, scaler
     
 
 if __name__ == '__main__':
@@ -277,32 +353,41 @@ if __name__ == '__main__':
     #aleat_bool = bool(int(sys.argv[5])) # ToDo: implement ANN with 1
     N_SAMPLES = int(sys.argv[5])  # Sampling size while training (M_train)
     M_SAMPLES = [2, 4, 8, 16, 32, 64, 512, 4096] # while optimizing (M_opt)
+    # Costs of excess evaluated with cost_shortage=100, quantile 0.1 for 900 
+    # (add values to evaluate more ratios from the same predictions)
+    COST_EXCESS = [900]
     
     # Aleatoric Uncertainty Modeling
     aleat_bool=True
     if method_name == 'ann':
         aleat_bool=False
     
+    # Seeds run in parallel processes if PAO_N_JOBS > 1
+    runs = parallel_utils.run_parallel(
+        run_classic_newsvendor,
+        [dict(method_name=method_name, 
+              method_learning=method_learning,
+              noise_type=noise_type,
+              seed_number=seed_number,
+              aleat_bool=aleat_bool,
+              N_SAMPLES=N_SAMPLES,
+              M_SAMPLES=M_SAMPLES,
+              dev=dev,
+              COST_EXCESS=COST_EXCESS) for seed_number in range(0, nr_seeds)])
+    
+    # Columns of the ratios after the first one are suffixed with the ratio
+    quantiles = [100/(100 + ce) for ce in COST_EXCESS]
+    suffixes = [''] + [f'_q{q:g}' for q in quantiles[1:]]
+    
     df_total = pd.DataFrame()
     for seed_number in range(0, nr_seeds):
-        model_used, model_name, regr, fregr, mser \
-        = run_classic_newsvendor(
-            method_name, 
-            method_learning,
-            noise_type,
-            seed_number,
-            aleat_bool,
-            N_SAMPLES,
-            M_SAMPLES,
-            dev
-        )
+        model_used, model_name, regr, fregr, mser, scaler = runs[seed_number]
         
-        df_results = pd.DataFrame(
-            data = {f'MSE_{seed_number}':mser,
-                    f'REGRET_{seed_number}':regr,
-                    f'FR{seed_number}':fregr
-                   }
-        )
+        data = {f'MSE_{seed_number}':mser}
+        for i, suffix in enumerate(suffixes):
+            data[f'REGRET_{seed_number}{suffix}'] = regr[i].tolist()
+            data[f'FR{seed_number}{suffix}'] = fregr[i].tolist()
+        df_results = pd.DataFrame(data = data)
         
         df_total = pd.concat([df_total, df_results], axis=1)
         
@@ -315,10 +400,11 @@ if __name__ == '__main__':
             os.makedirs("./models")        
         torch.save(model_used, 
                    f'./models/{model_name}_{seed_number}.pkl') 
+        # Each model keeps the output scaler of its own run
+        joblib.dump(scaler, 
+                    f'./models/{model_name}_{seed_number}.pkl.scaler.gz')
          
     cols_mse = [c for c in df_total.columns.tolist() if 'MSE' in c]
-    cols_nr = [c for c in df_total.columns.tolist() if 'REGRET' in c]
-    cols_fnr = [c for c in df_total.columns.tolist() if 'FR' in c]
     
     print('---------------------------------------------------')
     print('-----------------Results---------------------------')
@@ -327,13 +413,21 @@ if __name__ == '__main__':
     mse_std = df_total[cols_mse].std(axis=1)
     print('MSE: ', round(mse_mean, 5), '(', round(mse_std, 5), ')')
     
-    nr01_mean = df_total[cols_nr].mean(axis=1)
-    nr01_std = df_total[cols_nr].std(axis=1)
-    print('REGRET 0.1: ', round(nr01_mean, 5), '(', round(nr01_std, 5), ')')
-    
-    fnr01_mean = df_total[cols_fnr].mean(axis=1)
-    fnr01_std = df_total[cols_fnr].std(axis=1)
-    print('FR 0.1: ', round(fnr01_mean, 5), '(', round(fnr01_std, 5), ')')
+    for q, suffix in zip(quantiles, suffixes):
+        cols_nr = [f'REGRET_{seed_number}{suffix}' 
+                   for seed_number in range(0, nr_seeds)]
+        cols_fnr = [f'FR{seed_number}{suffix}' 
+                    for seed_number in range(0, nr_seeds)]
+        
+        nr_mean = df_total[cols_nr].mean(axis=1)
+        nr_std = df_total[cols_nr].std(axis=1)
+        print(f'REGRET {q:g}: ', round(nr_mean, 5), 
+              '(', round(nr_std, 5), ')')
+        
+        fnr_mean = df_total[cols_fnr].mean(axis=1)
+        fnr_std = df_total[cols_fnr].std(axis=1)
+        print(f'FR {q:g}: ', round(fnr_mean, 5), 
+              '(', round(fnr_std, 5), ')')
     
     if not os.path.isdir("./newsvendor_results"):   
         os.makedirs("./newsvendor_results")  
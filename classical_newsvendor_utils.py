@@ -1,22 +1,54 @@
 import torch
 
+import quantile_utils
+
 # Class to the Classical Newsvendor Optimization Problem
 class ClassicalNewsvendor():
     """
     Classical Newsvendor Optimization Problem class.
     Init with c_s and c_e deterministic parameters.
+    c_s and c_e can also be sequences (or one of them a scalar) of the 
+    pairs of costs of a sweep of critical ratios: orders, costs and regrets 
+    then have a first dimension of ratios, and the orders of all the 
+    ratios are computed from one sort of the samples.
     """
     
     def __init__(self, cost_shortage, cost_excess):
+        self.n_ratios = None
+        if not (quantile_utils.is_scalar(cost_shortage) 
+                and quantile_utils.is_scalar(cost_excess)):
+            cost_shortage, cost_excess = torch.broadcast_tensors(
+                torch.tensor(quantile_utils.as_list(cost_shortage), 
+                             dtype=torch.float64), 
+                torch.tensor(quantile_utils.as_list(cost_excess), 
+                             dtype=torch.float64))
+            self.n_ratios = len(cost_shortage)
         self.cs = cost_shortage
         self.ce = cost_excess
+
+    def quantile_cuts(self):
+        """
+        Critical ratio cs/(cs + ce), a list if there are several ratios
+        """
+        quantile_cut = self.cs/(self.cs + self.ce)
+        if self.n_ratios is not None:
+            return quantile_cut.tolist()
+        return quantile_cut
+
+    def per_ratio(self, cost, demand):
+        """
+        Cost parameter broadcastable to the orders of demand (ratios first)
+        """
+        if self.n_ratios is None:
+            return cost
+        return cost.to(demand).view(-1, *[1]*demand.dim())
       
     def get_argmins_from_dist(self, dist):
         """
         Give samples of y: dist, compute z*(dist)
         """
-        quantile_cut = self.cs/(self.cs + self.ce)
-        argmin_from_dist = torch.quantile(
+        quantile_cut = self.quantile_cuts()
+        argmin_from_dist = quantile_utils.quantile(
                             dist, 
                             quantile_cut, 
                             dim=0)
@@ -25,6 +57,32 @@ class ClassicalNewsvendor():
             torch.zeros_like(argmin_from_dist))
         return argmin_from_dist
 
+    def get_argmins_from_stream(self, chunks, n_samples):
+        """
+        Same as get_argmins_from_dist for n_samples samples of y given in 
+        chunks (samples in the first dimension), without keeping them all
+        """
+        quantile_cut = self.quantile_cuts()
+        argmin_from_dist = quantile_utils.streaming_quantile(
+            chunks, n_samples, quantile_cut)
+        return torch.maximum(
+            argmin_from_dist, torch.zeros_like(argmin_from_dist))
+
+    def get_argmins_from_gaussian(self, mean, std):
+        """
+        z* of a Gaussian distribution of y: its quantile at the critical 
+        ratio, mean + std*inverse normal cdf(cs/(cs + ce)), without samples
+        """
+        quantile_cut = torch.as_tensor(
+            self.quantile_cuts(), dtype=mean.dtype, device=mean.device)
+        if self.n_ratios is not None:
+            quantile_cut = quantile_cut.view(-1, *[1]*mean.dim())
+        # std = 0 (point mass) gives the mean, also for q = 0 or 1
+        argmin_from_dist = mean + torch.where(
+            std > 0, std*torch.special.ndtri(quantile_cut), 0)
+        return torch.maximum(
+            argmin_from_dist, torch.zeros_like(argmin_from_dist))
+
     def get_argmins_from_value(self, demand):
         """
         Give values of y, compute z*(y) ( = y in this case)
@@ -37,32 +95,60 @@ class ClassicalNewsvendor():
         """
         Give values of z and y, compute the cost f(z,y) per row
         """
-        return self.cs*torch.maximum(
+        cs = self.per_ratio(self.cs, demand_true)
+        ce = self.per_ratio(self.ce, demand_true)
+        return cs*torch.maximum(
             demand_true - order, 
-            torch.zeros_like(demand_true)) + self.ce*torch.maximum(
+            torch.zeros_like(demand_true)) + ce*torch.maximum(
             order - demand_true, torch.zeros_like(demand_true))
 
     def cost_sum(self, order, demand_true):
         """
-        Compute mean of f(z, y) through rows
+        Compute mean of f(z, y) through rows (per ratio if several)
         """
-        return self.cost_per_instance(order, demand_true).mean()
+        cost = self.cost_per_instance(order, demand_true)
+        if self.n_ratios is None:
+            return cost.mean()
+        return cost.flatten(1).mean(1)
 
     def compute_norm_regret_from_costs(self, cost_pred, cost_best):
-        regret =  cost_pred - cost_best
+        regret =  cost_pred - torch.as_tensor(
+            cost_best, dtype=cost_pred.dtype, device=cost_pred.device)
         return regret
 
-    def compute_norm_regret_from_preds(self, y_val, Y_pred, Y_noisy):
+    def oracle_costs(self, y_val, Y_noisy):
         """
-        Compute evaluation metrics regret and fair regret
+        Costs of the best (observed demand) and fair (samples of the true 
+        distribution) orders, which do not depend on the predictions
         """
-        z_pred = self.get_argmins_from_dist(Y_pred)
         z_fair = self.get_argmins_from_dist(Y_noisy)
         z_best = self.get_argmins_from_value(y_val[:,0])
 
-        cost_pred = self.cost_sum(z_pred, y_val[:,0])
-        cost_fair = self.cost_sum(z_fair, y_val[:,0])
         cost_best = self.cost_sum(z_best, y_val[:,0])
+        cost_fair = self.cost_sum(z_fair, y_val[:,0])
+        return cost_best, cost_fair
+
+    def compute_norm_regret_from_preds(self, y_val, Y_pred, Y_noisy, 
+                                       oracle=None):
+        """
+        Compute evaluation metrics regret and fair regret. oracle is the 
+        result of oracle_costs(y_val, Y_noisy) if already computed.
+        """
+        z_pred = self.get_argmins_from_dist(Y_pred)
+        return self.compute_norm_regret_from_orders(
+            y_val, z_pred, Y_noisy, oracle)
+
+    def compute_norm_regret_from_orders(self, y_val, z_pred, Y_noisy, 
+                                        oracle=None):
+        """
+        Same as compute_norm_regret_from_preds for orders z_pred already 
+        computed (e.g. by get_argmins_from_gaussian)
+        """
+        if oracle is None:
+            oracle = self.oracle_costs(y_val, Y_noisy)
+        cost_best, cost_fair = oracle
+        
+        cost_pred = self.cost_sum(z_pred, y_val[:,0])
 
         reg = self.compute_norm_regret_from_costs(cost_pred, cost_best)
         freg = self.compute_norm_regret_from_costs(cost_pred, cost_fair)
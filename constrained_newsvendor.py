@@ -1,6 +1,7 @@
 import numpy as np
 import pandas as pd
 import random
+import math
 import joblib
 import sys
 import os
@@ -14,11 +15,18 @@ import torch.nn as nn
 from qpth.qp import QPFunction
 from sklearn.preprocessing import StandardScaler
 
+import artifact_cache
+import autotune
 import data_generator
+import dtype_utils
+import evaluation_utils
+import hparam_search
+import parallel_utils
+import solver_cache
 import params_newsvendor as params
 from gauss_proc import GP
 from model import VariationalLayer, StrongStandardNet, StrongVariationalNet
-from train import TrainDecoupled, TrainCombined
+from train import TrainDecoupled, TrainCombined, tolerance_schedule
 import constrained_newsvendor_utils as cnu
 
     
@@ -29,7 +37,9 @@ def run_constrained_newsvendor(
             aleat_bool,
             N_SAMPLES,
             M_SAMPLES,
-            dev):
+            dev,
+            hparams=None,
+            epoch_callback=None):
 
 
     ##################################################################
@@ -83,8 +93,13 @@ def run_constrained_newsvendor(
     if method_learning == 'combined' and method_name == 'bnn':
         K = 1000 # to be same magnitude as the end loss 
         lr = 0.00008
+    explr = 0.99
+    
+    # Overrides of the hard-coded hyperparameters (see hparam_search.py)
+    lr, explr, EPOCHS, K = hparam_search.apply_overrides(
+        hparams, method_name, lr, explr, EPOCHS, K if bnn else None)
 
-    cpu_count = mp.cpu_count()
+    cpu_count = parallel_utils.get_loader_workers()
     if dev == torch.device('cuda'):
         print('Cuda found')
         cpu_count = 1
@@ -101,8 +116,8 @@ def run_constrained_newsvendor(
     # Output normalization
     scaler = StandardScaler()
     scaler.fit(Y_original)
-    tmean = torch.tensor(scaler.mean_).to(dev)
-    tstd = torch.tensor(scaler.scale_).to(dev)
+    tmean = dtype_utils.to_tensor(scaler.mean_, dev)
+    tstd = dtype_utils.to_tensor(scaler.scale_, dev)
     joblib.dump(scaler, 'scaler_constrained.gz')
 
     # Function to denormalize the data
@@ -110,9 +125,9 @@ def run_constrained_newsvendor(
         return yy*tstd + tmean
 
     Y = scaler.transform(Y_original).copy()
-    X = torch.tensor(X, dtype=torch.float32)
-    Y = torch.tensor(Y, dtype=torch.float32)
-    data_train = data_generator.ArtificialDataset(X, Y)
+    X = torch.tensor(X, dtype=dtype_utils.get_dtype())
+    Y = torch.tensor(Y, dtype=dtype_utils.get_dtype())
+    data_train = data_generator.ArtificialDataset(X, Y, return_idx=True)
     training_loader = torch.utils.data.DataLoader(
         data_train, batch_size=BATCH_SIZE_LOADER,
         shuffle=True, num_workers=cpu_count)
@@ -122,9 +137,9 @@ def run_constrained_newsvendor(
         N_valid, noise_level=nl, 
         seed_number=seed_number+100)
     Y_val = scaler.transform(Y_val_original).copy()
-    X_val = torch.tensor(X_val, dtype=torch.float32)
-    Y_val_original = torch.tensor(Y_val_original, dtype=torch.float32)
-    Y_val = torch.tensor(Y_val, dtype=torch.float32)
+    X_val = torch.tensor(X_val, dtype=dtype_utils.get_dtype())
+    Y_val_original = torch.tensor(Y_val_original, dtype=dtype_utils.get_dtype())
+    Y_val = torch.tensor(Y_val, dtype=dtype_utils.get_dtype())
     data_valid = data_generator.ArtificialDataset(X_val, Y_val)
     validation_loader = torch.utils.data.DataLoader(
         data_valid, batch_size=BATCH_SIZE_LOADER,
@@ -134,10 +149,13 @@ def run_constrained_newsvendor(
     X_test, Y_test_original, Y_noisy = data_generator.generate_dataset(
         N_valid, noise_level=nl, 
         seed_number=seed_number+200, add_yfair=True)
-    X_test = torch.tensor(X_test, dtype=torch.float32)
+    X_test = torch.tensor(X_test, dtype=dtype_utils.get_dtype())
     Y_test_original = torch.tensor(
-        Y_test_original, dtype=torch.float32)
-    Y_noisy = torch.tensor(Y_noisy, dtype=torch.float32)
+        Y_test_original, dtype=dtype_utils.get_dtype())
+    Y_noisy = torch.tensor(Y_noisy, dtype=dtype_utils.get_dtype())
+    # The test batches are fixed (the metrics are means over the batches 
+    # and the GP samples are drawn per batch), the batch size tuned below 
+    # only sets how many rows are solved at once
     data_test = data_generator.ArtificialDataset(
         X_test, Y_test_original)
     test_loader = torch.utils.data.DataLoader(
@@ -155,14 +173,33 @@ def run_constrained_newsvendor(
 
     #OP deterministic params
     params_t, _ = params.get_params(n_items, seed_number, dev)
+    
+    # Solver precision (see dtype_utils), float32 only if it is accurate 
+    # on scenarios of the training data
+    Y_check = torch.tensor(
+        dtype_utils.check_rows(Y_original, N_SAMPLES)).reshape(
+        N_SAMPLES, -1, n_items).to(dev)
+    solver_dtype = dtype_utils.validated_solver_dtype(
+        lambda dtype: cnu.SolveConstrainedNewsvendor(
+            params_t, N_SAMPLES, dev, dtype=dtype), 
+        Y_check, solve=lambda op, y: op.forward(op.reshape_outcomes(y)))
+    # Backend and tolerance schedule of the training solves (see 
+    # solver_cache), qpth with a fixed tolerance by default
+    training_solver = solver_cache.get_training_solver()
+    tol_schedule = tolerance_schedule() \
+        if solver_cache.use_tol_schedule() else None
 
     if method_learning == 'combined':
         # Construct the deterministic solver z*(y_mean or y_actual)
-        op_solver = cnu.SolveConstrainedNewsvendor(
-            params_t, 1, dev)
+        op_solver = solver_cache.get_solver(
+            cnu.SolveConstrainedNewsvendor, 
+            params_t, 1, dev, solver=training_solver, 
+            dtype=solver_dtype).train()
         # Construct the stochastic solver z*(y_samples)
-        op_solver_dist = cnu.SolveConstrainedNewsvendor(
-            params_t, N_SAMPLES, dev)
+        op_solver_dist = solver_cache.get_solver(
+            cnu.SolveConstrainedNewsvendor, 
+            params_t, N_SAMPLES, dev, solver=training_solver, 
+            dtype=solver_dtype).train()
 
         # ANN baseline uses only z*(y_mean or y_actual)
         if not aleat_bool and method_name=='ann':
@@ -181,7 +218,17 @@ def run_constrained_newsvendor(
             gp = GP(length_scale=1, length_scale_bounds=(1e-2, 1e4), 
                     alpha_noise=0.01, white_noise=1, 
                     n_restarts_optimizer=12)
-            gp.gp_fit(X.detach().numpy(), Y[:,k].detach().numpy())
+            
+            def fit_gp():
+                gp.gp_fit(X.detach().numpy(), Y[:,k].detach().numpy())
+                return gp
+            
+            gp, _ = artifact_cache.cached_train(
+                fit_gp,
+                script='constrained_newsvendor', method_name=method_name,
+                model_class=type(gp).__name__, seed_number=seed_number, 
+                output=k, nl=nl, N_train=N_train, n_items=n_items,
+                gp_params=(gp.ls, gp.lsbs, gp.alp, gp.wn, gp.nro))
             model_gps.append(gp)
             model_used = gp
         
@@ -210,7 +257,8 @@ def run_constrained_newsvendor(
                             aleat_bool=aleat_bool,
                             training_loader=training_loader,
                             validation_loader=validation_loader,
-                            dev=dev
+                            dev=dev,
+                            explr=explr
                         )
 
         # Combined learning approach (end-to-end loss)
@@ -225,7 +273,9 @@ def run_constrained_newsvendor(
                             scaler=scaler,
                             validation_loader=validation_loader,
                             OP=op_solver_dist,
-                            dev=dev
+                            dev=dev,
+                            explr=explr,
+                            tol_schedule=tol_schedule
                         )
 
         else:
@@ -233,14 +283,29 @@ def run_constrained_newsvendor(
             quit()
 
         # save the used model in a variable for the OP part
-        model_used = train_NN.train(EPOCHS=EPOCHS)
+        # (loaded from the cache if this configuration was trained before)
+        model_used, pretrain_key = artifact_cache.cached_train(
+            lambda: train_NN.train(EPOCHS=EPOCHS, callback=epoch_callback),
+            script='constrained_newsvendor', method_name=method_name,
+            method_learning=method_learning, model_class=type(h).__name__,
+            seed_number=seed_number, nl=nl, N_train=N_train, 
+            N_valid=N_valid, n_items=n_items, batch_size=BATCH_SIZE_LOADER, 
+            aleat_bool=aleat_bool, N_SAMPLES=N_SAMPLES, lr=lr, K=K, 
+            PLV=PLV if bnn else None, explr=explr, EPOCHS=EPOCHS, dev=dev,
+            solver=training_solver if method_learning == 'combined' else None,
+            tol_schedule=tol_schedule is not None 
+            and method_learning == 'combined')
         
         
-        op_solver = cnu.SolveConstrainedNewsvendor(
-            params_t, 1, dev)
+        op_solver = solver_cache.get_solver(
+            cnu.SolveConstrainedNewsvendor, 
+            params_t, 1, dev, solver=training_solver, 
+            dtype=solver_dtype).train()
         # Construct the stochastic solver z*(y_samples)
-        op_solver_dist = cnu.SolveConstrainedNewsvendor(
-            params_t, N_SAMPLES, dev)
+        op_solver_dist = solver_cache.get_solver(
+            cnu.SolveConstrainedNewsvendor, 
+            params_t, N_SAMPLES, dev, solver=training_solver, 
+            dtype=solver_dtype).train()
         opt_h = torch.optim.Adam(h.parameters(), lr=0.00002)
         train_NN = TrainCombined(
                             bnn = bnn,
@@ -252,140 +317,196 @@ def run_constrained_newsvendor(
                             scaler=scaler,
                             validation_loader=validation_loader,
                             OP=op_solver_dist,
-                            dev=dev
+                            dev=dev,
+                            tol_schedule=tol_schedule
                         )
         
-        model_used = train_NN.train(EPOCHS=EPOCHS)
+        # Combined fine-tuning warm-started from the cached model above
+        model_used, _ = artifact_cache.cached_train(
+            lambda: train_NN.train(EPOCHS=EPOCHS),
+            script='constrained_newsvendor', stage='finetune',
+            warm_start=pretrain_key, lr=0.00002, EPOCHS=EPOCHS, 
+            solver=op_solver_dist.solver, solver_dtype=str(solver_dtype),
+            tol_schedule=tol_schedule is not None)
 
 
     ##################################################################
     ##### Solving the Optimization Problem ###########################
     ##################################################################
     
-    reg_result = []
-    freg_result = []
-    mse_result = []
-        
-    for M in M_SAMPLES:
-        
-        # Updating the number of samples M_opt
-        if not aleat_bool:
-            M = 1
-        if method_name == 'gp':
-            for model in model_gps:
-                model.update_n_samples(n_samples=M)
-        else:
-            model_used.update_n_samples(n_samples=M)
-     
-        mse_loss = nn.MSELoss()
-        
-        dev_opt = dev
-        if M>40:
-            dev_opt = torch.device('cpu') 
+    # The ANN without aleatoric uncertainty predicts a single sample
+    M_eval = M_SAMPLES if aleat_bool else [1]
+    
+    # max(M) samples are drawn once per batch and each M uses the first M
+    def sample_batch(batch, M):
+        x_test_batch, y_test_batch, _ = batch
         
+        # Output predictions
         if method_name in ['ann','bnn']:
-            model_used = model_used.to(dev_opt)
+            model_used.update_n_samples(n_samples=M)
+            y_preds = model_used.forward_dist(
+                x_test_batch, aleat_bool)
             
-        # Construct the solver again for the optimization part
-        op_solver = cnu.SolveConstrainedNewsvendor(
-            params_t, 1, dev_opt)
-        op_solver_dist = cnu.SolveConstrainedNewsvendor(
-            params_t, M, dev_opt)
-        op_solver_dist_noisy = cnu.SolveConstrainedNewsvendor(
-            params_t, 32, dev_opt)
-        if not aleat_bool and method_name=='ann':
-            op_solver_dist = op_solver
-            model_used.update_n_samples(n_samples=1)
-        
-        f_total = 0
-        f_total_noisy = 0
-        f_total_best = 0
-        mse_loss_result = 0
-        n_batches = len(test_loader)
-
-        for i, (tdata, tndata) in tqdm(
-            enumerate(zip(test_loader, test_noisy_loader))):
+        elif method_name in ['gp']:
+            y_preds = torch.zeros_like(
+                y_test_batch).unsqueeze(0).expand(
+                M, y_test_batch.shape[0], 
+                y_test_batch.shape[1]).clone()
+            for k in range(0, len(model_gps)):
+                model_gps[k].update_n_samples(n_samples=M)
+                y_preds[:,:,k] = model_gps[k].forward_dist(
+                    x_test_batch, aleat_bool).squeeze()
             
+        else:
+            raise ValueError('Model not found')
+        
+        # Denormalize predictions
+        if method_name in ['bnn','gp']:
+            y_preds = y_preds.squeeze()
+        y_preds = inverse_transform(y_preds.to(dev))
+        return y_preds.reshape(M, -1, n_items)
+    
+    # Device and number of rows per solve of the decision step, measured 
+    # on predictions of the model for the first test rows and the largest M 
+    # (see autotune.py). The samples of the probe do not change the random 
+    # state of the evaluation.
+    M_probe = max(M_eval, default=1)
+    probe_samples = {}
+    def probe(dev_probe, batch_size):
+        if 'y' not in probe_samples:
+            n_rows = min(max(autotune.BATCH_SIZES), len(data_test))
+            with torch.random.fork_rng(), torch.no_grad():
+                probe_samples['y'] = sample_batch(
+                    (X_test[:n_rows].to(dev), 
+                     Y_test_original[:n_rows].to(dev), None), M_probe)
+        op = solver_cache.get_solver(
+            cnu.SolveConstrainedNewsvendor, 
+            params_t, M_probe, dev_probe, dtype=solver_dtype).eval()
+        y = Y_test_original[:batch_size].to(dev_probe)
+        op.end_loss_dist(
+            probe_samples['y'][:, :batch_size].to(dev_probe), y)
+    
+    plan = autotune.tune(
+        'constrained_newsvendor', probe, max_batch_size=len(data_test), 
+        n_items=n_items, M=M_probe, dtype=str(solver_dtype), 
+        method_name=method_name)
+    dev_opt = torch.device(plan['device'])
+    
+    if method_name in ['ann','bnn']:
+        model_used = model_used.to(dev_opt)
+        
+    # Construct the solvers for the optimization part, with exact 
+    # solves without autograd for the evaluation
+    op_solver = solver_cache.get_solver(
+        cnu.SolveConstrainedNewsvendor, 
+        params_t, 1, dev_opt, dtype=solver_dtype).eval()
+    op_solver_dist_noisy = solver_cache.get_solver(
+        cnu.SolveConstrainedNewsvendor, 
+        params_t, 32, dev_opt, dtype=solver_dtype).eval()
+    op_solvers_dist = {M: solver_cache.get_solver(
+        cnu.SolveConstrainedNewsvendor, 
+        params_t, M, dev_opt, dtype=solver_dtype).eval() for M in M_eval}
+    
+    def test_batches():
+        for tdata, tndata in zip(test_loader, test_noisy_loader):
             x_test_batch, y_test_batch = tdata
             _, y_test_noisy_batch = tndata
             y_test_noisy_batch = torch.permute(
                 y_test_noisy_batch, (1,0,2))
+            yield (x_test_batch.to(dev_opt), y_test_batch.to(dev_opt), 
+                   y_test_noisy_batch.to(dev_opt))
+    
+    # Consecutive test batches solved together, about plan['batch_size'] 
+    # rows per solve; the samples and metrics are still those of each batch
+    batches_per_solve = max(1, plan['batch_size']//test_loader.batch_size)
+    def test_groups():
+        group = []
+        for batch in test_batches():
+            group.append(batch)
+            if len(group) == batches_per_solve:
+                yield group
+                group = []
+        if len(group) > 0:
+            yield group
+    
+    def sample_fn(group, M):
+        return torch.cat([sample_batch(batch, M) for batch in group], 1)
+    
+    def metrics_fn(M, y_preds, group):
+        y_test = torch.cat([batch[1] for batch in group]).reshape(-1, n_items)
+        sizes = [len(batch[1]) for batch in group]
+        
+        # Squared errors and cost function based on predictions 
+        # f(z*(y_pred)) of each row, one solve for the rows of the group
+        se = (y_preds.mean(axis=0).to(dev_opt) - y_test).pow(2).mean(1)
+        f = op_solvers_dist[M].calc_f_per_day(y_preds.to(dev_opt), y_test)
+        
+        # Means of the batches, averaged over the batches of the group
+        return {'MSE': torch.stack([v.mean() for v in se.split(sizes)]).mean(), 
+                'END': torch.stack([v.mean() for v in f.split(sizes)]).mean()}
+    
+    # Best and fair costs of the test set, the same for every method and 
+    # M of this dataset (stored in the cache, see artifact_cache)
+    def oracle_costs():
+        totals = {'FAIR': 0, 'BEST': 0}
+        n_batches = 0
+        with torch.no_grad():
+            for _, y_test_batch, y_test_noisy_batch in test_batches():
+                y_test_batch = y_test_batch.reshape(-1, n_items)
+                y_test_noisy_batch = y_test_noisy_batch.reshape(
+                    y_test_noisy_batch.shape[0], -1, n_items)
                 
-            x_test_batch = x_test_batch.to(dev_opt)
-            y_test_batch = y_test_batch.to(dev_opt)
-            y_test_noisy_batch = y_test_noisy_batch.to(dev_opt)
-            
-            # Output predictions
-            if method_name in ['ann','bnn']:
-                y_preds = model_used.forward_dist(
-                    x_test_batch, aleat_bool)
-                
-            elif method_name in ['gp']:
-                y_preds = torch.zeros_like(
-                    y_test_batch).unsqueeze(0).expand(
-                    M, y_test_batch.shape[0], 
-                    y_test_batch.shape[1]).clone()
-                for k in range(0, len(model_gps)):
-                    y_preds[:,:,k] = model_gps[k].forward_dist(
-                        x_test_batch, aleat_bool).squeeze()
+                # Compute cost function based on samples of 
+                # true distribution f(z*(y_pred)) 
+                totals['FAIR'] += op_solver_dist_noisy.end_loss_dist(
+                    y_test_noisy_batch, y_test_batch).item()
                 
-            else:
-                print('Model not found')
-                break
-           
-            
-            # Denormalize predictions
-            if method_name in ['bnn','gp']:
-                y_preds = y_preds.squeeze()
-            y_preds = inverse_transform(y_preds.to(dev))
-
-            y_preds = y_preds.reshape(M, -1, n_items)
-            y_test_batch = y_test_batch.reshape(-1, n_items)
-            y_test_noisy_batch = y_test_noisy_batch.reshape(y_test_noisy_batch.shape[0], -1, n_items)           
-            
-            # Compute MSE
-            mse_loss_result += (mse_loss(
-                y_preds.mean(axis=0).to(dev_opt), 
-                y_test_batch.to(dev_opt))/n_batches).detach()
-            
-            # Compute cost function based on predictions f(z*(y_pred))
-            f_total += (op_solver_dist.end_loss_dist(
-                y_preds.to(dev_opt), 
-                y_test_batch.to(dev_opt))/n_batches).detach()         
-            
-            # Compute cost function based on samples of 
-            # true distribution f(z*(y_pred)) 
-            f_total_noisy += (op_solver_dist_noisy.end_loss_dist(
-                y_test_noisy_batch.to(dev_opt), 
-                y_test_batch.to(dev_opt))/n_batches).detach()
-            
-            # Compute best cost function (based on observations)
-            f_total_best += (op_solver.cost_fn(
-                y_test_batch.unsqueeze(0).to(dev_opt), 
-                y_test_batch.to(dev_opt))/n_batches).detach()
-         
+                # Compute best cost function (based on observations)
+                totals['BEST'] += op_solver.cost_fn(
+                    y_test_batch.unsqueeze(0), y_test_batch).item()
+                n_batches += 1
+        return {name: total/n_batches for name, total in totals.items()}
+    
+    oracle = artifact_cache.cached_oracle(
+        oracle_costs, script='constrained_newsvendor', 
+        seed_number=seed_number+200, nl=nl, n_items=n_items, 
+        data=artifact_cache.data_hash(Y_test_original, Y_noisy), 
+        params=artifact_cache.data_hash(*params_t.values()), 
+        n_samples_noisy=op_solver_dist_noisy.n_samples, 
+        batch_size=test_loader.batch_size, dtype=str(solver_dtype))
+    
+    df_eval = evaluation_utils.evaluate_prefixes(
+        tqdm(test_groups(), 
+             total=math.ceil(len(test_loader)/batches_per_solve)), 
+        sample_fn, M_eval, metrics_fn, weight_fn=len).assign(**oracle)
+    
+    reg_result = []
+    freg_result = []
+    mse_result = []
+    
+    for _, row in df_eval.iterrows():
+        
         # Compute evaluation metrics regret and fair regret
-        regret = f_total.item() - f_total_best.item()
-        f_regret = f_total.item() - f_total_noisy.item()
-
-        print('Results for seed = ', seed_number, 'and M = ', M)
-        print('MSE loss: ', round(mse_loss_result.item(), 5))
-        print('END cost: ', round(f_total.item(), 5))
-        print('FAIR cost: ', round(f_total_noisy.item(), 5))
-        print('BEST cost: ', round(f_total_best.item(), 5))
+        regret = row['END'] - row['BEST']
+        f_regret = row['END'] - row['FAIR']
+
+        print('Results for seed = ', seed_number, 'and M = ', int(row['M']))
+        print('MSE loss: ', round(row['MSE'], 5))
+        print('END cost: ', round(row['END'], 5))
+        print('FAIR cost: ', round(row['FAIR'], 5))
+        print('BEST cost: ', round(row['BEST'], 5))
         print('REGRET: ', round(regret, 5))
         print('FAIR REGRET: ', round(f_regret, 5))
         
-        mse_result.append(mse_loss_result.item())
+        mse_result.append(row['MSE'])
         reg_result.append(regret)
         freg_result.append(f_regret)
-        
-        if not aleat_bool and method_name=='ann':
-            for i in range(0, 3):
-                mse_result.append(mse_loss_result.item())
-                reg_result.append(regret)
-                freg_result.append(f_regret)
-            break       
+    
+    # Same results for every M if a single sample is predicted
+    if not aleat_bool:
+        mse_result = mse_result*len(M_SAMPLES)
+        reg_result = reg_result*len(M_SAMPLES)
+        freg_result = freg_result*len(M_SAMPLES)
         
     return model_used, model_name, reg_result, freg_result, mse_result
 
@@ -428,17 +549,20 @@ if __name__ == '__main__':
     freg_results_8 = []
     freg_results_4 = []
     
+    # Seeds run in parallel processes if PAO_N_JOBS > 1
+    runs = parallel_utils.run_parallel(
+        run_constrained_newsvendor,
+        [dict(method_name=method_name, 
+              method_learning=method_learning,
+              seed_number=seed_number,
+              aleat_bool=aleat_bool,
+              N_SAMPLES=N_SAMPLES,
+              M_SAMPLES=M_SAMPLES,
+              dev=dev) for seed_number in range(0, nr_seeds)])
+    
     for seed_number in range(0, nr_seeds):
         model_used, model_name, reg_result, freg_result, mse_result \
-        = run_constrained_newsvendor(
-            method_name, 
-            method_learning,
-            seed_number,
-            aleat_bool,
-            N_SAMPLES,
-            M_SAMPLES,
-            dev
-        )
+        = runs[seed_number]
         
         mse_results_32.append(mse_result[0])
         mse_results_16.append(mse_result[1])
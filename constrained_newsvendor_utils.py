@@ -1,19 +1,48 @@
+import functools
+
 import torch
 from qpth.qp import QPFunction
 
+import dtype_utils
+import parallel_utils
+import qp_utils
+import scenario_utils
+
 class SolveConstrainedNewsvendor():
     """
     Quadratic Newsvendor Stochastic Optimization Problem class.
     Init with deterministic parameters params_t and solve it for n_samples.
+    solver='qpth' solves the full QP with qpth, solver='dual' uses the 
+    structure of the problem (see NewsvendorDualFunction) and 
+    solver='ipm' is an interior point method on the implicit 
+    constraints (see NewsvendorKKT). solver='cached' solves the same 
+    dense QP as qpth, caching the constant parts of its factorization 
+    (see qp_utils.DenseQP).
+    eps, max_iter and dtype are the tolerance, iteration cap and precision 
+    of the solvers (None for the defaults, the dtype default is given by 
+    dtype_utils.get_solver_dtype).
+    After eval() the orders are solved exactly without autograd (see 
+    forward_eval) until train() is called.
+    With scenario_reduction=True, reshape_outcomes compresses more than 
+    n_samples predictive samples into n_samples weighted scenarios per 
+    item (scenario_utils.reduce_scenarios), since the cost only depends 
+    on the samples of each item. Weighted scenarios are solved by the 
+    'qpth' and 'dual' solvers and in evaluation mode.
     """
-    def __init__(self, params_t, n_samples, dev):
+    def __init__(self, params_t, n_samples, dev, solver='qpth', 
+                 eps=None, max_iter=None, dtype=None, 
+                 scenario_reduction=False):
         super(SolveConstrainedNewsvendor, self).__init__()
+        
+        assert solver in ['qpth', 'dual', 'ipm', 'cached']
             
         self.params_t = params_t
         self.dev = dev    
+        self.solver = solver
         n_items = len(params_t['c'])
         self.n_items = n_items  
         self.n_samples = n_samples
+        self.scenario_reduction = scenario_reduction
         
         self.params_q = params_t['q'].to(self.dev)
         self.params_qs = params_t['qs'].to(self.dev)
@@ -27,24 +56,28 @@ class SolveConstrainedNewsvendor():
         
         self.zeros_params = torch.zeros((self.n_items)).to(self.dev)
         
-            
-        # Torch parameters for KKT         
-        ident = torch.eye(n_items).to(self.dev)
-        ident_samples = torch.eye(n_items*n_samples).to(self.dev)
-        ident3 = torch.eye(n_items + 2*n_items*n_samples).to(self.dev)
-        zeros_matrix = torch.zeros((n_items*n_samples, n_items*n_samples)).to(self.dev)
-        zeros_array = torch.zeros(n_items*n_samples).to(self.dev)
-        ones_array = torch.ones(n_items*n_samples).to(self.dev)
-             
-        self.Q = torch.diag(
-            torch.hstack(
+        if dtype is None:
+            dtype = dtype_utils.get_solver_dtype()
+        self.budget = params_t['B'].to(dtype).to(self.dev)
+        self.n_bisect = 60 # Bisection steps of the dual solver
+        self.dtype = dtype
+        if solver == 'qpth':
+            self.eps, self.max_iter = 1e-12, 20 # qpth defaults
+        else:
+            self.eps, self.max_iter = 1e-11, 50
+        self.set_tolerance(eps, max_iter)
+        self.n_iter = 0 # Iterations of the last solve (ipm, cached or dual)
+        self.warm_cache = None # Solutions per dataset index (init_warm_start)
+        self.warm_idx = None # Dataset indices of the next batch
+        self.training = True # Differentiable solves (see train and eval)
+        
+        self.Q_diag = torch.hstack(
                 (
                     self.params_q, 
                     (1/n_samples)*self.params_qs.repeat_interleave(n_samples), 
                     (1/n_samples)*self.params_qw.repeat_interleave(n_samples)
                 )
-            )).to(self.dev)
-        
+            ).to(self.dev)
         
         self.lin = torch.hstack(
                                 (
@@ -52,6 +85,25 @@ class SolveConstrainedNewsvendor():
                                     (1/n_samples)*self.params_cs.repeat_interleave(n_samples), 
                                     (1/n_samples)*self.params_cw.repeat_interleave(n_samples)
                                 )).to(self.dev)
+        
+        # The structured solvers do not need the dense KKT matrices, 
+        # their memory grows linearly with n_items*n_samples
+        if solver == 'ipm':
+            self.kkt = NewsvendorKKT(
+                2*self.Q_diag.to(dtype), self.params_pr.to(dtype), 
+                n_items, n_samples)
+        if solver in ['dual', 'ipm']:
+            return
+            
+        # Torch parameters for KKT         
+        ident = torch.eye(n_items).to(self.dev)
+        ident_samples = torch.eye(n_items*n_samples).to(self.dev)
+        ident3 = torch.eye(n_items + 2*n_items*n_samples).to(self.dev)
+        zeros_matrix = torch.zeros((n_items*n_samples, n_items*n_samples)).to(self.dev)
+        zeros_array = torch.zeros(n_items*n_samples).to(self.dev)
+        ones_array = torch.ones(n_items*n_samples).to(self.dev)
+             
+        self.Q = torch.diag(self.Q_diag).to(self.dev)
              
             
         shortage_ineq = torch.hstack(
@@ -102,13 +154,91 @@ class SolveConstrainedNewsvendor():
                                           torch.zeros(n_items*n_samples), 
                                           torch.zeros(n_items*n_samples))).to(self.dev)
         
-        self.e = torch.DoubleTensor().to(self.dev)
+        self.e = torch.tensor([], dtype=dtype).to(self.dev)
+        
+        # Q and the inequalities are constant, only the bounds depend on y
+        if solver == 'cached':
+            self.qp = qp_utils.DenseQP(
+                2*self.Q, self.ineqs, self.eps, self.max_iter, dtype)
         
         
         
-    def forward(self, y):
+    def set_tolerance(self, eps=None, max_iter=None):
+        """
+        Tolerance and iteration cap of the next solves (None keeps the value)
+        """
+        if eps is not None:
+            self.eps = eps
+        if max_iter is not None:
+            self.max_iter = max_iter
+        if hasattr(self, 'qp'):
+            self.qp.eps, self.qp.max_iter = self.eps, self.max_iter
+        
+    def init_warm_start(self, n_data):
+        """
+        Allocates the cache of solutions of a dataset of n_data samples, 
+        used to warm-start the solves of the batches given by 
+        set_warm_start_index. Not available for the qpth solver.
+        """
+        if self.solver == 'dual':
+            sizes = {'lam': 1}
+        elif self.solver == 'ipm':
+            n_x = self.n_items + 2*self.n_items*self.n_samples
+            sizes = {'x': n_x, 's': n_x + 2*self.n_items*self.n_samples + 1}
+            sizes['lam'] = sizes['s']
+        elif self.solver == 'cached':
+            sizes = {'x': self.ineqs.shape[1], 's': self.ineqs.shape[0]}
+            sizes['lam'] = sizes['s']
+        else:
+            return
+        self.warm_cache = qp_utils.WarmStartCache(n_data, sizes, self.dev)
+        
+    def set_warm_start_index(self, idx):
+        """
+        Dataset indices of the samples of the next forward, None to 
+        solve without warm start (e.g. validation)
+        """
+        self.warm_idx = idx
+        
+    def get_warm_start(self, batch_size):
+        if self.warm_cache is None or self.warm_idx is None:
+            return None
+        assert len(self.warm_idx) == batch_size
+        return self.warm_cache, self.warm_idx
+        
+    def train(self, mode=True):
+        """
+        Solves with the differentiable solver (mode=True) or with 
+        forward_eval (mode=False)
+        """
+        self.training = mode
+        return self
+        
+    def eval(self):
+        return self.train(False)
+        
+    def forward_eval(self, y, weights=None):
+        """
+        Orders of the batch y without autograd. The QP is solved exactly 
+        by the dual solver and the rows of the batch are split over 
+        parallel_utils.get_eval_jobs() processes.
+        """
+        params_t = self.params_t
+        arrays = (y.detach(),) if weights is None else (y.detach(), weights)
+        if parallel_utils.get_eval_jobs() > 1:
+            # The workers solve on the CPU
+            params_t = {name: v.cpu() 
+                        for name, v in params_t.items()}
+            arrays = tuple(v.cpu() for v in arrays)
+        z = parallel_utils.map_chunks(functools.partial(
+            solve_exact, params_t, self.n_samples, self.dtype), arrays)
+        return z.to(self.dev)
+        
+    def forward(self, y, weights=None):
         """
         Applies the qpth solver for all batches and allows backpropagation.
+        weights (batch x n_items x n_samples) are the probabilities of the 
+        scenarios of each item (1/n_samples each if None).
         Formulation based on Priya L. Donti, Brandon Amos, J. Zico Kolter (2017).
         Note: The quadratic terms (Q) are used as auxiliar terms only to allow the backpropagation through the 
         qpth library from Amos and Kolter. 
@@ -118,12 +248,40 @@ class SolveConstrainedNewsvendor():
         batch_size, n_samples_items = y.size()
                 
         assert self.n_samples*self.n_items == n_samples_items 
+        
+        if not self.training:
+            return self.forward_eval(y, weights)
+        if self.solver == 'dual':
+            return NewsvendorDualFunction.apply(y, self, weights)
+        if weights is not None and self.solver != 'qpth':
+            raise ValueError(
+                f'Weighted scenarios are not supported by the {self.solver} solver')
+        if self.solver == 'ipm':
+            return NewsvendorIPMFunction.apply(y, self)
+        if self.solver == 'cached':
+            bound = torch.hstack((
+                self.uncert_bound*torch.hstack((y, y)), 
+                self.determ_bound.expand(batch_size, -1)))
+            argmin = qp_utils.DenseQPFunction.apply(
+                self.lin.expand(batch_size, -1), bound, None, self.qp, 
+                self.get_warm_start(batch_size))
+            self.n_iter = self.qp.n_iter
+            return argmin[:,:self.n_items]
 
         Q = self.Q
         Q = Q.expand(batch_size, Q.size(0), Q.size(1))
         
         lin = self.lin
         lin = lin.expand(batch_size, lin.size(0))
+        
+        if weights is not None:
+            # The scenario costs are weighted by weights instead of 1/M
+            scale = torch.hstack((
+                torch.ones((batch_size, self.n_items), device=self.dev), 
+                (self.n_samples*weights.to(self.dev)).reshape(
+                    batch_size, -1).repeat(1, 2)))
+            Q = torch.diag_embed(self.Q_diag*scale)
+            lin = lin*scale
 
         ineqs = torch.unsqueeze(self.ineqs, dim=0)
         ineqs = ineqs.expand(batch_size, ineqs.shape[1], ineqs.shape[2])       
@@ -133,13 +291,158 @@ class SolveConstrainedNewsvendor():
             batch_size, self.determ_bound.shape[0])
         bound = torch.hstack((uncert_bound, determ_bound))     
         
-        argmin = QPFunction(verbose=-1)\
-            (2*Q.double(), lin.double(), ineqs.double(), 
-             bound.double(), self.e, self.e).double()
+        argmin = QPFunction(verbose=-1, eps=self.eps, maxIter=self.max_iter)\
+            (2*Q.to(self.dtype), lin.to(self.dtype), ineqs.to(self.dtype), 
+             bound.to(self.dtype), self.e, self.e)
             
         return argmin[:,:self.n_items]
 
     
+    def dual_prepare(self, y, weights=None):
+        """
+        Quantities of the per-item problems that do not depend on the 
+        budget multiplier. The shortage and excess variables are eliminated, 
+        so the cost of item i is a convex piecewise quadratic function of z_i. 
+        With k of the M sorted samples below z_i, its derivative is 
+        a_k*z_i + d_k. The samples have the probabilities weights 
+        (batch x n_items x M, 1/M if None).
+        """
+        batch_size = y.shape[0]
+        M = self.n_samples
+        y = y.to(self.dtype).reshape(batch_size, self.n_items, M)
+        y_sorted, order = torch.sort(y, dim=-1)
+        if weights is None:
+            w_sorted = torch.full_like(y_sorted, 1/M)
+        else:
+            w_sorted = weights.to(self.dtype).gather(-1, order)
+        
+        # Weight and weighted sum of the samples below each piece
+        cumsum = torch.cumsum(w_sorted*y_sorted, dim=-1)
+        cumsum = torch.cat((torch.zeros_like(cumsum[..., :1]), cumsum), -1)
+        total = cumsum[..., -1:]
+        w_below = torch.cumsum(w_sorted, dim=-1)
+        w_below = torch.cat((torch.zeros_like(w_below[..., :1]), w_below), -1)
+        q = self.params_q.to(self.dtype).unsqueeze(-1)
+        qs = self.params_qs.to(self.dtype).unsqueeze(-1)
+        qw = self.params_qw.to(self.dtype).unsqueeze(-1)
+        c = self.params_c.to(self.dtype).unsqueeze(-1)
+        cs = self.params_cs.to(self.dtype).unsqueeze(-1)
+        cw = self.params_cw.to(self.dtype).unsqueeze(-1)
+        
+        a = 2*q + 2*(qs*(1 - w_below) + qw*w_below)
+        d = (c - 2*qs*(total - cumsum) - cs*(1 - w_below) 
+             - 2*qw*cumsum + cw*w_below)
+        
+        # Derivative at the right of each sorted sample (nondecreasing)
+        d_right = a[..., 1:]*y_sorted + d[..., 1:]
+        
+        return y, y_sorted, order, a, d, d_right.contiguous()
+    
+    def dual_argmin(self, prep, lam):
+        """
+        Minimizes the cost of each item + lam*pr*z over z >= 0 for the 
+        budget multiplier lam (one per batch element).
+        """
+        _, y_sorted, _, a, d, d_right = prep
+        M = self.n_samples
+        t = -lam*self.params_pr.to(self.dtype)
+        
+        # k = number of samples below the unconstrained minimizer
+        k = torch.searchsorted(d_right, t.unsqueeze(-1)).squeeze(-1)
+        a_k = a.gather(-1, k.unsqueeze(-1)).squeeze(-1)
+        d_k = d.gather(-1, k.unsqueeze(-1)).squeeze(-1)
+        z = (t - d_k)/a_k
+        
+        # The minimizer can be at a kink of the cost (z equal to a sample)
+        y_kink = y_sorted.gather(
+            -1, k.clamp(max=M-1).unsqueeze(-1)).squeeze(-1)
+        kink = (k < M) & (z >= y_kink)
+        z = torch.where(kink, y_kink, z)
+        
+        zero = z <= 0
+        z = torch.clamp(z, min=0)
+        return z, k, a_k, d_k, kink, zero
+    
+    def solve_dual(self, y, lam_warm=None, warm_mask=None, weights=None):
+        """
+        Solves the QP by bisection on the multiplier of the budget 
+        constraint, which is the only constraint coupling the items.
+        The bisection stops when both ends of the bracket have the same 
+        active pieces. lam_warm (e.g. the multiplier of a close QP) gives 
+        a narrow initial bracket for the batch elements in warm_mask.
+        Returns the orders and the quantities used by the backward pass.
+        """
+        prep = self.dual_prepare(y, weights)
+        y, y_sorted, _, _, d, _ = prep
+        batch_size = y.shape[0]
+        pr = self.params_pr.to(self.dtype)
+        
+        def budget_state(lam):
+            z, k, _, _, kink, zero = self.dual_argmin(prep, lam)
+            feasible = (pr*z).sum(-1, keepdim=True) <= self.budget
+            return feasible, (k, kink, zero)
+        
+        def same_pieces(state_lo, state_hi):
+            return torch.all(torch.stack(
+                [a == b for a, b in zip(state_lo, state_hi)]), 0).all(
+                -1, keepdim=True)
+        
+        lam_lo = torch.zeros((batch_size, 1), dtype=self.dtype, device=y.device)
+        feasible_lo, state_lo = budget_state(lam_lo)
+        over_budget = ~feasible_lo
+        
+        # Multiplier that sets all the orders to zero
+        k_zero = torch.searchsorted(
+            y_sorted, torch.zeros_like(y_sorted[..., :1]), right=True)
+        d_zero = d.gather(-1, k_zero).squeeze(-1)
+        lam_hi = (torch.clamp(-d_zero, min=0)/pr).max(-1, keepdim=True)[0]
+        _, state_hi = budget_state(lam_hi)
+        
+        if lam_warm is not None:
+            # Bracket around the warm multiplier, kept where it is valid
+            lam_lo_w = 0.95*lam_warm
+            lam_hi_w = 1.05*lam_warm + 1e-12
+            feasible_lo_w, state_lo_w = budget_state(lam_lo_w)
+            feasible_hi_w, state_hi_w = budget_state(lam_hi_w)
+            use_lo = warm_mask.unsqueeze(-1) & ~feasible_lo_w & over_budget
+            use_hi = warm_mask.unsqueeze(-1) & feasible_hi_w & over_budget
+            lam_lo = torch.where(use_lo, lam_lo_w, lam_lo)
+            lam_hi = torch.where(use_hi, lam_hi_w, lam_hi)
+            state_lo = tuple(torch.where(use_lo, a, b) 
+                             for a, b in zip(state_lo_w, state_lo))
+            state_hi = tuple(torch.where(use_hi, a, b) 
+                             for a, b in zip(state_hi_w, state_hi))
+        
+        self.n_iter = 0
+        for _ in range(0, self.n_bisect):
+            if torch.all(same_pieces(state_lo, state_hi) | ~over_budget):
+                break
+            lam = (lam_lo + lam_hi)/2
+            feasible, state = budget_state(lam)
+            lam_hi = torch.where(feasible, lam, lam_hi)
+            lam_lo = torch.where(feasible, lam_lo, lam)
+            state_hi = tuple(torch.where(feasible, a, b) 
+                             for a, b in zip(state, state_hi))
+            state_lo = tuple(torch.where(feasible, b, a) 
+                             for a, b in zip(state, state_lo))
+            self.n_iter += 1
+            
+        # The orders are linear in lam between breakpoints, so the budget 
+        # equation is solved exactly with the pieces active at lam_hi
+        z, k, a_k, d_k, kink, zero = self.dual_argmin(prep, lam_hi)
+        free = ~kink & ~zero
+        inv_a = torch.where(free, 1/a_k, torch.zeros_like(a_k))
+        H = (pr**2*inv_a).sum(-1, keepdim=True)
+        fixed = (torch.where(free, torch.zeros_like(z), z)*pr).sum(-1, keepdim=True)
+        lam_exact = ((-d_k*pr*inv_a).sum(-1, keepdim=True) 
+                     + fixed - self.budget)/torch.where(H > 0, H, torch.ones_like(H))
+        use_exact = (H > 0) & (lam_exact >= lam_lo) & (lam_exact <= lam_hi)
+        lam = torch.where(use_exact, lam_exact, lam_hi)
+        lam = torch.where(over_budget, lam, torch.zeros_like(lam))
+        
+        z, k, a_k, _, kink, zero = self.dual_argmin(prep, lam)
+        return z, (y, prep[2], lam, a_k, k, kink, zero)
+    
     def cost_per_item(self, Z, Y):
         return ( self.params_q*Z**2 \
         + self.params_qs*(torch.max(self.zeros_params, Y-Z))**2 \
@@ -148,16 +451,33 @@ class SolveConstrainedNewsvendor():
         + self.params_cs*torch.max(self.zeros_params, Y-Z) \
         + self.params_cw*torch.max(self.zeros_params, Z-Y))
 
-    def reshape_outcomes(self, y_pred):
+    def reshape_outcomes(self, y_pred, return_weights=False):
+        """
+        Samples (M x batch x n_items) to the input of forward. With 
+        scenario_reduction, M > n_samples samples are reduced to n_samples 
+        weighted scenarios, whose weights are also returned if 
+        return_weights (None for equally likely samples).
+        """
         n_samples = y_pred.shape[0]
         batch_size = y_pred.shape[1]
         n_items = y_pred.shape[2]
-        y_pred = y_pred.permute((1, 2, 0)).reshape((batch_size, n_samples*n_items))
+        y_pred = y_pred.permute((1, 2, 0))
+        weights = None
+        if self.scenario_reduction and n_samples > self.n_samples:
+            centers, weights = scenario_utils.reduce_scenarios(
+                y_pred.reshape((batch_size*n_items, n_samples, 1)), 
+                self.n_samples)
+            y_pred = centers.reshape((batch_size, n_items, self.n_samples))
+            weights = weights.reshape((batch_size, n_items, self.n_samples))
+            n_samples = self.n_samples
+        y_pred = y_pred.reshape((batch_size, n_samples*n_items))
+        if return_weights:
+            return y_pred, weights
         return y_pred
 
     def calc_f_por_item(self, y_pred, y):
-        y_pred = self.reshape_outcomes(y_pred) 
-        z_star = self.forward(y_pred)
+        y_pred, weights = self.reshape_outcomes(y_pred, return_weights=True) 
+        z_star = self.forward(y_pred, weights)
         f_per_item = self.cost_per_item(z_star, y)
         return f_per_item
 
@@ -178,4 +498,233 @@ class SolveConstrainedNewsvendor():
     
     def end_loss_dist(self, y_pred, y):
         f_total = self.cost_fn(y_pred, y)
-        return f_total
\ No newline at end of file
+        return f_total
+
+
+def solve_exact(params_t, n_samples, dtype, y, weights=None):
+    """
+    Orders of the batch y solved by the dual solver without autograd 
+    (module level so it can be sent to the workers of forward_eval)
+    """
+    solver = SolveConstrainedNewsvendor(
+        params_t, n_samples, y.device, solver='dual', dtype=dtype)
+    with torch.no_grad():
+        z, _ = solver.solve_dual(y, weights=weights)
+    return z
+
+
+class NewsvendorDualFunction(torch.autograd.Function):
+    """
+    Structure-exploiting solver of the constrained newsvendor QP. The 
+    scenario variables are eliminated analytically, each item is solved 
+    exactly for a fixed multiplier of the budget constraint and the 
+    multiplier is found by bisection: O(n_items*M*log(M)) per instance 
+    instead of the O((n_items*M)^3) KKT solves of qpth.
+    The gradients come from implicit differentiation of the optimality 
+    conditions at the solution.
+    """
+    @staticmethod
+    def forward(ctx, y, solver, weights=None):
+        warm_start = solver.get_warm_start(y.shape[0])
+        if warm_start is None:
+            z, saved = solver.solve_dual(y.detach(), weights=weights)
+        else:
+            cache, idx = warm_start
+            values, valid = cache.get(idx)
+            z, saved = solver.solve_dual(
+                y.detach(), values['lam'].to(solver.dtype), valid, weights)
+            cache.update(idx, lam=saved[2])
+        ctx.solver = solver
+        ctx.weights = weights
+        ctx.y_dtype = y.dtype
+        ctx.save_for_backward(z, *saved)
+        return z
+
+    @staticmethod
+    def backward(ctx, grad_z):
+        z, y, order, lam, a_k, k, kink, zero = ctx.saved_tensors
+        solver = ctx.solver
+        batch_size, n_items, M = y.shape
+        pr = solver.params_pr.to(solver.dtype)
+        v = grad_z.to(solver.dtype)
+        
+        # Free items satisfy a_k*z + d_k(y) + lam*pr = 0, items at a kink 
+        # follow their sample and zero orders do not move. If the budget 
+        # is active, lam moves to keep sum(pr*z) = B.
+        free = ~kink & ~zero
+        inv_a = torch.where(free, 1/a_k, torch.zeros_like(a_k))
+        H = (pr**2*inv_a).sum(-1, keepdim=True)
+        active = (lam > 0) & (H > 0)
+        alpha = -(v*pr*inv_a).sum(-1, keepdim=True)
+        corr = torch.where(
+            active, alpha/torch.where(H > 0, H, torch.ones_like(H)), 
+            torch.zeros_like(H))
+        coef_free = (-v - corr*pr)*inv_a
+        coef_kink = torch.where(kink, v + corr*pr, torch.zeros_like(v))
+        
+        # Derivative of d_k with respect to each sample
+        qs = solver.params_qs.to(solver.dtype).unsqueeze(-1)
+        qw = solver.params_qw.to(solver.dtype).unsqueeze(-1)
+        w = 1/M if ctx.weights is None else ctx.weights.to(solver.dtype)
+        dd_dy = torch.where(y > z.unsqueeze(-1), -2*qs*w, -2*qw*w)
+        grad_y = coef_free.unsqueeze(-1)*dd_dy
+        
+        kink_idx = order.gather(-1, k.clamp(max=M-1).unsqueeze(-1))
+        grad_y = grad_y.scatter_add(-1, kink_idx, coef_kink.unsqueeze(-1))
+        
+        return grad_y.reshape(batch_size, n_items*M).to(ctx.y_dtype), None, None
+
+
+class NewsvendorKKT():
+    """
+    Implicit inequality system of the constrained newsvendor QP for the 
+    interior point solver of qp_utils. The variables are the orders z, 
+    the shortages s and the excesses w, and the constraints are stacked 
+    as in SolveConstrainedNewsvendor: shortage, excess, price and 
+    positivity. G is never formed; its products cost O(n_items*M) and 
+    the Newton systems are solved by eliminating s and w, which leaves 
+    a diagonal plus rank one system in z (Sherman-Morrison).
+    """
+    def __init__(self, Q_diag, pr, n_items, n_samples):
+        self.n = n_items
+        self.M = n_samples
+        self.nM = n_items*n_samples
+        self.Q_diag = Q_diag
+        self.pr = pr
+        self.Qz, self.Qs, self.Qw = self.split_x(Q_diag.unsqueeze(0))
+        
+    def split_x(self, x):
+        batch_size = x.shape[0]
+        z = x[:, :self.n]
+        s = x[:, self.n:self.n+self.nM].reshape(batch_size, self.n, self.M)
+        w = x[:, self.n+self.nM:].reshape(batch_size, self.n, self.M)
+        return z, s, w
+    
+    def split_ineq(self, lam):
+        batch_size = lam.shape[0]
+        l_short = lam[:, :self.nM].reshape(batch_size, self.n, self.M)
+        l_excess = lam[:, self.nM:2*self.nM].reshape(batch_size, self.n, self.M)
+        l_price = lam[:, 2*self.nM:2*self.nM+1]
+        l_pos = lam[:, 2*self.nM+1:]
+        return l_short, l_excess, l_price, l_pos
+    
+    def Q_mv(self, x):
+        return self.Q_diag*x
+    
+    def G_mv(self, x):
+        z, s, w = self.split_x(x)
+        shortage = -z.unsqueeze(-1) - s
+        excess = z.unsqueeze(-1) - w
+        price = (self.pr*z).sum(-1, keepdim=True)
+        return torch.hstack((shortage.flatten(1), excess.flatten(1), price, -x))
+    
+    def GT_mv(self, lam):
+        l_short, l_excess, l_price, l_pos = self.split_ineq(lam)
+        l_pos_z, l_pos_s, l_pos_w = self.split_x(l_pos)
+        gz = -l_short.sum(-1) + l_excess.sum(-1) + l_price*self.pr - l_pos_z
+        gs = -l_short - l_pos_s
+        gw = -l_excess - l_pos_w
+        return torch.hstack((gz, gs.flatten(1), gw.flatten(1)))
+    
+    def factor(self, W):
+        """
+        Newton matrix Q + G'W^{-1}G in factored form
+        """
+        D = 1/W
+        D_short, D_excess, _, D_pos = self.split_ineq(D)
+        D_pos_z, D_pos_s, D_pos_w = self.split_x(D_pos)
+        hs = self.Qs + D_short + D_pos_s
+        hw = self.Qw + D_excess + D_pos_w
+        # Diagonal of the z system after eliminating s, w and their multipliers
+        delta = (self.Qz + D_pos_z 
+                 + (D_short*(self.Qs + D_pos_s)/hs).sum(-1) 
+                 + (D_excess*(self.Qw + D_pos_w)/hw).sum(-1))
+        W_price = W[:, 2*self.nM:2*self.nM+1]
+        W_pos_z = self.split_x(self.split_ineq(W)[3])[0]
+        return D_short, D_excess, D_pos_z, D_pos_s, D_pos_w, \
+            W_price, W_pos_z, hs, hw, delta
+    
+    def solve(self, F, a, b):
+        """
+        The multipliers are recovered without products of the large 
+        entries of W^{-1} with differences of primal steps, which keeps 
+        the solve accurate when constraints are active.
+        """
+        D_short, D_excess, D_pos_z, D_pos_s, D_pos_w, \
+            W_price, W_pos_z, hs, hw, delta = F
+        az, a_s, aw = self.split_x(a)
+        b_short, b_excess, b_price, b_pos = self.split_ineq(b)
+        b_pos_z, b_pos_s, b_pos_w = self.split_x(b_pos)
+        Qs_pos = self.Qs + D_pos_s
+        Qw_pos = self.Qw + D_pos_w
+        
+        # Reduced system  delta*dz + pr*dlam_price = rz,  pr'dz - W dlam_price = b
+        rz = (az - D_pos_z*b_pos_z 
+              - (D_short*(b_short*Qs_pos + a_s - D_pos_s*b_pos_s)/hs).sum(-1) 
+              + (D_excess*(b_excess*Qw_pos + aw - D_pos_w*b_pos_w)/hw).sum(-1))
+        dl_price = ((self.pr*rz/delta).sum(-1, keepdim=True) - b_price)/(
+            (self.pr**2/delta).sum(-1, keepdim=True) + W_price)
+        dz = (rz - self.pr*dl_price)/delta
+        
+        dz_s = dz.unsqueeze(-1) + b_short
+        dz_w = dz.unsqueeze(-1) - b_excess
+        ds = (a_s - D_short*dz_s - D_pos_s*b_pos_s)/hs
+        dw = (aw + D_excess*dz_w - D_pos_w*b_pos_w)/hw
+        dl_short = D_short*(-dz_s*Qs_pos - a_s + D_pos_s*b_pos_s)/hs
+        dl_excess = D_excess*(dz_w*Qw_pos - aw + D_pos_w*b_pos_w)/hw
+        dl_pos_s = D_pos_s*(-a_s + D_short*dz_s - (self.Qs + D_short)*b_pos_s)/hs
+        dl_pos_w = D_pos_w*(-aw - D_excess*dz_w - (self.Qw + D_excess)*b_pos_w)/hw
+        # Multiplier of z >= 0 from its constraint when it is inactive and 
+        # from the stationarity of z when it is active
+        dl_pos_z = torch.where(
+            W_pos_z < 1, 
+            self.Qz*dz - dl_short.sum(-1) + dl_excess.sum(-1) 
+            + self.pr*dl_price - az, 
+            D_pos_z*(-dz - b_pos_z))
+        
+        dx = torch.hstack((dz, ds.flatten(1), dw.flatten(1)))
+        dlam = torch.hstack((
+            dl_short.flatten(1), dl_excess.flatten(1), dl_price, 
+            dl_pos_z, dl_pos_s.flatten(1), dl_pos_w.flatten(1)))
+        return dx, dlam
+
+
+class NewsvendorIPMFunction(torch.autograd.Function):
+    """
+    Constrained newsvendor QP solved by the batched interior point method 
+    of qp_utils with the implicit constraints of NewsvendorKKT. Memory and 
+    time grow linearly with n_items*M. The backward pass differentiates 
+    the KKT conditions as qpth does.
+    """
+    @staticmethod
+    def forward(ctx, y, solver):
+        batch_size = y.shape[0]
+        ctx.y_dtype = y.dtype
+        y = y.detach().to(solver.dtype)
+        kkt = solver.kkt
+        
+        h = torch.hstack((
+            -y, y, solver.budget.to(y.dtype).expand(batch_size, 1), 
+            torch.zeros((batch_size, kkt.n + 2*kkt.nM), 
+                        dtype=y.dtype, device=y.device)))
+        p = solver.lin.to(y.dtype).expand(batch_size, -1)
+        
+        x, s, lam, n_iter = qp_utils.pdipm_warm(
+            kkt, p, h, solver.eps, solver.max_iter, 
+            solver.get_warm_start(batch_size))
+        solver.n_iter = n_iter
+        
+        ctx.solver = solver
+        ctx.save_for_backward(x, s, lam)
+        return x[:, :kkt.n]
+
+    @staticmethod
+    def backward(ctx, grad_z):
+        x, s, lam = ctx.saved_tensors
+        kkt = ctx.solver.kkt
+        grad_x = torch.zeros_like(x)
+        grad_x[:, :kkt.n] = grad_z
+        _, dlam = qp_utils.pdipm_backward(kkt, s, lam, grad_x)
+        grad_h = -dlam
+        grad_y = -grad_h[:, :kkt.nM] + grad_h[:, kkt.nM:2*kkt.nM]
+        return grad_y.to(ctx.y_dtype), None
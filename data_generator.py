@@ -4,9 +4,10 @@ import torch
 from sklearn import preprocessing
 
 class ArtificialDataset(torch.utils.data.Dataset):
-    def __init__(self, X, y):
+    def __init__(self, X, y, return_idx=False):
         self.X = X
         self.y = y
+        self.return_idx = return_idx # Also return the index (warm start)
         return
 
     def __len__(self):
@@ -15,6 +16,8 @@ class ArtificialDataset(torch.utils.data.Dataset):
     def __getitem__(self, idx):
         X_i = self.X[idx]
         y_i = self.y[idx]
+        if self.return_idx:
+            return X_i, y_i, idx
         return X_i, y_i
     
 class ArtificialNoisyDataset(torch.utils.data.Dataset):
@@ -0,0 +1,51 @@
+import inspect
+import os
+import sys
+
+import joblib
+import numpy as np
+import torch
+
+import decision_utils
+from classical_newsvendor_utils import ClassicalNewsvendor
+from model import StandardNet
+
+
+if __name__ == '__main__':
+
+    # Orders of a model saved by classic_newsvendor.py (./models/*.pkl, with
+    # the *.pkl.scaler.gz of its run) for a features file of any number of rows
+    assert (len(sys.argv) in [5, 6])
+    model_path = sys.argv[1] # e.g. ./models/bnn_decoupled_gaussian_3_16_0_0.pkl
+    X_path = sys.argv[2] # .npy file, rows x features
+    out_dir = sys.argv[3] # order.npy (and cost.npy) are written there
+    M = int(sys.argv[4]) # Number of predictive samples per row
+    y_path = sys.argv[5] if len(sys.argv) == 6 else None # demands, .npy
+
+    dev = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    cost_shortage = 100
+    COST_EXCESS = [900]
+    op = ClassicalNewsvendor(cost_shortage, COST_EXCESS)
+
+    # The saved file is the whole model, which newer torch versions only 
+    # load with weights_only=False (the argument does not exist before 1.13)
+    load_kwargs = {}
+    if 'weights_only' in inspect.signature(torch.load).parameters:
+        load_kwargs['weights_only'] = False
+    model = torch.load(model_path, map_location=dev, **load_kwargs)
+    # Same uncertainty as in classic_newsvendor.py
+    aleat_bool = not isinstance(model, StandardNet)
+
+    # The scaler saved next to the model, not the scaler.gz of the last run
+    scaler_path = f'{model_path}.scaler.gz'
+    if not os.path.isfile(scaler_path):
+        sys.exit(f'Missing {scaler_path}: run classic_newsvendor.py again '
+                 'to save the scaler of the model')
+    scaler = joblib.load(scaler_path)
+    X = np.load(X_path, mmap_mode='r')
+    y = np.load(y_path, mmap_mode='r') if y_path is not None else None
+
+    decision_utils.newsvendor_decisions(
+        model, op, X, out_dir, n_samples=M, aleat_bool=aleat_bool, y=y,
+        scale=scaler.scale_.item(), shift=scaler.mean_.item(), dev=dev)
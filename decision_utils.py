@@ -0,0 +1,125 @@
+import json
+import os
+import time
+
+import numpy as np
+import torch
+
+import dtype_utils
+
+# Feature rows per chunk of newsvendor_decisions
+CHUNK_SIZE = 4096
+
+# Predictive samples drawn at once for a chunk of rows
+SAMPLE_CHUNK = 256
+
+
+def open_columns(out_dir, n_rows, columns):
+    """
+    One .npy file per column in out_dir, opened as writable memmaps of
+    n_rows rows; columns is {name: (shape of a row, dtype)}
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    return {name: np.lib.format.open_memmap(
+                os.path.join(out_dir, f'{name}.npy'), mode='w+',
+                dtype=dtype, shape=(n_rows,) + shape)
+            for name, (shape, dtype) in columns.items()}
+
+
+def read_chunk(array, start, stop, dtype, dev):
+    """
+    Rows start:stop of a tensor or of a numpy array (copied, so read-only 
+    memmaps work) as a tensor
+    """
+    if torch.is_tensor(array):
+        return array[start:stop].to(dev, dtype)
+    return torch.from_numpy(np.array(array[start:stop])).to(dev, dtype)
+
+
+def chunk_orders(model, op, x, n_samples, aleat_bool, scale, shift,
+                 sample_chunk):
+    """
+    Orders of op for the rows x (ratios first if several). The predictions
+    are mapped to the demand as y*scale + shift (scale > 0, the inverse
+    transform of the scaler of the outputs).
+    Models with forward_gaussian need no samples (see StandardNet), the
+    others are sampled sample_chunk samples at a time and reduced by the
+    streaming quantile of op, so the memory is bounded by sample_chunk
+    and not n_samples.
+    """
+    if hasattr(model, 'forward_gaussian'):
+        mean, std = model.forward_gaussian(x, aleat_bool)
+        return op.get_argmins_from_gaussian(
+            mean[:,0]*scale + shift, std[:,0]*scale)
+
+    # The samples of GP.forward_dist have a fixed seed, so only the torch
+    # models (new samples at every call) are sampled in several draws
+    if not isinstance(model, torch.nn.Module):
+        sample_chunk = n_samples
+
+    def chunks():
+        n_drawn = 0
+        while n_drawn < n_samples:
+            m = min(sample_chunk, n_samples - n_drawn)
+            model.update_n_samples(n_samples=m)
+            y_pred = model.forward_dist(x, aleat_bool)[:,:,0]
+            n_drawn += m
+            yield y_pred*scale + shift
+
+    return op.get_argmins_from_stream(chunks(), n_samples)
+
+
+def newsvendor_decisions(model, op, X, out_dir, n_samples=512,
+                         aleat_bool=True, y=None, scale=1., shift=0.,
+                         chunk_size=CHUNK_SIZE, sample_chunk=SAMPLE_CHUNK,
+                         dev=torch.device('cpu')):
+    """
+    Orders of the newsvendor op (ClassicalNewsvendor) for every row of the
+    features X (rows x features: numpy array, e.g. np.load(path,
+    mmap_mode='r'), or tensor), from n_samples predictive samples of the
+    model. The rows are processed chunk_size at a time and the results
+    are written as they are computed to out_dir, one .npy file per column
+    (see open_columns): order, and cost (the cost of the order for the
+    demand) if the demands y (rows, in the units of the orders) are given.
+    Columns have one value per row, or one per cost ratio if op has
+    several (rows x ratios). The memory does not depend on the number of
+    rows. Returns {'rows', 'seconds', 'rows_per_s'}.
+    """
+    n_rows = len(X)
+    n_ratios = op.n_ratios
+    row_shape = () if n_ratios is None else (n_ratios,)
+    np_dtype = torch.empty(0, dtype=dtype_utils.get_dtype()).numpy().dtype
+    columns = {'order': (row_shape, np_dtype)}
+    if y is not None:
+        columns['cost'] = (row_shape, np_dtype)
+    out = open_columns(out_dir, n_rows, columns)
+    with open(os.path.join(out_dir, 'columns.json'), 'w') as fp:
+        json.dump({'rows': n_rows, 'columns': list(columns),
+                   'quantile': op.quantile_cuts(), 'n_samples': n_samples},
+                  fp, indent=1)
+
+    t0 = time.perf_counter()
+    with torch.no_grad():
+        for start in range(0, n_rows, chunk_size):
+            stop = min(start + chunk_size, n_rows)
+            x = read_chunk(X, start, stop, dtype_utils.get_dtype(), dev)
+            z = chunk_orders(model, op, x, n_samples, aleat_bool, scale,
+                             shift, sample_chunk)
+            results = {'order': z}
+            if y is not None:
+                y_chunk = read_chunk(y, start, stop, z.dtype, z.device)
+                results['cost'] = op.cost_per_instance(z, y_chunk.reshape(-1))
+            for name, value in results.items():
+                # Rows first in the columns
+                if n_ratios is not None:
+                    value = value.T
+                out[name][start:stop] = value.cpu().numpy()
+    for column in out.values():
+        column.flush()
+    seconds = time.perf_counter() - t0
+
+    stats = {'rows': n_rows, 'seconds': seconds,
+             'rows_per_s': n_rows/seconds if seconds > 0 else float('inf')}
+    print(f'Decisions of {n_rows} rows written to {out_dir} in '
+          f'{seconds:.1f} s ({stats["rows_per_s"]:.0f} rows/s)')
+    return stats
@@ -0,0 +1,69 @@
+import os
+
+import numpy as np
+import torch
+
+# Precision of the networks, the data tensors and inverse_transform
+DTYPE_ENV = 'PAO_DTYPE'
+# Precision of the QP solvers (SolveConstrainedNewsvendor, RiskPortOP)
+SOLVER_DTYPE_ENV = 'PAO_SOLVER_DTYPE'
+
+DTYPES = {'float32': torch.float32, 'float64': torch.float64}
+
+
+def get_dtype():
+    return DTYPES[os.environ.get(DTYPE_ENV, 'float32')]
+
+
+def get_solver_dtype():
+    return DTYPES[os.environ.get(SOLVER_DTYPE_ENV, 'float64')]
+
+
+def to_tensor(array, dev):
+    """
+    Tensor in the policy dtype, e.g. the mean and std of a scaler, so
+    inverse_transform does not upcast the predictions
+    """
+    return torch.tensor(array, dtype=get_dtype()).to(dev)
+
+
+def check_rows(Y, n_samples, n_check=16):
+    """
+    Rows of Y for up to n_check instances of n_samples scenarios, the batch
+    of validated_solver_dtype. With fewer than n_samples rows they are 
+    repeated, so there is always at least one instance.
+    """
+    n_check = max(1, min(n_check, len(Y)//n_samples))
+    return Y[np.arange(n_check*n_samples) % len(Y)]
+
+
+def solution_error(make_solver, y, solve=None):
+    """
+    Relative error of the float32 solution of the solver built by
+    make_solver(dtype) on the batch y, against its float64 solution
+    """
+    if solve is None:
+        solve = lambda op, y: op.forward(y)
+    with torch.no_grad():
+        z64 = solve(make_solver(torch.float64), y.double())
+        z32 = solve(make_solver(torch.float32), y.float())
+    return ((z32.double() - z64).abs().max()
+            /torch.clamp(z64.abs().max(), min=1)).item()
+
+
+def validated_solver_dtype(make_solver, y, solve=None, rtol=1e-3):
+    """
+    Solver dtype of the policy. float32 is only used if its solutions on
+    the batch y are within rtol of the float64 ones (see solution_error),
+    otherwise the solver falls back to float64.
+    """
+    dtype = get_solver_dtype()
+    if dtype == torch.float64:
+        return dtype
+    error = solution_error(make_solver, y, solve)
+    if error > rtol:
+        print(f'float32 solver not accurate (relative error {error:.1e}), '
+              'using float64')
+        return torch.float64
+    print(f'Using float32 solver (relative error {error:.1e})')
+    return dtype
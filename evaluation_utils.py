@@ -0,0 +1,112 @@
+import queue
+import threading
+
+import pandas as pd
+import torch
+
+# Number of sampled batches the sampling worker may run ahead of the solves
+QUEUE_SIZE = 2
+
+_DONE = object()
+
+
+def _produce(batches, sample_fn, M_max, out, stop):
+    """
+    Sampling worker of pipeline: puts (batch, y_preds) in out, then _DONE,
+    or the exception raised by sample_fn
+    """
+    def put(item):
+        # Time out regularly, so the worker stops when the consumer failed
+        while not stop.is_set():
+            try:
+                out.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    try:
+        # no_grad is thread local
+        with torch.no_grad():
+            for batch in batches:
+                if not put((batch, sample_fn(batch, M_max))):
+                    return
+    except BaseException as e:
+        put(e)
+        return
+    put(_DONE)
+
+
+def pipeline(batches, sample_fn, M_max, queue_size=QUEUE_SIZE):
+    """
+    Yields (batch, sample_fn(batch, M_max)) for each batch. The sampling
+    runs in a worker thread, at most queue_size batches ahead, so the
+    sampling of the next batches overlaps the solves of the current one
+    (torch and the LP solver release the GIL). The batches are sampled in
+    order by a single worker, so the random draws are the same as in a
+    sequential loop as long as the consumer does not draw random numbers.
+    """
+    out = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    worker = threading.Thread(
+        target=_produce, args=(batches, sample_fn, M_max, out, stop),
+        daemon=True)
+    worker.start()
+    try:
+        while True:
+            item = out.get()
+            if item is _DONE:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        worker.join()
+
+
+def evaluate_prefixes(batches, sample_fn, M_values, metrics_fn, base_fn=None,
+                      queue_size=QUEUE_SIZE, weight_fn=None):
+    """
+    Evaluates the decisions of every M of M_values in one pass over the
+    test batches. For each batch, sample_fn(batch, max(M_values)) draws
+    the predictive samples once (samples in the first dimension) and
+    metrics_fn(M, y_preds[:M], batch) computes the metrics of M (dict of
+    scalars, or of vectors such as one value per cost ratio) from the 
+    first M samples, so the draws of the M values are nested. 
+    base_fn(batch) computes the metrics that do not depend on M (e.g. the 
+    best and fair costs) once per batch.
+    The sampling of the next batches runs in a worker thread while the
+    metrics (the solves) of the current batch are computed, see pipeline;
+    queue_size=0 runs both in sequence.
+    Returns a DataFrame with one row per M, in the order of M_values, with
+    the metrics averaged over the batches, weighted by weight_fn(batch) if
+    given (e.g. the number of test batches in a batch of batches).
+    """
+    if len(M_values) == 0:
+        return pd.DataFrame(columns=['M'])
+    M_max = max(M_values)
+    if queue_size > 0:
+        sampled = pipeline(batches, sample_fn, M_max, queue_size)
+    else:
+        sampled = ((batch, sample_fn(batch, M_max)) for batch in batches)
+
+    totals = {M: {} for M in M_values}
+    n_batches = 0
+    with torch.no_grad():
+        for batch, y_preds in sampled:
+            weight = weight_fn(batch) if weight_fn is not None else 1
+            base = base_fn(batch) if base_fn is not None else {}
+            for M in M_values:
+                metrics = dict(base, **metrics_fn(M, y_preds[:M], batch))
+                for name, value in metrics.items():
+                    # Vectors (e.g. one value per cost ratio) as arrays
+                    if torch.is_tensor(value):
+                        value = value.item() if value.dim() == 0 \
+                        else value.cpu().numpy()
+                    totals[M][name] = totals[M].get(name, 0) + weight*value
+            n_batches += weight
+
+    rows = [dict({name: total/n_batches for name, total in totals[M].items()},
+                 M=M) for M in M_values]
+    return pd.DataFrame(rows)
@@ -0,0 +1,257 @@
+import functools
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.multiprocessing as mp
+
+import artifact_cache
+import parallel_utils
+
+
+class TrialPruned(Exception):
+    """
+    Raised by the epoch callback to stop a weak trial
+    """
+
+
+class TrialFinished(Exception):
+    """
+    Raised by the epoch callback after the last epoch of a trial, so the
+    experiment script stops before evaluating on the test set
+    """
+
+
+# Default search space of the knobs hard-coded in the run_* functions.
+# Each entry is ('log', low, high), ('uniform', low, high) or a list
+# of choices.
+DEFAULT_SPACE = {
+    'lr': ('log', 1e-5, 1e-2),
+    'explr': ('uniform', 0.95, 1.0),
+    'K': ('log', 1e-3, 1e3),
+}
+
+
+def apply_overrides(hparams, method_name, lr, explr, EPOCHS, K=None):
+    """
+    Hard-coded hyperparameters of an experiment script, replaced by the
+    ones in hparams (see make_objective) for the ann and bnn methods; K
+    is only replaced for bnn. Returns (lr, explr, EPOCHS, K).
+    """
+    if hparams is None or method_name not in ['ann','bnn']:
+        return lr, explr, EPOCHS, K
+    if method_name == 'bnn':
+        K = hparams.get('K', K)
+    return (hparams.get('lr', lr), hparams.get('explr', explr),
+            hparams.get('EPOCHS', EPOCHS), K)
+
+
+def sample_hparams(space, n_trials, seed=0):
+    """
+    Random configurations from the search space
+    """
+    rng = np.random.RandomState(seed)
+    configs = []
+    for _ in range(0, n_trials):
+        config = {}
+        for name, dist in space.items():
+            if isinstance(dist, list):
+                config[name] = dist[rng.randint(len(dist))]
+            elif dist[0] == 'log':
+                config[name] = float(np.exp(rng.uniform(
+                    np.log(dist[1]), np.log(dist[2]))))
+            elif dist[0] == 'uniform':
+                config[name] = float(rng.uniform(dist[1], dist[2]))
+            else:
+                raise ValueError(f'Unknown distribution {dist[0]}')
+        configs.append(config)
+    return configs
+
+
+def get_rungs(min_epochs, max_epochs, eta):
+    """
+    Epochs at which trials are compared: min_epochs*eta^k < max_epochs
+    """
+    rungs = []
+    r = min_epochs
+    while r < max_epochs:
+        rungs.append(r)
+        r = r*eta
+    return rungs
+
+
+class ASHACallback():
+    """
+    Epoch callback of one trial with the Asynchronous Successive Halving
+    rule: when a trial reaches a rung, its best validation loss is
+    recorded and the trial only continues if it is in the top 1/eta of
+    all the losses recorded so far at that rung. The losses are the
+    validation data (or end) losses without the K-scaled KL term (see
+    train.py), so trials with different K are compared on the same scale.
+    """
+    def __init__(self, trial_id, rungs, max_epochs, eta,
+                 rung_losses, lock):
+        self.trial_id = trial_id
+        self.rungs = rungs
+        self.max_epochs = max_epochs
+        self.eta = eta
+        self.rung_losses = rung_losses # shared between the workers
+        self.lock = lock
+        self.best_loss = np.inf
+        self.epochs = 0
+
+    def __call__(self, epoch, valid_loss):
+        self.epochs = epoch + 1
+        self.best_loss = min(self.best_loss, valid_loss)
+
+        if self.epochs in self.rungs:
+            with self.lock:
+                losses = self.rung_losses.get(self.epochs, []) \
+                + [self.best_loss]
+                self.rung_losses[self.epochs] = losses
+            n_top = max(1, len(losses)//self.eta)
+            if self.best_loss > sorted(losses)[n_top - 1]:
+                raise TrialPruned()
+
+        if self.epochs >= self.max_epochs:
+            raise TrialFinished()
+        return False
+
+
+def _run_trial(objective, trial_id, hparams, rungs, max_epochs, eta,
+               rung_losses, lock):
+    # Trials must train, so the model cache is not used during the search
+    cache_env = os.environ.get(artifact_cache.CACHE_ENABLED_ENV)
+    os.environ[artifact_cache.CACHE_ENABLED_ENV] = '0'
+
+    callback = ASHACallback(
+        trial_id, rungs, max_epochs, eta, rung_losses, lock)
+    pruned = False
+    try:
+        objective(hparams=dict(hparams, EPOCHS=max_epochs),
+                  epoch_callback=callback)
+    except TrialPruned:
+        pruned = True
+    except TrialFinished:
+        pass
+    finally:
+        if cache_env is None:
+            os.environ.pop(artifact_cache.CACHE_ENABLED_ENV)
+        else:
+            os.environ[artifact_cache.CACHE_ENABLED_ENV] = cache_env
+
+    print(f'Trial {trial_id} {hparams}: loss {callback.best_loss} '
+          f'after {callback.epochs} epochs', '(pruned)' if pruned else '')
+    return dict(hparams, trial=trial_id, loss=callback.best_loss,
+                epochs=callback.epochs, pruned=pruned)
+
+
+def asha_search(objective, space=DEFAULT_SPACE, n_trials=27,
+                max_epochs=81, min_epochs=1, eta=3, n_jobs=None, seed=0):
+    """
+    Search the hyperparameters with Asynchronous Successive Halving.
+    objective(hparams, epoch_callback) must train a model with the
+    hyperparameters hparams (lr, explr, K, EPOCHS) and call
+    epoch_callback(epoch, valid_loss) after every epoch with a loss that
+    does not depend on K, as the run_*
+    functions of the experiment scripts do. Trials run in a process
+    pool of n_jobs workers (see parallel_utils) and weak trials are
+    stopped at the rungs min_epochs*eta^k.
+    Returns two DataFrames: the completed trials sorted by their
+    validation loss after max_epochs, and the pruned trials sorted by
+    the rung they reached (epochs) and their loss at it. Losses of
+    different rungs are not comparable, so only completed trials are
+    ranked against each other.
+    """
+    rungs = get_rungs(min_epochs, max_epochs, eta)
+    configs = sample_hparams(space, n_trials, seed)
+
+    manager = mp.get_context('spawn').Manager()
+    rung_losses = manager.dict()
+    lock = manager.Lock()
+
+    results = parallel_utils.run_parallel(
+        _run_trial,
+        [dict(objective=objective, trial_id=i, hparams=config,
+              rungs=rungs, max_epochs=max_epochs, eta=eta,
+              rung_losses=rung_losses, lock=lock)
+         for i, config in enumerate(configs)],
+        n_jobs=n_jobs)
+    manager.shutdown()
+
+    df_trials = pd.DataFrame(results)
+    df_completed = df_trials[~df_trials['pruned']].sort_values('loss')
+    df_pruned = df_trials[df_trials['pruned']].sort_values(
+        ['epochs', 'loss'], ascending=[False, True])
+    return df_completed, df_pruned
+
+
+def make_objective(script, args, dev):
+    """
+    Objective of the search for an experiment script with its command
+    line arguments (without the number of seeds), e.g.
+    classic_newsvendor bnn decoupled gaussian 16
+    """
+    if script == 'classic_newsvendor':
+        import classic_newsvendor
+        method_name, method_learning, noise_type, N_SAMPLES = args
+        return functools.partial(
+            classic_newsvendor.run_classic_newsvendor,
+            method_name=method_name, method_learning=method_learning,
+            noise_type=noise_type, seed_number=0,
+            aleat_bool=method_name!='ann', N_SAMPLES=int(N_SAMPLES),
+            M_SAMPLES=[], dev=dev)
+
+    if script == 'constrained_newsvendor':
+        import constrained_newsvendor
+        method_name, method_learning, N_SAMPLES = args
+        return functools.partial(
+            constrained_newsvendor.run_constrained_newsvendor,
+            method_name=method_name, method_learning=method_learning,
+            seed_number=0, aleat_bool=method_name!='ann',
+            N_SAMPLES=int(N_SAMPLES), M_SAMPLES=[], dev=dev)
+
+    if script == 'minmaxportfolio':
+        import minmaxportfolio
+        method_name, method_learning, N_SAMPLES, N_ASSETS = args
+        return functools.partial(
+            minmaxportfolio.run_minimax_op,
+            method_name=method_name, method_learning=method_learning,
+            seed_number=0, N_SAMPLES=int(N_SAMPLES), M_SAMPLES=[],
+            N_ASSETS=int(N_ASSETS), N_train=1500, EPOCHS=150, dev=dev)
+
+    raise ValueError(f'Search not available for {script}')
+
+
+if __name__ == '__main__':
+
+    dev = torch.device('cpu')
+    if torch.cuda.is_available():
+        dev = torch.device('cuda')
+
+    script = sys.argv[1] # experiment script name, e.g. classic_newsvendor
+    n_trials = int(sys.argv[2]) # number of sampled configurations
+    max_epochs = int(sys.argv[3]) # epochs of the trials that are not pruned
+    args = sys.argv[4:] # arguments of the script (without nr of seeds)
+
+    space = dict(DEFAULT_SPACE)
+    if args[0] != 'bnn':
+        space.pop('K')
+
+    objective = make_objective(script, args, dev)
+    df_completed, df_pruned = asha_search(
+        objective, space, n_trials=n_trials, max_epochs=max_epochs)
+
+    print('---------------------------------------------------')
+    print('-----------------Best trials-----------------------')
+    print(df_completed.head(10).to_string(index=False))
+    print('-----------------Pruned trials---------------------')
+    print(df_pruned.to_string(index=False))
+
+    if not os.path.isdir("./hparam_results"):
+        os.makedirs("./hparam_results")
+    results_name = f'./hparam_results/{script}_{"_".join(args)}'
+    df_completed.to_csv(f'{results_name}.csv', index=False)
+    df_pruned.to_csv(f'{results_name}_pruned.csv', index=False)
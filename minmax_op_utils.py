@@ -1,23 +1,66 @@
+import functools
+import time
+
 import torch
 from qpth.qp import QPFunction
 
-from mip import Model as ModelMip, xsum, minimize, maximize, \
-INTEGER, BINARY, CONTINUOUS, CutType, OptimizationStatus
-
 import numpy as np
+from scipy import sparse
+from scipy.optimize import linprog
+
+try:
+    import highspy
+except ImportError:
+    highspy = None
+
+import dtype_utils
+import parallel_utils
+import qp_utils
 
 
 class RiskPortOP():
     """
     Risk Portfolio    
     Init with deterministic parameters params_t and solve it for n_samples.
+    solver='qpth' solves the QP with qpth and solver='cached' caches the 
+    constant parts of its factorization (see qp_utils.DenseQP).
+    solver='smooth' eliminates the shortfall variables u and solves over 
+    the n_assets weights only, with a smoothed hinge (see solve_smooth); 
+    smoothing is the width of the hinge relative to the scale of Y_dist.
+    eps, max_iter and dtype are the tolerance, iteration cap and precision 
+    of the solver (None for the defaults, the dtype default is given by 
+    dtype_utils.get_solver_dtype).
+    After eval() the portfolios are solved exactly without autograd (see 
+    forward_eval) until train() is called.
+    There is no scenario reduction: the portfolio risk depends on the tail 
+    of the losses, which k-means clusters (scenario_utils) wash out.
+    With eval_tol set, the exact LPs of forward_true and forward_eval are 
+    replaced by the batched PDHG of pdhg_argmins, stopped at a certified 
+    relative duality gap of eval_tol; the rows it does not certify are 
+    solved exactly.
     """
-    def __init__(self, n_samples, n_assets, min_return, Y_train, dev):
+    def __init__(self, n_samples, n_assets, min_return, Y_train, dev, 
+                 solver='qpth', eps=None, max_iter=None, dtype=None, 
+                 smoothing=1e-2, eval_tol=None):
         super(RiskPortOP, self).__init__()
+        
+        assert solver in ['qpth', 'cached', 'smooth']
             
         self.dev = dev    
+        self.solver = solver
+        if dtype is None:
+            dtype = dtype_utils.get_solver_dtype()
+        self.dtype = dtype
+        if solver == 'qpth':
+            self.eps, self.max_iter = 1e-12, 20 # qpth defaults
+        elif solver == 'smooth':
+            self.eps, self.max_iter = 1e-6, 5000
+        else:
+            self.eps, self.max_iter = 1e-11, 50
         self.N = n_assets
         self.M = n_samples
+        self.smoothing = smoothing
+        self.eval_tol = eval_tol
         
         self.R = torch.tensor(min_return) .to(self.dev)
         self.uy = torch.clip(Y_train.mean(axis=0), torch.tensor(0.01), None).to(self.dev)
@@ -54,9 +97,82 @@ class RiskPortOP():
         
 
         
-        self.e = torch.DoubleTensor().to(self.dev)
+        self.e = torch.tensor([], dtype=dtype).to(self.dev)
+        
+        # Only the block of the max inequalities depends on Y_dist
+        if solver == 'cached':
+            self.qp = qp_utils.DenseQP(
+                2*self.Q, self.ineqs, self.eps, self.max_iter, dtype)
+        self.set_tolerance(eps, max_iter)
+        self.n_iter = 0 # Iterations of the last solve (cached)
+        self.warm_cache = None # Solutions per dataset index (init_warm_start)
+        self.warm_idx = None # Dataset indices of the next batch
+        self.training = True # Differentiable solves (see train and eval)
+        self.pdhg_warm = None # Last solution of pdhg_argmins
+        
+        
+        
+    def set_tolerance(self, eps=None, max_iter=None):
+        """
+        Tolerance and iteration cap of the next solves (None keeps the value)
+        """
+        if eps is not None:
+            self.eps = eps
+        if max_iter is not None:
+            self.max_iter = max_iter
+        if hasattr(self, 'qp'):
+            self.qp.eps, self.qp.max_iter = self.eps, self.max_iter
+        
+    def init_warm_start(self, n_data):
+        """
+        Allocates the cache of solutions of a dataset of n_data samples, 
+        used to warm-start the solves of the batches given by 
+        set_warm_start_index. Not available for the qpth solver.
+        """
+        if self.solver == 'smooth':
+            sizes = {'p': self.N}
+        elif self.solver == 'cached':
+            n_ineq = self.ineqs.shape[0] + self.M
+            sizes = {'x': self.M + self.N, 's': n_ineq, 'lam': n_ineq}
+        else:
+            return
+        self.warm_cache = qp_utils.WarmStartCache(n_data, sizes, self.dev)
+        
+    def set_warm_start_index(self, idx):
+        """
+        Dataset indices of the samples of the next forward, None to 
+        solve without warm start (e.g. validation)
+        """
+        self.warm_idx = idx
+        
+    def get_warm_start(self, batch_size):
+        if self.warm_cache is None or self.warm_idx is None:
+            return None
+        assert len(self.warm_idx) == batch_size
+        return self.warm_cache, self.warm_idx
+        
+    def train(self, mode=True):
+        """
+        Solves with the differentiable solver (mode=True) or with 
+        forward_eval (mode=False)
+        """
+        self.training = mode
+        return self
         
+    def eval(self):
+        return self.train(False)
         
+    def forward_eval(self, Y_dist, weights=None):
+        """
+        Solves the LP of each batch element exactly (forward_true, without 
+        the quadratic terms and autograd of the QP) and returns ustar, zstar 
+        as forward does
+        """
+        if weights is not None:
+            weights = weights.detach().cpu().numpy()
+        argmins = self.true_argmins(Y_dist.detach().cpu().numpy(), weights)
+        argmins = torch.tensor(argmins, dtype=self.dtype).to(self.dev)
+        return argmins[:, :self.M], argmins[:, self.M:]
         
     def forward(self, Y_dist):
         """
@@ -72,7 +188,14 @@ class RiskPortOP():
         assert self.N == n_assets
         
         assert self.M == n_samples
-              
+        
+        if not self.training:
+            return self.forward_eval(Y_dist)
+        
+        if self.solver == 'smooth':
+            zstar = SmoothPortfolioFunction.apply(Y_dist, self, None)
+            ustar = torch.relu(-(Y_dist.to(zstar.dtype)*zstar.unsqueeze(1)).sum(-1))
+            return ustar, zstar
 
 
         Q = self.Q
@@ -84,18 +207,24 @@ class RiskPortOP():
         # max ineq
         unc_ineq = torch.dstack(( -self.eyeM.expand(batch_size, self.M, self.M), 
                                   -Y_dist ))        
-        ineqs = torch.unsqueeze(self.ineqs, dim=0)
-        ineqs = ineqs.expand(batch_size, ineqs.shape[1], ineqs.shape[2])
-
-            
-        ineqs = torch.hstack(( ineqs, unc_ineq ))
         
         bounds = self.bounds.unsqueeze(dim=0).expand(
             batch_size, self.bounds.shape[0])
 
-        argmin = QPFunction(verbose=-1)\
-            (2*Q.double(), lin.double(), ineqs.double(), 
-             bounds.double(), self.e, self.e).double()
+        if self.solver == 'cached':
+            argmin = qp_utils.DenseQPFunction.apply(
+                lin, bounds, unc_ineq, self.qp, 
+                self.get_warm_start(batch_size))
+            self.n_iter = self.qp.n_iter
+        else:
+            ineqs = torch.unsqueeze(self.ineqs, dim=0)
+            ineqs = ineqs.expand(batch_size, ineqs.shape[1], ineqs.shape[2])
+                
+            ineqs = torch.hstack(( ineqs, unc_ineq ))
+            
+            argmin = QPFunction(verbose=-1, eps=self.eps, maxIter=self.max_iter)\
+                (2*Q.to(self.dtype), lin.to(self.dtype), ineqs.to(self.dtype), 
+                 bounds.to(self.dtype), self.e, self.e)
         
         ustar = argmin[:, :self.M]
         zstar = argmin[:, self.M:]    
@@ -107,12 +236,64 @@ class RiskPortOP():
             print("Warning solver")
             
         if not torch.all(zstar >= -0.01):
-            zstar = torch.where(zstar<-0.01, self.R/self.uy.sum().double(), zstar)
+            zstar = torch.where(zstar<-0.01, self.R/self.uy.sum().to(zstar.dtype), zstar)
             print("Projecting zstar to feasibility")
                   
         return ustar, zstar
     
     
+    def smooth_objective(self, Y, weights=None):
+        """
+        Scale of the hinge, weights of the scenarios and weight of the 
+        quadratic term of the smoothed problem of solve_smooth
+        """
+        tau = self.smoothing*Y.pow(2).mean((1, 2)).sqrt().unsqueeze(-1)
+        tau = torch.clamp(tau, min=torch.finfo(Y.dtype).eps)
+        if weights is None:
+            w = torch.full(Y.shape[:2], 1/Y.shape[1], dtype=Y.dtype, 
+                           device=Y.device)
+        else:
+            w = weights.detach().to(Y.dtype)
+        gamma = 2*0.001/self.N # same as the term of z in the QP
+        return tau, w, gamma
+    
+    def solve_smooth(self, Y, weights=None, p_warm=None, warm_mask=None):
+        """
+        Solves the portfolio problem over the weights only. The shortfalls 
+        u_m = max(0, -y_m.z) are eliminated and, with z = R*p, the problem 
+        becomes
+            min_p  sum_m w_m h(-y_m.p) + gamma/2 |p|^2  s.t. p >= 0, uy.p = 1
+        where h is the hinge smoothed by a softplus of width tau. It is 
+        solved by projected accelerated gradient (FISTA with adaptive 
+        restart, see project_return), O(M*n_assets) per iteration instead 
+        of the O((M + n_assets)^3) of the QP. p_warm (e.g. the solution of 
+        the previous epoch) is the starting point of the batch elements in 
+        warm_mask. Returns p.
+        """
+        Y = Y.detach().to(self.dtype)
+        tau, w, gamma = self.smooth_objective(Y, weights)
+        uy = self.uy.to(self.dtype)
+        # Lipschitz constant of the gradient
+        L = (w*Y.pow(2).sum(-1)).sum(-1, keepdim=True)/(4*tau) + gamma
+        
+        p = project_return(torch.zeros_like(Y[:, 0]), uy)
+        if p_warm is not None:
+            p = torch.where(warm_mask.unsqueeze(-1), p_warm.to(p.dtype), p)
+        p_prev, q, t = p, p, 1
+        self.n_iter = 0
+        for _ in range(0, self.max_iter):
+            self.n_iter += 1
+            sig = torch.sigmoid(-(Y@q.unsqueeze(-1)).squeeze(-1)/tau)
+            grad = -(Y*(w*sig).unsqueeze(-1)).sum(1) + gamma*q
+            p = project_return(q - grad/L, uy)
+            if (L*(p - q)).abs().max() < self.eps:
+                break
+            t_next = (1 + (1 + 4*t*t)**0.5)/2
+            restart = ((q - p)*(p - p_prev)).sum(-1, keepdim=True) > 0
+            q = torch.where(restart, p, p + (t - 1)/t_next*(p - p_prev))
+            p_prev, t = p, t_next
+        return p
+    
     def risk_loss_dataset(self, Y_dist, zstar_pred):        
         loss_portfolio = -(Y_dist*zstar_pred.unsqueeze(1)).sum(2)
         u = loss_portfolio.squeeze()    
@@ -148,56 +329,455 @@ class RiskPortOP():
     
     
     def min_true_sample(self, y):
+        uy = self.uy.cpu().detach().numpy()
+        R = self.R.cpu().detach().numpy()
+        assert self.N == y.shape[1]
+        return min_true_sample(y, uy, R)
     
-        n_samples = y.shape[0]
-        n_assets = y.shape[1]
-        
+    def true_argmins(self, Y_dist, weights=None):
+        """
+        Solutions (ustar, zstar) of the LPs of the rows of Y_dist (numpy) 
+        with the scenario weights (numpy, None if equally likely), split 
+        over parallel_utils.get_eval_jobs() processes, or all at once by 
+        pdhg_argmins if eval_tol is set
+        """
+        if self.eval_tol is not None:
+            return self.pdhg_argmins(Y_dist, weights)
+        return self.exact_argmins(Y_dist, weights)
+    
+    def exact_argmins(self, Y_dist, weights=None):
+        """
+        true_argmins solved exactly, one LP per row
+        """
         uy = self.uy.cpu().detach().numpy()
         R = self.R.cpu().detach().numpy()
+        arrays = (Y_dist,) if weights is None else (Y_dist, weights)
+        return parallel_utils.map_chunks(
+            functools.partial(true_argmins, uy, R), arrays)
+    
+    def pdhg_argmins(self, Y_dist, weights=None):
+        """
+        true_argmins solved by pdhg on the device of the solver. The rows 
+        whose gap is not certified below eval_tol are solved exactly 
+        (exact_argmins). The solution is kept to warm-start the next call 
+        with the same shape (e.g. the same rows with a tighter eval_tol).
+        """
+        Y = torch.as_tensor(Y_dist).to(self.dev, self.dtype)
+        if weights is not None:
+            weights = torch.as_tensor(weights).to(self.dev, self.dtype)
+        p0, lam0 = None, None
+        if self.pdhg_warm is not None and self.pdhg_warm[1].shape == Y.shape[:2]:
+            p0, lam0 = self.pdhg_warm
+        uy = self.uy.to(self.dtype)
+        p, lam, gap, self.n_iter = pdhg(
+            Y, uy, weights, self.eval_tol, p0=p0, lam0=lam0)
+        self.pdhg_warm = (p, lam)
+        zstar = self.R.to(self.dtype)*p
+        ustar = torch.relu(-(Y*zstar.unsqueeze(1)).sum(-1))
+        argmins = torch.hstack((ustar, zstar)).cpu().numpy()
         
-        assert self.N == n_assets
-           
-        m = ModelMip("cvar")
-        m.verbose = 0
-        z = ([m.add_var(var_type=CONTINUOUS, name=f'z_{i}') for i in range(0, n_assets)])
-        u = ([m.add_var(var_type=CONTINUOUS, name=f'u_{i}') for i in range(0, n_samples)])
-
-        m.objective = minimize((1/n_samples)*xsum(u[i] for i in range(0, n_samples)))
-
-        for i in range(0, n_assets):
-            m += z[i] >= 0
+        failed = (gap > self.eval_tol).cpu().numpy()
+        if failed.any():
+            argmins[failed] = self.exact_argmins(
+                np.asarray(Y_dist)[failed], 
+                None if weights is None else weights.cpu().numpy()[failed])
+        return argmins
+    
+    def forward_true(self, Y_dist):
+        return self.true_argmins(Y_dist)[:, Y_dist.shape[1]:]
 
-        for i in range(0, n_samples):
-            m += u[i] >= 0
 
-        for i in range(0, n_samples):
-            m += xsum(z[j]*y[i][j] for j in range(0, n_assets)) + u[i] >= 0
+def project_return(v, a):
+    """
+    Euclidean projection of the rows of v (batch x n) onto 
+    {p >= 0, a.p = 1} with a > 0: p = max(0, v - theta*a), where theta is 
+    found exactly from the sorted breakpoints v/a
+    """
+    t = v/a
+    t_sorted, order = t.sort(-1, descending=True)
+    a_sorted = a.expand_as(v).gather(-1, order)
+    v_sorted = v.gather(-1, order)
+    theta = ((a_sorted*v_sorted).cumsum(-1) - 1)/(a_sorted*a_sorted).cumsum(-1)
+    # The valid numbers of positive entries are a prefix, take the last one
+    k = (theta < t_sorted).sum(-1, keepdim=True) - 1
+    theta = theta.gather(-1, k.clamp(min=0))
+    return torch.clamp(v - theta*a, min=0)
 
-        m += xsum(-z[i]*uy[i] for i in range(0, n_assets)) <= -R
 
-        m.optimize()
-        f_opt = m.objective_value
-        argmins = []
-        for v in m.vars:
-            argmins.append(v.x)
-           
-        zstar = argmins[:n_assets]
-        ustar = argmins[n_assets:]
+def consistent_multipliers(Y, uy, w, p, lam, tol):
+    """
+    Multipliers of the shortfalls consistent with the optimality of p: w 
+    on the scenarios with a shortfall (y_m.p < -tol), 0 on those with 
+    y_m.p > tol, and on the scenarios at the kink the nearest values to 
+    lam such that (-Y'lam)_j/uy_j is the same for all the assets held by 
+    p, clipped to [0, w]. Any lam in [0, w] gives a dual bound, this one 
+    is tight when the kink and the assets of the optimum are identified.
+    """
+    Yp = (Y@p.unsqueeze(-1)).squeeze(-1)
+    kink = Yp.abs() <= tol
+    lam0 = torch.where(kink, lam, torch.where(Yp < 0, w, torch.zeros_like(w)))
+    held = p > 1e-6*p.amax(-1, keepdim=True)
+    # Minimum norm correction of (lam0, mu0) on the kink such that 
+    # -Y_j'lam - mu*uy_j = 0 for the held assets j: with A the matrix of 
+    # these equations, d = A'(AA')^-1 r
+    Ylam = -(Y.transpose(1, 2)@lam0.unsqueeze(-1)).squeeze(-1)
+    mu0 = (Ylam/uy).min(-1, keepdim=True)[0]
+    r = -(Ylam - mu0*uy)*held
+    Y_kink = Y*kink.unsqueeze(-1)
+    held_pairs = held.unsqueeze(-1) & held.unsqueeze(1)
+    G = (Y_kink.transpose(1, 2)@Y_kink + torch.outer(uy, uy))*held_pairs \
+        + torch.diag_embed((~held).to(Y.dtype))
+    G = G + 1e-12*G.diagonal(dim1=1, dim2=2).sum(-1)[:, None, None] \
+        *torch.eye(G.shape[-1], dtype=Y.dtype, device=Y.device)
+    x = torch.linalg.solve(G, r.unsqueeze(-1))*held.unsqueeze(-1)
+    d = -(Y_kink@x).squeeze(-1)
+    return torch.clamp(lam0 + d, min=torch.zeros_like(w), max=w)
 
-        return ustar, zstar
-    
-    
-    def forward_true(self, Y_dist):
-        zstar = np.zeros_like(Y_dist[:,0,:])
-        for i in range(0, Y_dist.shape[0]):
-            _ , zstar[i,:] = self.min_true_sample(Y_dist[i,:,:])       
-        return zstar
 
+def pdhg(Y, uy, weights=None, eps=1e-3, max_iter=2000, check_every=64, 
+         stall_checks=8, p0=None, lam0=None):
+    """
+    Batched primal-dual hybrid gradient (Chambolle-Pock) for the LPs of 
+    all the rows of Y (batch x M x n_assets) at once. With z = R*p and the 
+    shortfalls eliminated, each LP is the saddle point problem
+        min_p max_lam  -lam'Y p   s.t.  p >= 0, uy.p = 1,  0 <= lam <= w
+    The primal value P(p) = sum_m w_m max(0, -y_m.p) and the dual value 
+    D(lam) = min_j (-Y'lam)_j/uy_j bound the optimum from both sides, so 
+    P - D certifies the accuracy of p. D is taken at the best of the dual 
+    iterate and of its projections onto the multipliers consistent with 
+    p (see consistent_multipliers).
+    Every check_every iterations each row restarts from the better of its 
+    current and average (since its last restart) iterates when the 
+    relative gap (P - D)/|P| has decreased enough since the last restart 
+    (adaptive restarts), and the ratio of the primal and dual steps is 
+    rebalanced from the distances travelled by p and lam since then. The rows whose relative gap is 
+    below eps are frozen, and so are the rows without a restart in the 
+    last stall_checks checks (stalled), to be solved exactly by the 
+    caller. p0 and lam0 warm-start the iterates.
+    Returns p, lam, the relative gap of each row and the iterations.
+    """
+    batch_size, M, n_assets = Y.shape
+    w = torch.full((batch_size, M), 1/M, dtype=Y.dtype, device=Y.device) \
+        if weights is None else weights.to(Y.dtype)
+    p = project_return(torch.zeros_like(Y[:, 0]), uy) if p0 is None else p0.clone()
+    lam = torch.zeros_like(w) if lam0 is None else lam0.clone()
+    # Gaps of P close to 0 are measured relative to the scale of the losses
+    scale = 1e-6*Y.pow(2).mean((1, 2)).sqrt()/uy.mean()
     
+    # Step sizes tau*sigma < 1/|Y|^2 with |Y| from power iterations, 
+    # tau = eta/omega and sigma = eta*omega with the primal weight omega
+    v = torch.ones_like(Y[:, 0]).unsqueeze(-1)
+    for _ in range(0, 20):
+        v = Y.transpose(1, 2)@(Y@v)
+        v = v/torch.clamp(v.norm(dim=1, keepdim=True), min=1e-30)
+    eta = 0.9/torch.clamp((Y@v).norm(dim=1), min=1e-30)
+    omega = (w.norm(dim=1)/p.norm(dim=1)).unsqueeze(-1)
     
+    def values(p, lam, tight=True):
+        Yp = (Y_a@p.unsqueeze(-1)).squeeze(-1)
+        P = (w_a*torch.relu(-Yp)).sum(-1)
+        # Best dual value of lam and (if tight) of its projections for a 
+        # few widths of the kink (see consistent_multipliers)
+        Yp_scale = Yp.abs().mean(-1, keepdim=True)
+        lams = [lam] + [consistent_multipliers(Y_a, uy, w_a, p, lam, 
+                                               tol*Yp_scale) 
+                        for tol in ([1e-6, 1e-4, 1e-2] if tight else [])]
+        D = torch.stack([
+            (-(Y_a.transpose(1, 2)@l.unsqueeze(-1)).squeeze(-1)/uy).min(-1)[0]
+            for l in lams]).max(0)[0]
+        return (P - D)/torch.maximum(P.abs(), scale_a)
     
+    gap = torch.full((batch_size,), float('inf'), dtype=Y.dtype, device=Y.device)
+    active = torch.arange(batch_size, device=Y.device)
+    Y_a, w_a, scale_a = Y, w, scale
+    eta_a, omega_a = eta, omega
+    p_a, lam_a = p, lam
+    # Iterates and gaps at the last restart, gaps at the last check
+    p_r, lam_r = p_a.clone(), lam_a.clone()
+    gap_r = values(p_a, lam_a)
+    gap_prev = gap_r.clone()
+    n_checks = torch.zeros_like(gap_r, dtype=torch.long) # since the restart
+    p_sum, lam_sum = torch.zeros_like(p_a), torch.zeros_like(lam_a)
+    n_sum = torch.zeros_like(gap_r).unsqueeze(-1)
+    n_iter = 0
+    for n_iter in range(1, max_iter + 1):
+        p_next = project_return(
+            p_a + (eta_a/omega_a)*(Y_a.transpose(1, 2)@lam_a.unsqueeze(-1)).squeeze(-1), uy)
+        lam_a = torch.clamp(
+            lam_a - (eta_a*omega_a)*(Y_a@(2*p_next - p_a).unsqueeze(-1)).squeeze(-1), 
+            min=torch.zeros_like(w_a), max=w_a)
+        p_a = p_next
+        p_sum += p_a
+        lam_sum += lam_a
+        n_sum += 1
+        if n_iter % check_every > 0 and n_iter < max_iter:
+            continue
+        
+        # Candidate of each row: the current or the average iterate, 
+        # whichever has the smaller gap without projection
+        p_avg, lam_avg = p_sum/n_sum, lam_sum/n_sum
+        use_avg = (values(p_avg, lam_avg, False) 
+                   < values(p_a, lam_a, False)).unsqueeze(-1)
+        p_c = torch.where(use_avg, p_avg, p_a)
+        lam_c = torch.where(use_avg, lam_avg, lam_a)
+        gap_c = values(p_c, lam_c)
+        p[active], lam[active], gap[active] = p_c, lam_c, gap_c
+        
+        # Restart on a sufficient decrease of the gap, or on a smaller 
+        # decrease that stopped improving
+        restart = (gap_c <= 0.2*gap_r) \
+            | ((gap_c <= 0.8*gap_r) & (gap_c > gap_prev))
+        d_p = (p_c - p_r).norm(dim=1, keepdim=True)
+        d_lam = (lam_c - lam_r).norm(dim=1, keepdim=True)
+        rebalance = restart.unsqueeze(-1) & (d_p > 1e-12) & (d_lam > 1e-12)
+        omega_a = torch.where(
+            rebalance, torch.sqrt(omega_a*d_lam/torch.clamp(d_p, min=1e-30)), 
+            omega_a)
+        r = restart.unsqueeze(-1)
+        p_a, lam_a = torch.where(r, p_c, p_a), torch.where(r, lam_c, lam_a)
+        p_r, lam_r = torch.where(r, p_c, p_r), torch.where(r, lam_c, lam_r)
+        # The averages restart with the iterates
+        p_sum = torch.where(r, torch.zeros_like(p_sum), p_sum)
+        lam_sum = torch.where(r, torch.zeros_like(lam_sum), lam_sum)
+        n_sum = torch.where(r, torch.zeros_like(n_sum), n_sum)
+        gap_r = torch.where(restart, gap_c, gap_r)
+        gap_prev = gap_c
+        n_checks = torch.where(restart, torch.zeros_like(n_checks), n_checks + 1)
+        
+        keep = (gap_c > eps) & (n_checks < stall_checks)
+        if not torch.any(keep):
+            break
+        active = active[keep]
+        Y_a, w_a, scale_a = Y[active], w[active], scale[active]
+        eta_a, omega_a = eta[active], omega_a[keep]
+        p_a, lam_a, p_r, lam_r = p_a[keep], lam_a[keep], p_r[keep], lam_r[keep]
+        p_sum, lam_sum, n_sum = p_sum[keep], lam_sum[keep], n_sum[keep]
+        gap_r, gap_prev, n_checks = gap_r[keep], gap_prev[keep], n_checks[keep]
+    return p, lam, gap, n_iter
+
+
+class SmoothPortfolioFunction(torch.autograd.Function):
+    """
+    Differentiable solver of the portfolio problem over the weights only 
+    (RiskPortOP.solve_smooth). The gradients come from implicit 
+    differentiation of the optimality conditions on the positive weights,
+    a system of n_assets + 1 equations per instance. The scenario weights 
+    and the width of the hinge are not differentiated.
+    """
+    @staticmethod
+    def forward(ctx, Y, solver, weights=None):
+        warm_start = solver.get_warm_start(Y.shape[0])
+        if warm_start is None:
+            p = solver.solve_smooth(Y, weights)
+        else:
+            cache, idx = warm_start
+            values, valid = cache.get(idx)
+            p = solver.solve_smooth(Y, weights, values['p'], valid)
+            cache.update(idx, p=p)
+        ctx.solver = solver
+        ctx.weights = weights
+        ctx.Y_dtype = Y.dtype
+        ctx.save_for_backward(Y.detach().to(solver.dtype), p)
+        return solver.R.to(p.dtype)*p
+
+    @staticmethod
+    def backward(ctx, grad_z):
+        Y, p = ctx.saved_tensors
+        solver = ctx.solver
+        tau, w, gamma = solver.smooth_objective(Y, ctx.weights)
+        uy = solver.uy.to(p.dtype)
+        g = solver.R.to(p.dtype)*grad_z.to(p.dtype)
+        
+        # On the positive weights, grad f(p) + nu*uy = 0 and uy.p = 1. The 
+        # system [H uy; uy' 0] is solved with identity rows for the zeros.
+        free = p > 0
+        sig = torch.sigmoid(-(Y@p.unsqueeze(-1)).squeeze(-1)/tau)
+        d_sig = w*sig*(1 - sig)/tau
+        H = Y.transpose(1, 2)@(d_sig.unsqueeze(-1)*Y)
+        H = H + gamma*torch.eye(solver.N, dtype=p.dtype, device=p.device)
+        mask = free.unsqueeze(-1) & free.unsqueeze(-2)
+        H = torch.where(mask, H, torch.diag_embed(torch.ones_like(p)))
+        a = torch.where(free, uy.expand_as(p), torch.zeros_like(p))
+        K = torch.cat((
+            torch.cat((H, a.unsqueeze(-1)), -1),
+            torch.cat((a, torch.zeros_like(a[:, :1])), -1).unsqueeze(1)), 1)
+        rhs = torch.cat((torch.where(free, g, torch.zeros_like(g)), 
+                         torch.zeros_like(g[:, :1])), -1)
+        v = torch.linalg.solve(K, rhs)[:, :solver.N]
+        
+        # grad_Y = -d(v.grad f(p, Y))/dY at fixed p
+        Yv = (Y@v.unsqueeze(-1)).squeeze(-1)
+        grad_Y = (w*sig).unsqueeze(-1)*v.unsqueeze(1) \
+            - (d_sig*Yv).unsqueeze(-1)*p.unsqueeze(1)
+        return grad_Y.to(ctx.Y_dtype), None, None
+
+
+def lp_matrices(y, uy, R, w=None):
+    """
+    Matrices of the LP of the scenarios y (n_samples x n_assets), built in 
+    bulk with numpy and scipy.sparse: the variables are x = [z, u] and the 
+    LP is min w.u s.t. -y z - u <= 0, -uy.z <= -R, x >= 0
+    """
+    n_samples, n_assets = y.shape
+    if w is None:
+        w = np.full(n_samples, 1/n_samples)
+    c = np.concatenate([np.zeros(n_assets), w])
+    A_ub = sparse.bmat(
+        [[sparse.csr_matrix(-y), -sparse.identity(n_samples)],
+         [-np.reshape(uy, (1, -1)), None]], format='csr')
+    b_ub = np.concatenate([np.zeros(n_samples), -np.reshape(R, -1)])
+    return c, A_ub, b_ub
+
+
+def min_true_sample(y, uy, R, w=None):
     
+    n_assets = y.shape[1]
+    c, A_ub, b_ub = lp_matrices(y, uy, R, w)
+    res = linprog(c, A_ub=A_ub, b_ub=b_ub, bounds=(0, None), method='highs')
+    if res.status != 0:
+        raise RuntimeError(f'Portfolio LP not solved: {res.message}')
+       
+    zstar = res.x[:n_assets]
+    ustar = res.x[n_assets:]
+
+    return ustar, zstar
+
+
+class PortfolioLP():
+    """
+    Persistent HiGHS model (highspy) of the LP of min_true_sample for the 
+    fixed uy, R and n_samples. The variables are x = [u, z]: the u columns, 
+    their costs and the rows are built once, and solve(y, w) only replaces 
+    the n_assets z columns (the coefficients y and uy, in one call) and the 
+    costs, then re-solves with the simplex.
+    """
     
+    def __init__(self, uy, R, n_samples):
+        self.n_samples = n_samples
+        self.n_assets = len(uy)
+        self.uy = np.asarray(uy, dtype=np.float64)
+        self.h = highspy.Highs()
+        self.h.setOptionValue('output_flag', False)
+        
+        inf = highspy.kHighsInf
+        # Rows -y_i z - u_i <= 0 and -uy z <= -R, the coefficients are set 
+        # by the columns
+        upper = np.concatenate([np.zeros(n_samples), -np.reshape(R, -1)])
+        self.h.addRows(
+            n_samples + 1, np.full(n_samples + 1, -inf), upper, 0, 
+            np.zeros(n_samples + 1, dtype=np.int32), 
+            np.zeros(0, dtype=np.int32), np.zeros(0))
+        rows = np.arange(n_samples, dtype=np.int32)
+        self.h.addCols(
+            n_samples, np.full(n_samples, 1/n_samples), np.zeros(n_samples), 
+            np.full(n_samples, inf), n_samples, rows, rows, 
+            -np.ones(n_samples))
+        
+        self.u_idx = rows
+        self.z_idx = np.arange(
+            n_samples, n_samples + self.n_assets, dtype=np.int32)
+        self.z_starts = np.arange(
+            self.n_assets, dtype=np.int32)*(n_samples + 1)
+        self.z_rows = np.tile(
+            np.arange(n_samples + 1, dtype=np.int32), self.n_assets)
+        self.has_z = False
+        
+    def solve(self, y, w=None):
+        """
+        Returns ustar, zstar of the scenarios y (n_samples x n_assets) with 
+        the weights w (uniform if None)
+        """
+        n_samples, n_assets = self.n_samples, self.n_assets
+        if w is None:
+            w = np.full(n_samples, 1/n_samples)
+        self.h.changeColsCost(n_samples, self.u_idx, np.asarray(w, np.float64))
+        
+        # One bulk replacement of the z columns (highspy has no bulk 
+        # changeCoeff, and one call per coefficient costs more than the 
+        # solve for hundreds of scenarios)
+        if self.has_z:
+            self.h.deleteCols(n_assets, self.z_idx)
+        values = np.vstack([-np.asarray(y, np.float64), -self.uy]).T.ravel()
+        self.h.addCols(
+            n_assets, np.zeros(n_assets), np.zeros(n_assets), 
+            np.full(n_assets, highspy.kHighsInf), len(values), 
+            self.z_starts, self.z_rows, values)
+        self.has_z = True
+        
+        self.h.run()
+        status = self.h.getModelStatus()
+        if status != highspy.HighsModelStatus.kOptimal:
+            raise RuntimeError(
+                f'Portfolio LP not solved: {self.h.modelStatusToString(status)}')
+        x = np.array(self.h.getSolution().col_value)
+        return x[:n_samples], x[n_samples:]
+
+
+# Rows timed with each LP backend before the faster one is kept (FastestLP)
+LP_PROBE_ROWS = 3
+
+
+class FastestLP():
+    """
+    Solves the LPs of min_true_sample with the faster of PortfolioLP and 
+    min_true_sample (linprog) on this machine: the first LP_PROBE_ROWS 
+    rows are solved and timed with each of them, then the one with the 
+    lower median time solves the rest. Both are exact, so only ties 
+    between optimal portfolios can depend on the choice.
+    """
     
-    
-   
+    def __init__(self, uy, R, n_samples):
+        self.backends = {
+            'model': PortfolioLP(uy, R, n_samples).solve,
+            'linprog': functools.partial(min_true_sample, uy=uy, R=R)}
+        self.times = {name: [] for name in self.backends}
+        self.backend = None
+        
+    def solve(self, y, w=None):
+        if self.backend is not None:
+            return self.backends[self.backend](y, w=w)
+        name = min(self.times, key=lambda name: len(self.times[name]))
+        t0 = time.perf_counter()
+        result = self.backends[name](y, w=w)
+        self.times[name].append(time.perf_counter() - t0)
+        if min(len(times) for times in self.times.values()) >= LP_PROBE_ROWS:
+            self.backend = min(
+                self.times, key=lambda name: np.median(self.times[name]))
+        return result
+
+
+# FastestLP solvers of this process, keyed by uy, R and n_samples
+_lp_models = {}
+
+
+def get_lp_model(uy, R, n_samples):
+    """
+    FastestLP of the current process (e.g. of each worker of 
+    RiskPortOP.true_argmins), built at the first call
+    """
+    key = (np.asarray(uy).tobytes(), float(R), n_samples)
+    if key not in _lp_models:
+        _lp_models[key] = FastestLP(uy, R, n_samples)
+    return _lp_models[key]
+
+
+def true_argmins(uy, R, Y_dist, weights=None):
+    """
+    Rows [ustar, zstar] of the LPs of the batch Y_dist with the scenario 
+    weights (module level so it can be sent to the workers of 
+    RiskPortOP.true_argmins). With highspy installed, the rows are solved 
+    by the FastestLP of the process, otherwise each LP is built and 
+    solved by min_true_sample.
+    """
+    batch_size, n_samples, n_assets = Y_dist.shape
+    argmins = np.zeros((batch_size, n_samples + n_assets))
+    if highspy is not None:
+        solve = get_lp_model(uy, R, n_samples).solve
+    else:
+        solve = functools.partial(min_true_sample, uy=uy, R=R)
+    for i in range(0, batch_size):
+        w = None if weights is None else weights[i]
+        ustar, zstar = solve(Y_dist[i,:,:], w=w)
+        argmins[i,:n_samples] = ustar
+        argmins[i,n_samples:] = zstar
+    return argmins
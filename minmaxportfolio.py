@@ -9,10 +9,16 @@ import joblib
 import random
 import sys
 
+import artifact_cache
 import data_generator
+import dtype_utils
+import evaluation_utils
+import hparam_search
+import parallel_utils
+import solver_cache
 #from model import VariableStandardNet, VariableVariationalNet
 from model import POStandardNet, POVariationalNet
-from train import TrainDecoupled, TrainCombined
+from train import TrainDecoupled, TrainCombined, tolerance_schedule
 
 from sklearn.preprocessing import StandardScaler
 
@@ -34,7 +40,9 @@ def run_minimax_op(
             N_ASSETS,
             N_train,
             EPOCHS,
-            dev):
+            dev,
+            hparams=None,
+            epoch_callback=None):
 
 
     ##################################################################
@@ -85,12 +93,18 @@ def run_minimax_op(
         EPOCHS = EPOCHS
         pt = -1
       
+    explr = 0.99
+    
+    # Overrides of the hard-coded hyperparameters (see hparam_search.py)
+    lr, explr, EPOCHS, K = hparam_search.apply_overrides(
+        hparams, method_name, lr, explr, EPOCHS, K)
+      
     # Aleatoric Uncertainty Modeling
     aleat_bool=True
     if method_name == 'ann':
         aleat_bool=False
         
-    cpu_count = mp.cpu_count()
+    cpu_count = parallel_utils.get_loader_workers()
     if dev == torch.device('cuda'):
         print('Cuda found')
         cpu_count = 1
@@ -113,8 +127,8 @@ def run_minimax_op(
     # Output normalization
     scaler = StandardScaler()
     scaler.fit(Y_original)
-    tmean = torch.tensor(scaler.mean_).to(dev)
-    tstd = torch.tensor(scaler.scale_).to(dev)
+    tmean = dtype_utils.to_tensor(scaler.mean_, dev)
+    tstd = dtype_utils.to_tensor(scaler.scale_, dev)
     joblib.dump(scaler, 'scaler_portfolio.gz')
 
     # Function to denormalize the data
@@ -122,26 +136,26 @@ def run_minimax_op(
         return yy*tstd + tmean
 
     Y = scaler.transform(Y_original).copy()
-    X = torch.tensor(X, dtype=torch.float32)
-    Y = torch.tensor(Y, dtype=torch.float32)
-    data_train = data_generator.ArtificialDataset(X, Y)
+    X = torch.tensor(X, dtype=dtype_utils.get_dtype())
+    Y = torch.tensor(Y, dtype=dtype_utils.get_dtype())
+    data_train = data_generator.ArtificialDataset(X, Y, return_idx=True)
     training_loader = torch.utils.data.DataLoader(
         data_train, batch_size=BATCH_SIZE_LOADER,
         shuffle=True, num_workers=cpu_count)
-    #Y_dist = torch.tensor(Y_dist, dtype=torch.float32)
+    #Y_dist = torch.tensor(Y_dist, dtype=dtype_utils.get_dtype())
 
     Y_val = scaler.transform(Y_val_original).copy()
-    X_val = torch.tensor(X_val, dtype=torch.float32)
-    Y_val_original = torch.tensor(Y_val_original, dtype=torch.float32)
-    Y_val = torch.tensor(Y_val, dtype=torch.float32)
+    X_val = torch.tensor(X_val, dtype=dtype_utils.get_dtype())
+    Y_val_original = torch.tensor(Y_val_original, dtype=dtype_utils.get_dtype())
+    Y_val = torch.tensor(Y_val, dtype=dtype_utils.get_dtype())
     data_valid = data_generator.ArtificialDataset(X_val, Y_val)
     validation_loader = torch.utils.data.DataLoader(
         data_valid, batch_size=BATCH_SIZE_LOADER,
         shuffle=False, num_workers=cpu_count)
 
-    X_test = torch.tensor(X_test, dtype=torch.float32)
+    X_test = torch.tensor(X_test, dtype=dtype_utils.get_dtype())
     Y_test_original = torch.tensor(
-        Y_test_original, dtype=torch.float32)
+        Y_test_original, dtype=dtype_utils.get_dtype())
     data_test = data_generator.ArtificialDistDataset(
         X_test, Y_test_original, Y_test_dist)
     test_loader = torch.utils.data.DataLoader(
@@ -154,7 +168,25 @@ def run_minimax_op(
     min_return = 10000
     
     mse_loss = nn.MSELoss(reduction='none')
-    op = op_utils.RiskPortOP(N_SAMPLES, N_ASSETS, min_return, torch.tensor(Y_original), dev)
+    
+    # Solver precision (see dtype_utils), float32 only if it is accurate 
+    # on scenarios of the training data
+    Y_check = torch.tensor(
+        dtype_utils.check_rows(Y_original, N_SAMPLES)).reshape(
+        -1, N_SAMPLES, N_ASSETS).to(dev)
+    solver_dtype = dtype_utils.validated_solver_dtype(
+        lambda dtype: op_utils.RiskPortOP(
+            N_SAMPLES, N_ASSETS, min_return, torch.tensor(Y_original), dev, dtype=dtype), 
+        Y_check, solve=lambda op, y: op.forward(y)[1])
+    # Backend and tolerance schedule of the training solves (see 
+    # solver_cache), qpth with a fixed tolerance by default
+    training_solver = solver_cache.get_training_solver()
+    tol_schedule = tolerance_schedule() \
+        if solver_cache.use_tol_schedule() else None
+    
+    op = solver_cache.get_solver(
+        op_utils.RiskPortOP, N_SAMPLES, N_ASSETS, min_return, torch.tensor(Y_original), dev, 
+        solver=training_solver, dtype=solver_dtype).train()
     
     #GP Baseline model
     if method_name == 'gp':
@@ -164,7 +196,17 @@ def run_minimax_op(
             gp = GP(length_scale=1, length_scale_bounds=(1e-2, 1e4), 
                     alpha_noise=0.01, white_noise=1, 
                     n_restarts_optimizer=4)
-            gp.gp_fit(X.detach().numpy(), Y[:,k].detach().numpy())
+            
+            def fit_gp():
+                gp.gp_fit(X.detach().numpy(), Y[:,k].detach().numpy())
+                return gp
+            
+            gp, _ = artifact_cache.cached_train(
+                fit_gp,
+                script='minmaxportfolio', method_name=method_name,
+                model_class=type(gp).__name__, seed_number=seed_number, 
+                output=k, N_train=N_train, N_ASSETS=N_ASSETS, nl=nl,
+                gp_params=(gp.ls, gp.lsbs, gp.alp, gp.wn, gp.nro))
             model_gps.append(gp)
             model_used = gp
     
@@ -201,7 +243,8 @@ def run_minimax_op(
                             aleat_bool=aleat_bool,
                             training_loader=training_loader,
                             validation_loader=validation_loader,
-                            dev=dev
+                            dev=dev,
+                            explr=explr
                         )
 
         # Combined learning approach (end-to-end loss)
@@ -217,7 +260,9 @@ def run_minimax_op(
                             validation_loader=validation_loader,
                             OP=op,
                             dev=dev,
-                            bm_stop=False
+                            explr=explr,
+                            bm_stop=False,
+                            tol_schedule=tol_schedule
                         )
         
 
@@ -225,7 +270,24 @@ def run_minimax_op(
             EPOCHS1 = 30
         else:
             EPOCHS1 = EPOCHS
-        model_used = train_NN.train(EPOCHS=EPOCHS1, pre_train=pt)
+        # Decoupled (or warm-start) models are shared by every run with 
+        # the same training configuration through the cache
+        if method_learning == 'decoupled' or warm_decoupled:
+            stage_key_parts = dict(stage='decoupled')
+        else:
+            stage_key_parts = dict(stage='combined', min_return=min_return, 
+                                   N_SAMPLES_OP=op.M, solver=op.solver, 
+                                   tol_schedule=tol_schedule is not None)
+        model_used, pretrain_key = artifact_cache.cached_train(
+            lambda: train_NN.train(
+                EPOCHS=EPOCHS1, pre_train=pt, callback=epoch_callback),
+            script='minmaxportfolio', method_name=method_name,
+            model_class=type(h).__name__, seed_number=seed_number, 
+            N_train=N_train, N_ASSETS=N_ASSETS, nl=nl, batch_size=BATCH_SIZE_LOADER, 
+            aleat_bool=aleat_bool, N_SAMPLES=N_SAMPLES, lr=lr, K=K, PLV=PLV, 
+            explr=explr, 
+            weight_decay=10e-4 if method_name == 'ann' else 0,
+            EPOCHS=EPOCHS1, pre_train=pt, dev=dev, **stage_key_parts)
     
         if warm_decoupled:
             train_NN = TrainCombined(
@@ -238,10 +300,16 @@ def run_minimax_op(
                             scaler=scaler,
                             validation_loader=validation_loader,
                             OP=op,
-                            dev=dev
+                            dev=dev,
+                            tol_schedule=tol_schedule
                         )
     
-            model_used = train_NN.train(EPOCHS=EPOCHS-EPOCHS1, pre_train=pt)
+            model_used, _ = artifact_cache.cached_train(
+                lambda: train_NN.train(EPOCHS=EPOCHS-EPOCHS1, pre_train=pt),
+                script='minmaxportfolio', stage='combined', 
+                warm_start=pretrain_key, min_return=min_return, 
+                N_SAMPLES_OP=op.M, EPOCHS=EPOCHS-EPOCHS1, pre_train=pt,
+                solver=op.solver, tol_schedule=tol_schedule is not None)
     
     
     if method_name == 'ann':
@@ -251,67 +319,76 @@ def run_minimax_op(
     sc_list = []
     oc_list = []
     
-    op_dist = op_utils.RiskPortOP(n_samples_orig, N_ASSETS, min_return, torch.tensor(Y_original), dev)
-    op_true = op_utils.RiskPortOP(1, N_ASSETS, min_return, torch.tensor(Y_original), dev)
-    
-    subopt_cost = 0
-    opt_cost = 0
-    for i, data in enumerate(test_loader):
-        _ , y_batch, y_dist = data
-        subopt_cost_ = op_dist.end_loss_dist(torch.permute(y_dist, (1, 0, 2)).to(dev), y_batch.to(dev), True).detach()
-        opt_cost_ = op_true.end_loss_dist(y_batch.unsqueeze(0).to(dev), y_batch.to(dev), True).detach()
-        subopt_cost += subopt_cost_
-        opt_cost += opt_cost_
-    
-    subopt_cost = subopt_cost/len(test_loader)
-    opt_cost = opt_cost/len(test_loader)
-    
-    for M_opt in M_SAMPLES:
-               
-        if method_name == 'gp':
-            for model in model_gps:
-                model.update_n_samples(n_samples=M_opt)
-        else:
-            model_used.update_n_samples(n_samples=M_opt)
-        
-        op = op_utils.RiskPortOP(M_opt, N_ASSETS, min_return, torch.tensor(Y_original), dev)
-                
-        final_cost = 0
+    op_dist = solver_cache.get_solver(
+        op_utils.RiskPortOP, n_samples_orig, N_ASSETS, min_return, torch.tensor(Y_original), dev, dtype=solver_dtype).eval()
+    op_true = solver_cache.get_solver(
+        op_utils.RiskPortOP, 1, N_ASSETS, min_return, torch.tensor(Y_original), dev, dtype=solver_dtype).eval()
+    
+    # Costs of the true distribution and of the observations, the same for 
+    # every method and M of this dataset (stored in the cache, see artifact_cache)
+    def oracle_costs():
+        subopt_cost = 0
+        opt_cost = 0
         for i, data in enumerate(test_loader):
-            x_batch, y_batch, _ = data
-            x_batch = x_batch.to(dev)
-            y_batch = y_batch.to(dev)
-            
-            if method_name in ['ann','bnn']:
-                Y_pred = model_used.forward_dist(x_batch, aleat_bool)
-                
-            elif method_name in ['gp']:
-                Y_pred = torch.zeros_like(
-                    y_batch).unsqueeze(0).expand(
-                    M_opt, y_batch.shape[0], 
-                    y_batch.shape[1]).clone()
-                for k in range(0, len(model_gps)):
-                    Y_pred[:,:,k] = model_gps[k].forward_dist(
-                        x_batch, aleat_bool).squeeze()
-                
-            else:
-                print('Model not found')
-                break
+            _ , y_batch, y_dist = data
+            subopt_cost_ = op_dist.end_loss_dist(torch.permute(y_dist, (1, 0, 2)).to(dev), y_batch.to(dev), True).detach()
+            opt_cost_ = op_true.end_loss_dist(y_batch.unsqueeze(0).to(dev), y_batch.to(dev), True).detach()
+            subopt_cost += subopt_cost_.item()
+            opt_cost += opt_cost_.item()
+        return subopt_cost/len(test_loader), opt_cost/len(test_loader)
+    
+    subopt_cost, opt_cost = artifact_cache.cached_oracle(
+        oracle_costs, script='minmaxportfolio', seed_number=seed_number + 160, 
+        nl=nl, N_test=N_test, N_ASSETS=N_ASSETS, min_return=min_return, 
+        data=artifact_cache.data_hash(Y_test_original, Y_test_dist), 
+        uy=artifact_cache.data_hash(op_true.uy), n_samples_orig=n_samples_orig, 
+        batch_size=BATCH_SIZE_LOADER, dtype=str(solver_dtype))
+    
+    ops = {M_opt: solver_cache.get_solver(
+        op_utils.RiskPortOP, M_opt, N_ASSETS, min_return, torch.tensor(Y_original), dev, dtype=solver_dtype).eval() 
+        for M_opt in M_SAMPLES}
     
+    # max(M_SAMPLES) samples are drawn once per batch and each M uses the first M
+    def sample_fn(data, M_opt):
+        x_batch = data[0].to(dev)
+        y_batch = data[1].to(dev)
+        
+        if method_name in ['ann','bnn']:
+            model_used.update_n_samples(n_samples=M_opt)
+            Y_pred = model_used.forward_dist(x_batch, aleat_bool)
             
-            Y_pred_original_ = inverse_transform(Y_pred)
-     
-            if method_learning == 'decoupled':
-                final_cost_ = op.end_loss_dist(Y_pred_original_.to(dev), y_batch.to(dev), True).detach()               
-            else:
-                final_cost_ = op.end_loss_dist(Y_pred_original_.to(dev), y_batch.to(dev)).detach()
-            final_cost += final_cost_
+        elif method_name in ['gp']:
+            Y_pred = torch.zeros_like(
+                y_batch).unsqueeze(0).expand(
+                M_opt, y_batch.shape[0], 
+                y_batch.shape[1]).clone()
+            for k in range(0, len(model_gps)):
+                model_gps[k].update_n_samples(n_samples=M_opt)
+                Y_pred[:,:,k] = model_gps[k].forward_dist(
+                    x_batch, aleat_bool).squeeze()
             
-        final_cost = final_cost/len(test_loader)
+        else:
+            raise ValueError('Model not found')
+        
+        return inverse_transform(Y_pred)
+    
+    def metrics_fn(M_opt, Y_pred_original_, data):
+        y_batch = data[1].to(dev)
+        if method_learning == 'decoupled':
+            final_cost_ = ops[M_opt].end_loss_dist(Y_pred_original_.to(dev), y_batch, True)
+        else:
+            final_cost_ = ops[M_opt].end_loss_dist(Y_pred_original_.to(dev), y_batch)
+        return {'final_cost': final_cost_}
+    
+    df_eval = evaluation_utils.evaluate_prefixes(
+        test_loader, sample_fn, M_SAMPLES, metrics_fn)
+    
+    for _, row in df_eval.iterrows():
+        final_cost = row['final_cost']
            
-        fc_list.append(final_cost.item())
-        sc_list.append(subopt_cost.item())
-        oc_list.append(opt_cost.item())
+        fc_list.append(final_cost)
+        sc_list.append(subopt_cost)
+        oc_list.append(opt_cost)
         
         print(f'Final cost: {final_cost} \t Subopt cost: {subopt_cost} \t Opt cost: {opt_cost}')
         
@@ -352,18 +429,22 @@ if __name__ == '__main__':
     fc_l = []
     sc_l = []
     oc_l = []
+    # Seeds run in parallel processes if PAO_N_JOBS > 1
+    runs = parallel_utils.run_parallel(
+        run_minimax_op,
+        [dict(method_name=method_name, 
+              method_learning=method_learning,
+              seed_number=seed_number,
+              N_SAMPLES=N_SAMPLES,
+              M_SAMPLES=M_SAMPLES,
+              N_ASSETS=N_ASSETS,
+              N_train=N_train,
+              EPOCHS=EPOCHS,
+              dev=dev) for seed_number in range(0, nr_seeds)])
+    
     for seed_number in range(0, nr_seeds):
     
-        fc_list, sc_list, oc_list = run_minimax_op(
-                                        method_name, 
-                                        method_learning,
-                                        seed_number,
-                                        N_SAMPLES,
-                                        M_SAMPLES,
-                                        N_ASSETS,
-                                        N_train,
-                                        EPOCHS,
-                                        dev)
+        fc_list, sc_list, oc_list = runs[seed_number]
         
         fc_l.append(fc_list)
         sc_l.append(sc_list)
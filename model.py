@@ -2,6 +2,8 @@ import math
 import torch
 import torch.nn as nn
 
+import dtype_utils
+
 # This code defines 2 ANNs and 2 BNNs
 # 1 of each is using for each experiment
 # Because we needed a more complex network
@@ -23,21 +25,24 @@ class VariationalLayer(nn.Module):
         # Bias weight
         input_size = input_size + 1
         
+        # Precision of the weights (see dtype_utils)
+        dtype = dtype_utils.get_dtype()
+        
         # Defining Prior distribution (Gaussian)
-        self.prior_mu = torch.tensor(prior_mu).to(dev)
-        self.prior_rho = torch.tensor(prior_rho).to(dev)
+        self.prior_mu = torch.tensor(prior_mu, dtype=dtype).to(dev)
+        self.prior_rho = torch.tensor(prior_rho, dtype=dtype).to(dev)
         
         # Defining Variational class (Gaussian class)
         self.theta_mu = nn.Parameter(
-            torch.Tensor(input_size, output_size).to(dev).uniform_(
-                mu_init_1, mu_init_2)).float()
+            torch.empty((input_size, output_size), dtype=dtype).to(dev).uniform_(
+                mu_init_1, mu_init_2))
         self.theta_rho = nn.Parameter(
-            torch.Tensor(input_size, output_size).to(dev).uniform_(
-                rho_init, rho_init+1)).float()      
+            torch.empty((input_size, output_size), dtype=dtype).to(dev).uniform_(
+                rho_init, rho_init+1))      
         
         # Defining some constants
         self.logsqrttwopi = torch.log(
-            torch.sqrt(2*torch.tensor(math.pi))).to(dev)
+            torch.sqrt(2*torch.tensor(math.pi, dtype=dtype))).to(dev)
         self.K = torch.tensor(1).to(dev)
         
         # Defining number of samples for forward
@@ -50,7 +55,8 @@ class VariationalLayer(nn.Module):
     def sample_weight(self):
         w = (self.theta_mu.to(self.dev)
         + self.rho_to_sigma(self.theta_rho.to(self.dev))*torch.randn(
-            (self.n_samples, self.theta_mu.shape[0], self.theta_mu.shape[1])
+            (self.n_samples, self.theta_mu.shape[0], self.theta_mu.shape[1]), 
+            dtype=self.theta_mu.dtype
         ).to(self.dev))
         return w
 
@@ -161,6 +167,7 @@ class StandardNet(nn.Module):
         self.linear3 = nn.Linear(hl_sizes[1], hl_sizes[1])
         self.linear4 = nn.Linear(hl_sizes[1], output_size)
         self.linear4_2 = nn.Linear(hl_sizes[1], output_size)
+        self.to(dtype_utils.get_dtype())
         
     def forward(self, x):
         x = self.linear1(x)
@@ -190,6 +197,17 @@ class StandardNet(nn.Module):
             y_dist = y
 
         return y_dist
+
+    def forward_gaussian(self, x, aleat_bool):
+        """
+        Mean and standard deviation of the predictive distribution that 
+        forward_dist samples (Gaussian, a point mass without aleatoric 
+        uncertainty), for decisions that do not need samples
+        """
+        y, rho = self(x)
+        if aleat_bool:
+            return y, torch.sqrt(torch.exp(rho))
+        return y, torch.zeros_like(y)
     
     
 class StrongStandardNet(nn.Module):
@@ -204,6 +222,7 @@ class StrongStandardNet(nn.Module):
         self.linear3 = nn.Linear(hl_sizes[1], hl_sizes[1])
         self.linear4 = nn.Linear(hl_sizes[1], output_size)
         self.linear4_2 = nn.Linear(hl_sizes[1], output_size)
+        self.to(dtype_utils.get_dtype())
         
     def forward(self, x):
         x = self.linear1(x)
@@ -317,6 +336,7 @@ class POStandardNet(nn.Module):
         self.linear3 = nn.Linear(hl_sizes[1], hl_sizes[1])
         self.linear4 = nn.Linear(hl_sizes[1], output_size)
         self.linear4_2 = nn.Linear(hl_sizes[1], output_size)
+        self.to(dtype_utils.get_dtype())
         
     def forward(self, x):
         x = self.linear1(x)
@@ -0,0 +1,198 @@
+import atexit
+import contextlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+# Environment variables read by the BLAS/OpenMP runtimes. They are set
+# for the worker processes so that each one only uses its thread budget.
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS',
+                   'OPENBLAS_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+                   'NUMEXPR_NUM_THREADS']
+
+# Number of CPUs a single run is allowed to use (threads and loader workers)
+CPU_BUDGET_ENV = 'PAO_CPU_BUDGET'
+
+# Number of runs (seeds/configurations) executed at the same time
+N_JOBS_ENV = 'PAO_N_JOBS'
+
+# Number of processes solving the optimization problems at evaluation
+EVAL_JOBS_ENV = 'PAO_EVAL_JOBS'
+
+# Chunks per worker in map_chunks, more chunks balance the load better
+CHUNKS_PER_JOB = 4
+
+# Persistent pools of map_chunks, keyed by (n_jobs, n_threads)
+_pools = {}
+
+
+def get_n_jobs():
+    """
+    Number of parallel runs requested by the user (default 1, sequential)
+    """
+    return max(1, int(os.environ.get(N_JOBS_ENV, 1)))
+
+
+def get_eval_jobs():
+    """
+    Processes used by the evaluation solves of a run (default 1, in the 
+    current process), at most the CPUs of the run
+    """
+    n_jobs = int(os.environ.get(EVAL_JOBS_ENV, 1))
+    return max(1, min(n_jobs, get_cpu_count()))
+
+
+def get_cpu_count():
+    """
+    CPUs available to the current run. Inside a worker of run_parallel
+    this is the thread budget of the worker, otherwise all CPUs.
+    """
+    return int(os.environ.get(CPU_BUDGET_ENV, mp.cpu_count()))
+
+
+def get_loader_workers():
+    """
+    DataLoader workers for the current run. With a budget of a single CPU
+    the data is loaded in the main process to avoid extra processes.
+    """
+    cpu_count = get_cpu_count()
+    if cpu_count <= 1:
+        return 0
+    return cpu_count
+
+
+def set_thread_budget(n_threads):
+    """
+    Limit torch intra-op and BLAS threads of this process to n_threads
+    """
+    n_threads = max(1, int(n_threads))
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(n_threads)
+    os.environ[CPU_BUDGET_ENV] = str(n_threads)
+    torch.set_num_threads(n_threads)
+
+
+@contextlib.contextmanager
+def thread_budget_env(n_threads):
+    """
+    Exports the thread budget n_threads in the environment, restored on 
+    exit. Spawned workers inherit the environment of the parent, so pools 
+    must start their workers inside this context.
+    """
+    env_backup = {var: os.environ.get(var)
+                  for var in THREAD_ENV_VARS + [CPU_BUDGET_ENV]}
+    try:
+        for var in THREAD_ENV_VARS + [CPU_BUDGET_ENV]:
+            os.environ[var] = str(n_threads)
+        yield
+    finally:
+        for var, value in env_backup.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def _call(fn, kwargs):
+    return fn(**kwargs)
+
+
+def run_parallel(fn, kwargs_list, n_jobs=None, n_threads=None):
+    """
+    Run fn(**kwargs) for every kwargs in kwargs_list (e.g. one per seed
+    or per configuration) over a process pool with n_jobs workers.
+    Each worker gets n_threads torch/BLAS threads (by default the CPUs
+    are split evenly between workers). Results are returned in the
+    same order as kwargs_list. With n_jobs=1 the runs are sequential
+    in the current process.
+    """
+    if n_jobs is None:
+        n_jobs = get_n_jobs()
+    n_jobs = max(1, min(n_jobs, len(kwargs_list)))
+
+    if n_jobs == 1:
+        return [fn(**kwargs) for kwargs in kwargs_list]
+
+    if n_threads is None:
+        n_threads = max(1, mp.cpu_count()//n_jobs)
+
+    with thread_budget_env(n_threads):
+        with ProcessPoolExecutor(
+            max_workers=n_jobs,
+            mp_context=mp.get_context('spawn'),
+            initializer=set_thread_budget,
+            initargs=(n_threads,)) as executor:
+            futures = [executor.submit(_call, fn, kwargs)
+                       for kwargs in kwargs_list]
+            results = [future.result() for future in futures]
+
+    return results
+
+
+def _apply(fn, chunk):
+    return fn(*chunk)
+
+
+def _split(array, n_chunks):
+    if torch.is_tensor(array):
+        return torch.tensor_split(array, n_chunks)
+    return np.array_split(array, n_chunks)
+
+
+def get_pool(n_jobs, n_threads=None):
+    """
+    Persistent spawn pool of n_jobs workers with n_threads threads each 
+    (by default the CPUs of the run are split evenly). The pool is created 
+    at the first call and reused by the next ones, so the workers only 
+    import torch and the solvers once per run.
+    """
+    if n_threads is None:
+        n_threads = max(1, get_cpu_count()//n_jobs)
+    key = (n_jobs, n_threads)
+    if key not in _pools:
+        _pools[key] = ProcessPoolExecutor(
+            max_workers=n_jobs,
+            mp_context=mp.get_context('spawn'),
+            initializer=set_thread_budget,
+            initargs=(n_threads,))
+    return _pools[key], n_threads
+
+
+@atexit.register
+def shutdown_pools():
+    for executor in _pools.values():
+        executor.shutdown(cancel_futures=True)
+    _pools.clear()
+
+
+def map_chunks(fn, array, n_jobs=None):
+    """
+    Applies fn to contiguous chunks of the rows of array (numpy array or 
+    tensor) over a persistent process pool of n_jobs workers (see 
+    get_pool, by default get_eval_jobs) and concatenates the results in 
+    order, so the result is the same as fn(array) whatever the number of 
+    workers. The rows are split in CHUNKS_PER_JOB chunks per worker to 
+    balance the load. With a tuple of arrays with the same rows, fn 
+    receives the chunks of each of them. fn must be picklable, e.g. a 
+    module level function or a functools.partial of one.
+    """
+    arrays = array if isinstance(array, tuple) else (array,)
+    if n_jobs is None:
+        n_jobs = get_eval_jobs()
+    n_jobs = max(1, min(n_jobs, len(arrays[0])))
+    if n_jobs == 1:
+        return fn(*arrays)
+
+    n_chunks = min(n_jobs*CHUNKS_PER_JOB, len(arrays[0]))
+    chunks = list(zip(*[_split(a, n_chunks) for a in arrays]))
+    executor, n_threads = get_pool(n_jobs)
+    # Workers are started on demand by submit, with the thread budget
+    with thread_budget_env(n_threads):
+        futures = [executor.submit(_apply, fn, chunk) for chunk in chunks]
+    results = [future.result() for future in futures]
+    if torch.is_tensor(results[0]):
+        return torch.cat(results)
+    return np.concatenate(results)
@@ -0,0 +1,284 @@
+import torch
+
+# Batched primal-dual interior point method for the QPs
+#     min 1/2 x'Qx + p'x   s.t.   Gx <= h
+# The matrices Q and G are never formed here. They are accessed through a
+# KKT object that exploits the structure of each problem and provides:
+#     kkt.Q_mv(x), kkt.G_mv(x), kkt.GT_mv(lam)  products with Q, G and G'
+#     kkt.factor(W)        factorization for the diagonal W > 0 (batch x nineq)
+#     kkt.solve(F, a, b)   solution (dx, dlam) of  Q dx + G'dlam = a
+#                                                 G dx - W dlam = b
+# The algorithm follows the Mehrotra predictor-corrector method used by qpth
+# (Amos and Kolter, 2017), and the backward pass differentiates the KKT
+# conditions at the solution in the same way.
+
+
+# Distance to the boundary of the warm-started slacks and multipliers
+warm_shift = 1e-1
+
+
+def max_step(v, dv):
+    """
+    Largest step keeping v + step*dv >= 0, per batch element
+    """
+    ratio = torch.where(dv < 0, -v/dv, torch.full_like(v, float('inf')))
+    return ratio.min(-1, keepdim=True)[0]
+
+
+def pdipm(kkt, p, h, eps=1e-8, max_iter=50, init=None, init_mask=None):
+    """
+    Solves the batch of QPs. Returns the solution x, the slacks s = h - Gx,
+    the multipliers lam of the inequalities and the number of iterations.
+    init = (x, s, lam) warm-starts the batch elements where init_mask is
+    True (e.g. the solution of a close QP, see WarmStartCache).
+    """
+    # Initial point: least squares solution of the KKT system
+    F = kkt.factor(torch.ones_like(h))
+    x, v = kkt.solve(F, -p, h)
+    s = -v
+    lam = v.clone()
+    s_min = s.min(-1, keepdim=True)[0]
+    s = torch.where(s_min <= 0, s - s_min + 1, s)
+    lam_min = lam.min(-1, keepdim=True)[0]
+    lam = torch.where(lam_min <= 0, lam - lam_min + 1, lam)
+
+    if init is not None:
+        x_w, s_w, lam_w = init
+        # The previous solution is on the boundary, the slacks and
+        # multipliers are pushed back into the interior
+        s_w = torch.clamp(h - kkt.G_mv(x_w), min=0) + warm_shift
+        lam_w = torch.clamp(lam_w, min=0) + warm_shift
+        mask = init_mask.unsqueeze(-1)
+        x = torch.where(mask, x_w, x)
+        s = torch.where(mask, s_w, s)
+        lam = torch.where(mask, lam_w, lam)
+
+    nineq = h.shape[-1]
+    scale = 1 + p.norm(dim=-1, keepdim=True) + h.norm(dim=-1, keepdim=True)
+    # As in qpth, the best iterate of each batch element is kept, since the
+    # Newton systems become ill-conditioned close to the solution
+    best = (x, s, lam)
+    best_err = torch.full_like(scale, float('inf'))
+    n_iter = 0
+    while True:
+        r_x = kkt.Q_mv(x) + p + kkt.GT_mv(lam)
+        r_p = kkt.G_mv(x) + s - h
+        mu = (s*lam).sum(-1, keepdim=True)/nineq
+
+        resid = (r_x.norm(dim=-1, keepdim=True)
+                 + r_p.norm(dim=-1, keepdim=True))/scale
+        obj = (0.5*kkt.Q_mv(x)*x + p*x).sum(-1, keepdim=True)
+        gap = nineq*mu/(1 + obj.abs())
+        err = torch.maximum(resid, gap)
+        improved = err < best_err
+        best = tuple(torch.where(improved, v, v_best)
+                     for v, v_best in zip((x, s, lam), best))
+        best_err = torch.where(improved, err, best_err)
+        # Converged elements are not moved anymore
+        done = best_err < eps
+        if torch.all(done) or n_iter >= max_iter:
+            break
+
+        F = kkt.factor(s/lam)
+
+        # Predictor (affine scaling) step
+        dx, dlam = kkt.solve(F, -r_x, -r_p + s)
+        ds = -r_p - kkt.G_mv(dx)
+        alpha = torch.clamp(
+            torch.minimum(max_step(s, ds), max_step(lam, dlam)), max=1)
+        mu_aff = ((s + alpha*ds)*(lam + alpha*dlam)).sum(-1, keepdim=True)/nineq
+        sigma = (mu_aff/mu)**3
+
+        # Corrector step
+        r_c = s*lam + ds*dlam - sigma*mu
+        dx, dlam = kkt.solve(F, -r_x, -r_p + r_c/lam)
+        ds = -r_p - kkt.G_mv(dx)
+        alpha = torch.clamp(
+            0.99*torch.minimum(max_step(s, ds), max_step(lam, dlam)), max=1)
+        alpha = torch.where(done, torch.zeros_like(alpha), alpha)
+
+        x = x + alpha*dx
+        s = s + alpha*ds
+        lam = lam + alpha*dlam
+        n_iter += 1
+
+    x, s, lam = best
+    return x, s, lam, n_iter
+
+
+def pdipm_warm(kkt, p, h, eps=1e-8, max_iter=50, warm_start=None):
+    """
+    pdipm warm-started from warm_start = (WarmStartCache, idx), the cache
+    is updated with the new solutions
+    """
+    if warm_start is None:
+        return pdipm(kkt, p, h, eps, max_iter)
+    cache, idx = warm_start
+    values, valid = cache.get(idx)
+    init = tuple(values[name].to(p.dtype) for name in ['x', 's', 'lam'])
+    x, s, lam, n_iter = pdipm(
+        kkt, p, h, eps, max_iter, init=init, init_mask=valid)
+    cache.update(idx, x=x, s=s, lam=lam)
+    return x, s, lam, n_iter
+
+
+class WarmStartCache():
+    """
+    Solutions of the QPs of a dataset kept per dataset index, to
+    warm-start the next solve of the same sample (e.g. at the next
+    epoch of TrainCombined). sizes maps each stored quantity to its
+    dimension and the tensors are preallocated for the n_data samples.
+    """
+    def __init__(self, n_data, sizes, dev):
+        self.values = {
+            name: torch.zeros((n_data, size), dtype=torch.float64, device=dev)
+            for name, size in sizes.items()}
+        self.valid = torch.zeros(n_data, dtype=torch.bool, device=dev)
+
+    def get(self, idx):
+        """
+        Stored values of the samples idx and mask of the samples solved before
+        """
+        idx = idx.to(self.valid.device)
+        values = {name: v[idx] for name, v in self.values.items()}
+        return values, self.valid[idx]
+
+    def update(self, idx, **values):
+        idx = idx.to(self.valid.device)
+        for name, v in values.items():
+            self.values[name][idx] = v.detach().double()
+        self.valid[idx] = True
+
+
+def pdipm_backward(kkt, s, lam, grad_x):
+    """
+    Differentiates the KKT conditions at the solution (Amos and Kolter, 2017).
+    Returns dx and dlam, from which the gradients of the QP data follow:
+        grad_p = dx, grad_h = -dlam, grad_G = dlam x' + lam dx'
+    """
+    W = torch.clamp(s, min=1e-8)/torch.clamp(lam, min=1e-8)
+    F = kkt.factor(W)
+    dx, dlam = kkt.solve(F, -grad_x, torch.zeros_like(s))
+    return dx, dlam
+
+
+class DenseQP():
+    """
+    Cache of the constant parts of the QPs
+        min 1/2 x'Qx + p'x   s.t.   G_c x <= h_c,  G_b x <= h_b
+    where Q and the block G_c are the same for every batch element and
+    every call, and only the (optional) block G_b and the vectors p, h
+    change. Q^{-1}, G_c Q^{-1} and G_c Q^{-1} G_c' are computed once per
+    instance, so each solve only factors the Schur complement
+    G Q^{-1} G' + W of the inequalities (Cholesky). The solves are done
+    in the precision dtype.
+    """
+    def __init__(self, Q, G_c, eps=1e-8, max_iter=50, dtype=torch.float64):
+        Q = Q.to(dtype)
+        self.dtype = dtype
+        self.G_c = G_c.to(dtype)
+        self.Q = Q
+        self.Q_inv = torch.cholesky_inverse(torch.linalg.cholesky(Q))
+        self.GcQi = self.G_c@self.Q_inv
+        self.K_cc = self.GcQi@self.G_c.T
+        self.eps = eps
+        self.max_iter = max_iter
+        self.n_iter = 0 # Iterations of the last solve
+
+    def kkt(self, batch_size, G_b=None):
+        return DenseKKT(self, batch_size, G_b)
+
+
+class DenseKKT():
+    """
+    KKT operator of a batch of DenseQP problems (see pdipm), solved in
+    the space of the inequalities:
+        (G Q^{-1} G' + W) dlam = G Q^{-1} a - b,  dx = Q^{-1}(a - G'dlam)
+    """
+    def __init__(self, qp, batch_size, G_b=None):
+        self.qp = qp
+        self.G_b = G_b
+        nc = qp.K_cc.shape[0]
+        if G_b is None:
+            self.K = qp.K_cc.expand(batch_size, nc, nc)
+        else:
+            GbQi = G_b@qp.Q_inv
+            K_cb = qp.GcQi@G_b.transpose(1, 2)
+            K_bb = GbQi@G_b.transpose(1, 2)
+            self.K = torch.cat((
+                torch.cat((qp.K_cc.expand(batch_size, nc, nc), K_cb), 2),
+                torch.cat((K_cb.transpose(1, 2), K_bb), 2)), 1)
+
+    def Q_mv(self, x):
+        return x@self.qp.Q
+
+    def G_mv(self, x):
+        Gx = x@self.qp.G_c.T
+        if self.G_b is None:
+            return Gx
+        return torch.hstack((Gx, (self.G_b@x.unsqueeze(-1)).squeeze(-1)))
+
+    def GT_mv(self, lam):
+        nc = self.qp.G_c.shape[0]
+        GTlam = lam[:, :nc]@self.qp.G_c
+        if self.G_b is None:
+            return GTlam
+        return GTlam + (lam[:, nc:].unsqueeze(1)@self.G_b).squeeze(1)
+
+    def factor(self, W):
+        A = self.K + torch.diag_embed(W)
+        L, info = torch.linalg.cholesky_ex(A)
+        if torch.any(info > 0):
+            # Nearly dependent inequalities (e.g. two sided bounds) in low
+            # precision: regularize with the machine precision of the diagonal
+            jitter = 10*torch.finfo(A.dtype).eps*torch.diagonal(
+                A, dim1=-2, dim2=-1).abs().max(-1, keepdim=True)[0]
+            L = torch.linalg.cholesky(A + torch.diag_embed(
+                jitter.expand_as(W)))
+        return L
+
+    def solve(self, F, a, b):
+        Qia = a@self.qp.Q_inv
+        dlam = torch.cholesky_solve(
+            (self.G_mv(Qia) - b).unsqueeze(-1), F).squeeze(-1)
+        dx = Qia - self.GT_mv(dlam)@self.qp.Q_inv
+        return dx, dlam
+
+
+class DenseQPFunction(torch.autograd.Function):
+    """
+    Differentiable solution of a batch of DenseQP problems. Q and G_c are
+    constant, p and h are (batch x n) and G_b is (batch x nb x nx) or
+    None. Gradients are returned for p, h and G_b. warm_start is passed
+    to pdipm_warm.
+    """
+    @staticmethod
+    def forward(ctx, p, h, G_b, qp, warm_start=None):
+        batch_size = h.shape[0]
+        ctx.dtypes = [v.dtype if v is not None else None for v in (p, h, G_b)]
+        if G_b is not None:
+            G_b = G_b.to(qp.dtype)
+        kkt = qp.kkt(batch_size, G_b)
+
+        x, s, lam, n_iter = pdipm_warm(
+            kkt, p.to(qp.dtype), h.to(qp.dtype), qp.eps, qp.max_iter,
+            warm_start)
+        qp.n_iter = n_iter
+
+        # The Schur complement G Q^{-1} G' of the batch is reused backwards
+        ctx.kkt = kkt
+        ctx.save_for_backward(x, s, lam)
+        return x
+
+    @staticmethod
+    def backward(ctx, grad_x):
+        x, s, lam = ctx.saved_tensors
+        dx, dlam = pdipm_backward(ctx.kkt, s, lam, grad_x)
+        grad_G_b = None
+        if ctx.kkt.G_b is not None:
+            nc = ctx.kkt.qp.G_c.shape[0]
+            grad_G_b = dlam[:, nc:].unsqueeze(-1)*x.unsqueeze(1) \
+                + lam[:, nc:].unsqueeze(-1)*dx.unsqueeze(1)
+            grad_G_b = grad_G_b.to(ctx.dtypes[2])
+        return dx.to(ctx.dtypes[0]), -dlam.to(ctx.dtypes[1]), grad_G_b, \
+            None, None
@@ -0,0 +1,178 @@
+import math
+import numbers
+
+import numpy as np
+import torch
+
+# dtypes of the partition path (numpy has no bfloat16)
+PARTITION_DTYPES = (torch.float32, torch.float64)
+
+# Above this number of order statistics (2 per quantile level) one sort is
+# cheaper than the selections
+MAX_SELECTED_RANKS = 2
+
+
+def is_scalar(q):
+    return isinstance(q, numbers.Real) or (torch.is_tensor(q) and q.dim() == 0)
+
+
+def as_list(q):
+    """
+    Quantile levels as a list of floats (q is a scalar, a sequence or a
+    1-D tensor)
+    """
+    if is_scalar(q):
+        return [float(q)]
+    if torch.is_tensor(q):
+        return q.tolist()
+    return [float(q_) for q_ in q]
+
+
+def quantile_ranks(q, n, dtype):
+    """
+    Ranks (lo, hi) of the two order statistics of a linear interpolation
+    quantile of n values and the weight of hi, computed as torch.quantile
+    does (q in the dtype of the values, q*(n-1) in double), so the results
+    are the same bit for bit
+    """
+    if not 0 <= q <= 1:
+        raise ValueError(f'q must be in [0, 1], got {q}')
+    pos = torch.tensor(q, dtype=dtype).double().item()*(n - 1)
+    lo = math.floor(pos)
+    hi = min(lo + 1, n - 1)
+    weight = torch.tensor(pos - lo, dtype=torch.float64).to(dtype)
+    return lo, hi, weight
+
+
+def interpolate(v_lo, v_hi, weight):
+    return torch.lerp(v_lo, v_hi, weight.to(v_lo.device))
+
+
+def order_statistics(x, ranks):
+    """
+    Values of the given (0-based, ascending) ranks over the first dimension
+    of x, by partial selection: np.partition on the CPU (one copy of x,
+    O(n) per column) and torch.kthvalue on other devices. Many ranks (e.g.
+    a sweep of quantiles) are gathered from one sort instead. Not
+    differentiated.
+    """
+    ranks = sorted(set(ranks))
+    on_cpu = x.device.type == 'cpu' and x.dtype in PARTITION_DTYPES
+    if len(ranks) > MAX_SELECTED_RANKS:
+        if on_cpu:
+            x_sorted = torch.from_numpy(np.sort(x.detach().numpy(), axis=0))
+            return {r: x_sorted[r] for r in ranks}
+        # Sorted along the last dimension, as torch.quantile does
+        x_sorted = x.movedim(0, -1).sort(dim=-1).values
+        return {r: x_sorted[..., r] for r in ranks}
+    if on_cpu:
+        part = np.partition(x.detach().numpy(), ranks, axis=0)
+        return {r: torch.from_numpy(part[r]) for r in ranks}
+    return {r: x.kthvalue(r + 1, dim=0).values for r in ranks}
+
+
+def extremes(x, k, largest=False):
+    """
+    The k smallest (or largest) values over the first dimension of x, in no
+    particular order
+    """
+    n = x.shape[0]
+    if k >= n:
+        return x
+    if x.device.type == 'cpu' and x.dtype in PARTITION_DTYPES:
+        kth = n - k if largest else k - 1
+        part = np.partition(x.detach().numpy(), kth, axis=0)
+        part = part[n - k:] if largest else part[:k]
+        return torch.from_numpy(np.ascontiguousarray(part))
+    return x.topk(k, dim=0, largest=largest, sorted=False).values
+
+
+def interpolate_ranks(values, ranks, offset=0):
+    """
+    Quantiles from the order statistics values (see order_statistics) and
+    the quantile_ranks of each level; the ranks of values start at offset
+    """
+    return torch.stack([interpolate(values[lo - offset], values[hi - offset],
+                                    weight) for lo, hi, weight in ranks])
+
+
+def quantile(x, q, dim=0):
+    """
+    Same as torch.quantile(x, q, dim) (linear interpolation), with a
+    partial selection of the order statistics around q instead of a full
+    sort when no gradient is needed (see order_statistics). q is a scalar,
+    or a sequence of levels for a result with a first dimension of levels
+    (all of them from one selection or sort of x).
+    With autograd the sort of torch.quantile is kept.
+    """
+    if x.requires_grad and torch.is_grad_enabled():
+        if not is_scalar(q):
+            q = torch.tensor(as_list(q), dtype=x.dtype, device=x.device)
+        return torch.quantile(x, q, dim=dim)
+    x = x.movedim(dim, 0)
+    ranks = [quantile_ranks(q_, x.shape[0], x.dtype) for q_ in as_list(q)]
+    values = order_statistics(
+        x, [lo for lo, _, _ in ranks] + [hi for _, hi, _ in ranks])
+    result = interpolate_ranks(values, ranks)
+    return result[0] if is_scalar(q) else result
+
+
+class StreamingQuantile():
+    """
+    Exact quantile q (same as torch.quantile over the first dimension) of
+    n_total samples that arrive in chunks (samples x ...). Only the hi+1
+    smallest samples seen so far (or the n_total-lo largest if fewer) are
+    kept per column, so the memory is O(min(q, 1-q)*n_total) samples per
+    column instead of n_total, e.g. a tenth of them for q=0.1. q can be a
+    sequence of levels, the samples from the lowest to the highest are
+    then kept.
+    """
+
+    def __init__(self, n_total, q):
+        self.n_total = n_total
+        self.q = q
+        self.n_seen = 0
+        self.buffer = None
+
+    def update(self, chunk):
+        if self.n_seen + chunk.shape[0] > self.n_total:
+            raise ValueError(
+                f'More than n_total={self.n_total} samples in the stream')
+        if self.buffer is None:
+            self.ranks = [quantile_ranks(q_, self.n_total, chunk.dtype)
+                          for q_ in as_list(self.q)]
+            n_low = max(hi for _, hi, _ in self.ranks) + 1
+            n_high = self.n_total - min(lo for lo, _, _ in self.ranks)
+            # Keep the side of the distribution with fewer samples
+            self.smallest = n_low <= n_high
+            self.n_keep = n_low if self.smallest else n_high
+            values = chunk
+        else:
+            values = torch.cat((self.buffer, chunk), 0)
+        self.n_seen += chunk.shape[0]
+
+        self.buffer = extremes(values, self.n_keep, not self.smallest)
+        return self
+
+    def result(self):
+        if self.n_seen != self.n_total:
+            raise ValueError(
+                f'Expected {self.n_total} samples, got {self.n_seen}')
+        # Ranks in the buffer, which holds the n_keep extreme samples
+        offset = 0 if self.smallest else self.n_total - self.n_keep
+        values = order_statistics(
+            self.buffer, [lo - offset for lo, _, _ in self.ranks]
+            + [hi - offset for _, hi, _ in self.ranks])
+        result = interpolate_ranks(values, self.ranks, offset)
+        return result[0] if is_scalar(self.q) else result
+
+
+def streaming_quantile(chunks, n_total, q):
+    """
+    Quantile q over the first dimension of the concatenation of chunks,
+    without concatenating them (see StreamingQuantile)
+    """
+    state = StreamingQuantile(n_total, q)
+    for chunk in chunks:
+        state.update(chunk)
+    return state.result()
@@ -0,0 +1,67 @@
+import torch
+
+
+def init_centers(Y, k):
+    """
+    Deterministic initial centers: the sample closest to the mean, then
+    the sample farthest from the centers already chosen (maximin)
+    """
+    batch_size, M, _ = Y.shape
+    dist = (Y - Y.mean(1, keepdim=True)).pow(2).sum(-1)
+    idx = [dist.argmin(-1)]
+    dist_min = torch.full_like(dist, float('inf'))
+    for _ in range(1, k):
+        center = Y[torch.arange(batch_size), idx[-1]].unsqueeze(1)
+        dist_min = torch.minimum(dist_min, (Y - center).pow(2).sum(-1))
+        idx.append(dist_min.argmax(-1))
+    idx = torch.stack(idx, -1)
+    return Y.gather(1, idx.unsqueeze(-1).expand(-1, -1, Y.shape[-1]))
+
+
+def reduce_scenarios(Y, k, n_iter=20):
+    """
+    Compresses the M samples of each batch element of Y (batch x M x d)
+    into k weighted scenarios with a batched k-means (Lloyd). Returns the
+    centers (batch x k x d) and their weights (batch x k), the fraction
+    of the samples in each cluster. The assignment is not differentiated,
+    the centers are the mean of their samples and keep the gradient.
+    Empty clusters share the center and the weight of the largest one, so
+    every scenario has a positive weight and the problem is unchanged.
+    """
+    batch_size, M, d = Y.shape
+    if k >= M:
+        return Y, torch.full(
+            (batch_size, M), 1/M, dtype=Y.dtype, device=Y.device)
+
+    with torch.no_grad():
+        Y_d = Y.detach()
+        centers = init_centers(Y_d, k)
+        assign = None
+        for _ in range(0, n_iter):
+            new_assign = torch.cdist(Y_d, centers).argmin(-1)
+            if assign is not None and torch.equal(new_assign, assign):
+                break
+            assign = new_assign
+            one_hot = torch.nn.functional.one_hot(assign, k).to(Y.dtype)
+            counts = one_hot.sum(1)
+            sums = one_hot.transpose(1, 2)@Y_d
+            centers = torch.where(
+                counts.unsqueeze(-1) > 0,
+                sums/torch.clamp(counts, min=1).unsqueeze(-1), centers)
+
+    one_hot = torch.nn.functional.one_hot(assign, k).to(Y.dtype)
+    counts = one_hot.sum(1)
+    centers = (one_hot.transpose(1, 2)@Y)/torch.clamp(
+        counts, min=1).unsqueeze(-1)
+    weights = counts/M
+
+    empty = counts == 0
+    largest = counts.argmax(-1, keepdim=True)
+    is_largest = torch.nn.functional.one_hot(
+        largest.squeeze(-1), k).bool()
+    share = weights.gather(-1, largest)/(1 + empty.sum(-1, keepdim=True))
+    weights = torch.where(empty | is_largest, share, weights)
+    centers = torch.where(
+        empty.unsqueeze(-1),
+        centers.gather(1, largest.unsqueeze(-1).expand(-1, -1, d)), centers)
+    return centers, weights
@@ -0,0 +1,70 @@
+import collections
+import hashlib
+import os
+
+import numpy as np
+import torch
+
+# Number of solver instances kept in memory, the least recently used
+# instance is evicted first
+MAX_SOLVERS = 16
+
+# Backend of the training solvers of the experiment scripts ('qpth' by
+# default, see SolveConstrainedNewsvendor and RiskPortOP), e.g. 'cached'
+# to warm-start the solves of each training sample across epochs
+SOLVER_ENV = 'PAO_SOLVER'
+# '1' to train the combined models with train.tolerance_schedule
+TOL_SCHEDULE_ENV = 'PAO_TOL_SCHEDULE'
+
+_solvers = collections.OrderedDict()
+
+
+def get_training_solver():
+    return os.environ.get(SOLVER_ENV, 'qpth')
+
+
+def use_tol_schedule():
+    return os.environ.get(TOL_SCHEDULE_ENV, '0') == '1'
+
+
+def _key(value):
+    """
+    Hashable key of a constructor argument. Tensors and arrays (e.g. the
+    problem parameters) are identified by the hash of their content.
+    """
+    if torch.is_tensor(value):
+        value = value.detach().cpu().numpy()
+    if isinstance(value, np.ndarray):
+        digest = hashlib.sha256(np.ascontiguousarray(value).tobytes())
+        return ('array', str(value.dtype), value.shape, digest.hexdigest())
+    if isinstance(value, dict):
+        return tuple(sorted((name, _key(v)) for name, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_key(v) for v in value)
+    return (type(value).__name__, str(value))
+
+
+def get_solver(cls, *args, **kwargs):
+    """
+    Shared instance of cls(*args, **kwargs), e.g.
+    get_solver(SolveConstrainedNewsvendor, params_t, M, dev, dtype=dtype).
+    Instances are built once per (class, parameters, n_samples, device,
+    dtype, ...) and reused across M values, seeds and the training and
+    evaluation phases, so their dense matrices are only allocated once.
+    The state of an instance (train/eval mode, tolerance, warm start) is
+    shared as well: callers set the mode they need.
+    """
+    key = (cls.__module__, cls.__qualname__, _key(args), _key(kwargs))
+    if key in _solvers:
+        _solvers.move_to_end(key)
+        return _solvers[key]
+
+    solver = cls(*args, **kwargs)
+    _solvers[key] = solver
+    while len(_solvers) > MAX_SOLVERS:
+        _solvers.popitem(last=False)
+    return solver
+
+
+def clear():
+    _solvers.clear()
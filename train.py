@@ -5,6 +5,26 @@ import math
 from tqdm import tqdm
 import copy
 
+import dtype_utils
+
+
+def tolerance_schedule(eps_start=1e-4, eps_end=1e-11, 
+                       max_iter_start=10, max_iter_end=50):
+    """
+    Schedule of the QP solver tolerance for TrainCombined: the tolerance 
+    decreases geometrically from eps_start to eps_end and the iteration 
+    cap increases linearly, so early epochs use cheap inexact solves. 
+    Returns schedule(epoch, EPOCHS) -> (eps, max_iter).
+    """
+    def schedule(epoch, EPOCHS):
+        frac = epoch/max(1, EPOCHS - 1)
+        eps = eps_start*(eps_end/eps_start)**frac
+        max_iter = int(round(max_iter_start 
+                             + (max_iter_end - max_iter_start)*frac))
+        return eps, max_iter
+    return schedule
+
+
 class TrainDecoupled():
     """
     Class to help on training process using the 
@@ -51,7 +71,7 @@ class TrainDecoupled():
                 
         for i, data in enumerate(self.training_loader):
             
-            x_batch, y_batch = data
+            x_batch, y_batch = data[0], data[1]
             x_batch = x_batch.to(self.dev)
             y_batch = y_batch.to(self.dev)
             
@@ -93,10 +113,12 @@ class TrainDecoupled():
         return loss_data, kl
     
     
-    def train(self, EPOCHS=150, pre_train=-1):
+    def train(self, EPOCHS=150, pre_train=-1, callback=None):
         """
         Update ANN or BNN weights with Decoupled Learning approach 
-        for EPOCHS epochs.
+        for EPOCHS epochs. If given, callback(epoch, valid_loss) is 
+        called after every epoch with the validation data loss (without 
+        the K-scaled KL term) and the training stops if it returns True.
         """
         epoch_number = 0
  
@@ -180,6 +202,9 @@ class TrainDecoupled():
             epoch_number += 1
             self.scheduler.step()
             
+            if callback is not None and callback(epoch, avg_vloss_data):
+                break
+            
         return best_model 
             
 
@@ -191,23 +216,34 @@ class TrainCombined():
     """
     def __init__(self, bnn, model, opt, K, aleat_bool, 
                  training_loader, scaler, validation_loader, 
-                 OP, dev, explr=0.99, bm_stop=True):
+                 OP, dev, explr=0.99, bm_stop=True, tol_schedule=None):
         self.model = model # Neural network (ANN or BNN)
         self.opt = opt
         self.K = K # Useful only for BNN
         self.aleat_bool = aleat_bool # True if allow noise modeling
         self.training_loader = training_loader
         self.scaler = scaler # To denormalize to solve the OP in the training process
-        self.scaler_mean = torch.tensor(self.scaler.mean_, device=dev)
-        self.scaler_std = torch.tensor(self.scaler.scale_, device=dev)
+        self.scaler_mean = dtype_utils.to_tensor(self.scaler.mean_, dev)
+        self.scaler_std = dtype_utils.to_tensor(self.scaler.scale_, dev)
         self.validation_loader = validation_loader
         self.bnn = bnn # True if BNN, False if ANN
+        self.OP = OP
         self.end_loss = OP.end_loss # OP cost function
         self.end_loss_dist = OP.end_loss_dist # OP expect cost function
+        # The QP solvers can be warm-started with the solution of each 
+        # sample at the previous epoch (if the loader returns the indices)
+        self.warm_start = hasattr(OP, 'init_warm_start')
+        if self.warm_start:
+            OP.init_warm_start(len(training_loader.dataset))
         self.dev = dev
         self.scheduler = torch.optim.lr_scheduler.ExponentialLR(
             opt, gamma=explr)
         self.bm_stop = bm_stop
+        # Tolerance of the QP solves of the training epochs (see 
+        # tolerance_schedule), validation always uses the solver tolerance
+        self.tol_schedule = tol_schedule
+        if tol_schedule is not None:
+            self.tol_final = (OP.eps, OP.max_iter)
        
 
     def inverse_transform(self, inp):
@@ -226,6 +262,7 @@ class TrainCombined():
 
         end_total_loss = 0.
         kl_running_loss = 0.
+        self.solver_iters = 0
         
         if flag_pretrain:
             bnn = self.bnn
@@ -236,9 +273,11 @@ class TrainCombined():
         
         for i, data in enumerate(self.training_loader):
             
-            x_batch, y_batch = data
+            x_batch, y_batch = data[0], data[1]
             x_batch = x_batch.to(self.dev)
             y_batch = y_batch.to(self.dev)
+            if self.warm_start and len(data) > 2:
+                self.OP.set_warm_start_index(data[2])
             
             self.opt.zero_grad()
  
@@ -268,18 +307,25 @@ class TrainCombined():
 
             end_total_loss += end_loss_.item()
             kl_running_loss += kl_loss_.item()
+            self.solver_iters += getattr(self.OP, 'n_iter', 0)
+            
+        if self.warm_start:
+            self.OP.set_warm_start_index(None)
 
         end_total_loss = end_total_loss/n_batches
+        self.solver_iters = self.solver_iters/n_batches
         kl = kl_running_loss
 
         return end_total_loss, kl
     
     
     
-    def train(self, EPOCHS=150, pre_train=-1):
+    def train(self, EPOCHS=150, pre_train=-1, callback=None):
         """
         Update ANN or BNN weights with Combined Learning approach 
-        for EPOCHS epochs. 
+        for EPOCHS epochs. If given, callback(epoch, valid_loss) is 
+        called after every epoch with the validation end loss (without 
+        the K-scaled KL term) and the training stops if it returns True.
         """
         epoch_number = 0
         
@@ -297,9 +343,16 @@ class TrainCombined():
                 aleat_bool = self.aleat_bool
                 flag_pretrain = False
 
+            if self.tol_schedule is not None:
+                epoch_eps, epoch_max_iter = self.tol_schedule(epoch, EPOCHS)
+                self.OP.set_tolerance(epoch_eps, epoch_max_iter)
+
             self.model.train(True)
             end_loss, kl_loss = self.train_one_epoch(flag_pretrain)
             total_loss = end_loss + kl_loss
+            
+            if self.tol_schedule is not None:
+                self.OP.set_tolerance(*self.tol_final)
 
             self.model.train(False)
 
@@ -351,6 +404,10 @@ class TrainCombined():
                     f'KL LOSS \t train {round(kl_loss/(self.K+0.0001), 3)} valid {round(kl_loss_val/(self.K+0.0001), 3)} \n',
                     f'TOTAL LOSS \t train {round(total_loss, 3)} valid {round(total_loss_val, 3)} \n',
                 )
+                if self.tol_schedule is not None:
+                    print(f'SOLVER TOLERANCE \t {epoch_eps:.1e}')
+                if self.solver_iters > 0:
+                    print(f'SOLVER ITERATIONS \t {round(self.solver_iters, 1)} per batch')
 
             if  total_loss_val < best_loss:
                 best_loss = total_loss_val
@@ -358,6 +415,9 @@ class TrainCombined():
                 
             epoch_number += 1
             self.scheduler.step()
+            
+            if callback is not None and callback(epoch, end_loss_val):
+                break
         
         if self.bm_stop:
             return best_model